@@ -8,6 +8,8 @@
 # Logger constants
 LOGGER_DB_CONNECTIONS_KEY = 'app.utilities.db.connections'
 LOGGER_DATA_KEY = 'app.utilities.data'
+LOGGER_SNAPSHOT_KEY = 'app.utilities.snapshot'
+LOGGER_CACHE_KEY = 'app.utilities.cache'
 
 # Streamlit keys
 SIDEBAR_STATE_KEY = 'sidebar_state'
@@ -29,20 +31,93 @@ BRIDGE_ACTORS_KEY = 'bridge_actors'
 BRIDGE_GENRES_KEY = 'bridge_genres'
 FACT_TABLE_KEY = 'fact_table'
 
-DIM_YEARS_COLUMNS_KEY = 'dim_years_columns'
-DIM_GENRES_COLUMNS_KEY = 'dim_genres_columns'
-DIM_DIRECTORS_COLUMNS_KEY = 'dim_directors_columns'
-DIM_ACTORS_COLUMNS_KEY = 'dim_actors_columns'
-BRIDGE_ACTORS_COLUMNS_KEY = 'bridge_actors_columns'
-BRIDGE_GENRES_COLUMNS_KEY = 'bridge_genres_columns'
-FACT_TABLE_COLUMNS_KEY = 'fact_table_columns'
+SNAPSHOT_KEY = 'warehouse_snapshot'
+FILTER_MASKS_KEY = 'filter_masks'
+FILTER_SIGNATURE_KEY = 'filter_signature'
+FILTER_SELECTION_KEY = 'filter_selection'
+FILTER_AGGREGATES_KEY = 'filter_aggregates'
+YEAR_STATE_DATA_KEY = 'year_state_data'
+TOP_METRICS_DATA_KEY = 'top_metrics_data'
+INITIAL_DATA_KEY = 'initial_data'
 
-COMPLETE_YEAR_LIST_KEY = 'complete_year_list'
-COMPLETE_YEAR_IDS_LIST_KEY = 'complete_year_ids_list'
-COMPLETE_GENRE_LIST_KEY = 'complete_genre_list'
-MAX_REVENUE_KEY = 'max_revenue'
+# Tables of the IMDB_DWH schema, sorted so every table comes after the ones it references (used by the incremental sync)
+DWH_TABLE_NAMES = [DIM_YEARS_KEY, DIM_GENRES_KEY, DIM_DIRECTORS_KEY, DIM_ACTORS_KEY, BRIDGE_GENRES_KEY, BRIDGE_ACTORS_KEY, FACT_TABLE_KEY]
 
-INITIAL_DATA_KEY = 'initial_data'
+DWH_PRIMARY_KEYS = {
+    DIM_YEARS_KEY: 'YEAR_ID',
+    DIM_GENRES_KEY: 'GENRE_ID',
+    DIM_DIRECTORS_KEY: 'DIRECTOR_ID',
+    DIM_ACTORS_KEY: 'ACTOR_ID',
+    BRIDGE_GENRES_KEY: 'BRIDGE_GENRE_ID',
+    BRIDGE_ACTORS_KEY: 'BRIDGE_ACTOR_ID',
+    FACT_TABLE_KEY: 'FILM_RANK'
+}
+
+# Snowflake session parameters (one authenticated connection per user session)
+SNOW_SESSION_KEY = 'snow_session'
+SNOW_SESSION_IDLE_TIMEOUT = 900
+SNOW_KEEP_ALIVE_FREQUENCY = 900
+
+# Snowflake download parameters
+SNOW_CONCURRENT_DOWNLOAD = True
+SNOW_MAX_CONCURRENT_QUERIES = 4
+SNOW_ARROW_BATCH_SIZE = 50000
+
+# Filter parameters ('memory' filters the snapshot with NumPy masks, 'psql' queries the local db)
+FILTER_BACKEND = 'memory'
+FILTER_CACHE_MAX_MB = 256
+
+# Rollup cube parameters (dimensions and measures of each cell, used by the charts when the filters allow it)
+ROLLUP_CUBE_DIMENSIONS = ['YEAR_ID', 'GENRE_ID', 'USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']
+ROLLUP_CUBE_MEASURES = ['REVENUE', 'USER_VOTES', 'USER_SCORE', 'CRITIC_SCORE']
+ROLLUP_CUBE_VIEW = 'rollup_cube'
+
+# Filter delta parameters (share of the fact rows a toggle can read before the totals are recomputed, both cost the same near 0.6)
+DELTA_MAX_ROWS_FRACTION = 0.5
+
+# Shared snapshot parameters
+SNAPSHOT_MAX_VERSIONS = 2
+SNAPSHOT_CACHE_DIR = 'snapshot_cache'
+SNAPSHOT_MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_FILE_FORMAT = 4
+
+# Local db connection pool parameters (shared by all the sessions of the process)
+PSQL_POOL_MIN_SIZE = 1
+PSQL_POOL_MAX_SIZE = 8
+PSQL_POOL_IDLE_TIMEOUT = 300
+PSQL_POOL_CHECKOUT_TIMEOUT = 30
+PSQL_POOL_PING_AFTER = 30
+
+# Local db load parameters
+COPY_CHUNK_ROWS = 50000
+LOCAL_LOAD_CONNECTIONS = 3
+SCHEMA_SQL_PATH = 'scripts/schema_creation_psql.sql'
+STAGING_SCHEMA_SUFFIX = '_staging'
+PREVIOUS_SCHEMA_SUFFIX = '_previous'
+SWAP_SCHEMA_SUFFIX = '_swap'
+INDEX_CHECK_MIN_ROWS = 100000
+INDEX_CHECK_REVENUE_BAND = 0.01
+
+# Local db synchronization parameters
+SYNC_INCREMENTAL = True
+SYNC_FULL_RELOAD_RATIO = 0.5
+SYNC_MAX_IDS_PER_QUERY = 10000
+SYNC_METADATA_TABLE = 'sync_metadata'
+SYNC_ROW_HASHES_TABLE = 'sync_row_hashes'
+
+# Warehouse statistics parameters
+STATS_RANGE_COLUMNS = ['REVENUE', 'RUNTIME', 'USER_VOTES']
+STATS_CATEGORY_COLUMNS = ['RUNTIME_CATEGORY', 'REVENUE_CATEGORY', 'USER_VOTES_CATEGORY', 'USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY']
 
 # Other parameters
-SCORE_OPTIONS = ['OVERWHELMING_NEGATIVE', 'MOSTLY_NEGATIVE', 'NEGATIVE', 'MIXED', 'POSITIVE', 'MOSTLY_POSITIVE', 'OVERWHELMING_POSITIVE']
\ No newline at end of file
+SCORE_OPTIONS = ['OVERWHELMING_NEGATIVE', 'MOSTLY_NEGATIVE', 'NEGATIVE', 'MIXED', 'POSITIVE', 'MOSTLY_POSITIVE', 'OVERWHELMING_POSITIVE']
+LEVEL_OPTIONS = ['LOW', 'MEDIUM', 'HIGH']
+
+# Compact store parameters (options of each category column, kept in memory as int8 codes)
+STORE_CATEGORY_OPTIONS = {
+    'RUNTIME_CATEGORY': LEVEL_OPTIONS,
+    'REVENUE_CATEGORY': LEVEL_OPTIONS,
+    'USER_VOTES_CATEGORY': LEVEL_OPTIONS,
+    'USER_SCORE_CATEGORY': SCORE_OPTIONS,
+    'CRITIC_SCORE_CATEGORY': SCORE_OPTIONS
+}
\ No newline at end of file
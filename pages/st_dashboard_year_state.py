@@ -1,6 +1,7 @@
 from utilities_navigation import get_login_state, show_info_toast, move_to_login
-from utilities_data import get_initial_data, get_average_data_per_year, get_pie_count
+from utilities_data import get_initial_data, get_session_year_state_data
 from utilities_graphs import lines_graph, pie_chart
+from utilities_snapshot import get_session_result
 from pages.st_sidebar import get_filter_sidebar
 
 from global_parameters import *
@@ -20,11 +21,10 @@ if not get_login_state():
 # Sidebar initialization
 get_filter_sidebar()
 
-fact_table = st.session_state[FACT_TABLE_KEY]
+# The data of the charts is shared by every session with the same filters
+avg_data, pie_counts = get_session_result(YEAR_STATE_DATA_KEY, get_session_year_state_data)
 
 # Lines Graphs
-average_data_columns = ['YEAR_ID', 'USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES']
-avg_data = get_average_data_per_year(st.session_state[DIM_YEARS_KEY], fact_table[average_data_columns])
 years = list(avg_data['YEAR'])
 
 user_score_traces = years, list(avg_data['USER_SCORE'].astype(int)), 'User Score'
@@ -38,8 +38,7 @@ revenue_graph = lines_graph('Average Film Revenue per Year', 'Year', 'Average Re
 user_votes_graph = lines_graph('Average User Votes per Year', 'Year', 'Average User Votes', [user_votes_traces])
 
 # Pie Graphs
-pie_columns = ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']
-user_score_count, critic_score_count, user_votes_count, revenue_category_count = get_pie_count(fact_table[pie_columns])
+user_score_count, critic_score_count, user_votes_count, revenue_category_count = pie_counts
 
 colors = px.colors.qualitative.Plotly
 color_discrete_map = {category: color for category, color in zip(SCORE_OPTIONS, colors[:len(SCORE_OPTIONS)])}
@@ -1,5 +1,8 @@
-from utilities_db_connections import create_psql_connection, close_psql_connection
-from utilities_data import get_filtered_dimensions_psql, get_filtered_fact_table_psql
+from utilities_db_connections import psql_connection
+from utilities_data import get_filtered_dimensions_psql, get_filtered_fact_table_psql, is_local_db_current
+from utilities_snapshot import get_session_snapshot, set_session_filters, get_primary_key_mask, get_bridge_genres_mask
+from utilities_filters import get_default_selection
+from utilities_cache import get_filter_signature
 from global_parameters import *
 import streamlit as st
 
@@ -7,59 +10,70 @@ import streamlit as st
 #                               FILTERS
 # -----------------------------------------------------------------------
 
-def apply_filters():
+def get_filter_selection():
 
-    conn = None
-    try:
-        conn = create_psql_connection()
+    snapshot = get_session_snapshot()
 
-        # Selected values initialization
-        selected_years = st.session_state[COMPLETE_YEAR_IDS_LIST_KEY]
-        selected_genres = st.session_state[COMPLETE_GENRE_LIST_KEY]
+    # Default values, used for the widgets that are not rendered yet
+    selection = get_default_selection([], 0.0, snapshot.max_revenue)
 
-        min_revenue = 0.0
-        max_revenue = st.session_state[MAX_REVENUE_KEY]
+    # YEARS
+    for id in snapshot.year_ids_list:
+        if(st.session_state[CHECKBOX_YEAR_ID_PREFIX + str(id)]):
+            selection['year_ids'].append(id)
 
-        max_user_score = SCORE_OPTIONS[-1]
-        max_critic_score = SCORE_OPTIONS[-1]
+    # GENRES
+    if(CHECKBOX_GENRES_KEY in st.session_state and not st.session_state[CHECKBOX_GENRES_KEY]):
+        selection['genres'] = st.session_state[MULTISELECT_GENRES_KEY]
 
-        # YEARS        
-        selected_years = []
-        for id in st.session_state[COMPLETE_YEAR_IDS_LIST_KEY]:
-            if(st.session_state[CHECKBOX_YEAR_ID_PREFIX + str(id)]):
-                selected_years.append(id)
+    # REVENUE
+    if(RANGE_REVENUE_KEY in st.session_state):
+        selection['min_revenue'], selection['max_revenue'] = st.session_state[RANGE_REVENUE_KEY]
 
-        st.session_state[DIM_YEARS_KEY] = get_filtered_dimensions_psql(conn, 'dim_years', st.session_state[DIM_YEARS_COLUMNS_KEY], 'YEAR_ID', selected_years, is_int=True)
+    # MAX SCORES
+    if(SLIDER_USER_SCORE_KEY in st.session_state and SLIDER_CRITIC_SCORE_KEY in st.session_state):
+        selection['max_user_score'] = st.session_state[SLIDER_USER_SCORE_KEY]
+        selection['max_critic_score'] = st.session_state[SLIDER_CRITIC_SCORE_KEY]
 
-        # GENRES
-        if(CHECKBOX_GENRES_KEY in st.session_state):
-            selected_genres = []
-            if st.session_state[CHECKBOX_GENRES_KEY]:
-                selected_genres = None
-            else:
-                selected_genres = st.session_state[MULTISELECT_GENRES_KEY]
+    return selection
+
+def get_filter_masks_psql(selection: dict):
+
+    snapshot = get_session_snapshot()
+    masks = {}
+
+    # The connection is borrowed from the pool of the process, so a filter change costs no handshake
+    with psql_connection() as conn:
+        if not is_local_db_current(conn, snapshot):
+            return snapshot.filter_engine.get_masks(selection)
+
+        dim_years = get_filtered_dimensions_psql(conn, 'dim_years', snapshot.get_columns(DIM_YEARS_KEY), 'YEAR_ID', selection['year_ids'])
+        dim_genres = get_filtered_dimensions_psql(conn, 'dim_genres', snapshot.get_columns(DIM_GENRES_KEY), 'GENRE_NAME', selection['genres'])
 
-            dim_genres = get_filtered_dimensions_psql(conn, 'dim_genres', st.session_state[DIM_GENRES_COLUMNS_KEY], 'GENRE_NAME', selected_genres, is_int=False)
-            st.session_state[DIM_GENRES_KEY] = dim_genres
-            st.session_state[BRIDGE_GENRES_KEY] = get_filtered_dimensions_psql(conn, 'bridge_genres', st.session_state[BRIDGE_GENRES_COLUMNS_KEY], 'GENRE_ID', list(dim_genres['GENRE_ID']), is_int=True)
+        # The genres are filtered by name inside the fact query, so it does not wait for the bridge rows
+        fact_table = get_filtered_fact_table_psql(conn, snapshot.get_columns(FACT_TABLE_KEY), selection['min_revenue'], selection['max_revenue'], selection['year_ids'],
+                                                  selection['genres'], selection['max_user_score'], selection['max_critic_score'])
 
-        # REVENUE
-        if(RANGE_REVENUE_KEY in st.session_state):
-            min_revenue, max_revenue = st.session_state[RANGE_REVENUE_KEY]
+    masks[DIM_YEARS_KEY] = get_primary_key_mask(DIM_YEARS_KEY, dim_years)
+    masks[DIM_GENRES_KEY] = get_primary_key_mask(DIM_GENRES_KEY, dim_genres)
+    masks[BRIDGE_GENRES_KEY] = get_bridge_genres_mask(dim_genres)
+    masks[FACT_TABLE_KEY] = get_primary_key_mask(FACT_TABLE_KEY, fact_table)
 
-        # MAX SCORES
-        if(SLIDER_USER_SCORE_KEY in st.session_state and SLIDER_CRITIC_SCORE_KEY in st.session_state):
-            max_user_score = st.session_state[SLIDER_USER_SCORE_KEY]
-            max_critic_score = st.session_state[SLIDER_CRITIC_SCORE_KEY]
+    return masks
 
-        # FACT TABLE
-        bridge_genres = st.session_state[BRIDGE_GENRES_KEY]
-        selected_bridge_genres_ids = list(bridge_genres['BRIDGE_GENRE_ID'])
-        
-        st.session_state[FACT_TABLE_KEY] = get_filtered_fact_table_psql(conn, st.session_state[FACT_TABLE_COLUMNS_KEY], min_revenue, max_revenue, selected_years, selected_bridge_genres_ids, max_user_score, max_critic_score)
+def get_filter_masks(selection: dict):
+    if FILTER_BACKEND == 'psql':
+        return get_filter_masks_psql(selection)
 
-    finally:
-        close_psql_connection(conn)
+    return get_session_snapshot().filter_engine.get_masks(selection)
+
+def apply_filters():
+
+    selection = get_filter_selection()
+    signature = get_filter_signature(selection)
+
+    # The masks select rows of the shared snapshot, and they are built and cached the first time a chart reads a filtered table
+    set_session_filters(selection, signature, lambda: get_filter_masks(selection))
 
 # -----------------------------------------------------------------------
 #                              WIDGETS
@@ -116,9 +130,11 @@ def get_filter_sidebar():
         st.header('Filters')
 
         if(INITIAL_DATA_KEY in st.session_state):
-            checkbox_container('Years', CHECKBOX_YEAR_CONTAINER_KEY, st.session_state[COMPLETE_YEAR_LIST_KEY], st.session_state[COMPLETE_YEAR_IDS_LIST_KEY])
-            multiselect_container('Genres', 'Genres to filter', st.session_state[COMPLETE_GENRE_LIST_KEY], MULTISELECT_GENRES_KEY, CHECKBOX_GENRES_KEY, 5, 'Select 1 to 5 genres')
-            range_float_container('Revenue', 'Revenue interval to select', RANGE_REVENUE_KEY, 0.0, st.session_state[MAX_REVENUE_KEY])
+            snapshot = get_session_snapshot()
+
+            checkbox_container('Years', CHECKBOX_YEAR_CONTAINER_KEY, snapshot.year_list, snapshot.year_ids_list)
+            multiselect_container('Genres', 'Genres to filter', snapshot.genre_list, MULTISELECT_GENRES_KEY, CHECKBOX_GENRES_KEY, 5, 'Select 1 to 5 genres')
+            range_float_container('Revenue', 'Revenue interval to select', RANGE_REVENUE_KEY, 0.0, snapshot.max_revenue)
             slider_container('User score', 'Select the maximum user score', SLIDER_USER_SCORE_KEY, SCORE_OPTIONS, SCORE_OPTIONS[-1])
             slider_container('Critic score', 'Select the maximum critic score', SLIDER_CRITIC_SCORE_KEY, SCORE_OPTIONS, SCORE_OPTIONS[-1])
 
@@ -0,0 +1,380 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                               BENCHMARKS
+#   This script is executed apart from the app, and it is used to measure
+#   the data functions of the app with the .csv files in the datasets
+#   folder, replicated to simulate a bigger warehouse.
+#
+#   Usage (from the project folder): python scripts/benchmarks.py <name> [scale]
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import os
+import sys
+import time
+from dotenv import load_dotenv
+import psycopg2 as psy
+import psycopg2.extras as extras
+import pandas as pd
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities_db_connections import get_psql_config
+from utilities_data import get_top_directors, get_top_genres, get_top_actors, get_year_state_data, get_year_state_data_delta, get_top_metrics_data, DataFrameCsvReader, copy_local_rows, get_score_list, list_to_wherein, get_schema_statements, get_filtered_fact_table_query, get_fact_table_conditions, get_pyformat_query
+from utilities_filters import FilterEngine
+from utilities_snapshot import WarehouseSnapshot, get_masked_table
+from utilities_store import get_compact_table, get_table_memory
+from utilities_delta import FilterDeltaEngine
+from global_parameters import *
+
+load_dotenv()
+
+# -----------------------------------------------------------------------
+#                          GLOBAL PARAMETERS
+# -----------------------------------------------------------------------
+
+DATASETS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datasets')
+
+# -----------------------------------------------------------------------
+#                              FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_dataset_tables():
+    return {table_name: pd.read_csv(os.path.join(DATASETS_FOLDER, f'{table_name}.csv')) for table_name in DWH_TABLE_NAMES}
+
+def get_scaled_fact_table(fact_table: pd.DataFrame, scale: int):
+
+    # Every copy of the films gets new ranks, keeping the same dimensions and bridges
+    copies = []
+    for i in range(scale):
+        copy = fact_table.copy()
+        copy['FILM_RANK'] = copy['FILM_RANK'] + i * len(fact_table)
+        copies.append(copy)
+
+    return pd.concat(copies, ignore_index=True)
+
+def get_scaled_film_tables(tables: dict, scale: int):
+
+    # Every copy of the films gets its own bridge rows, so the bridges grow with the scale
+    fact_table = tables[FACT_TABLE_KEY]
+    scaled_tables = {**tables}
+
+    # Some ranks are missing from the fact table, so the copies are shifted by the highest one to keep them unique
+    rank_offset = int(fact_table['FILM_RANK'].max())
+
+    fact_copies = []
+    for i in range(scale):
+        fact_copy = fact_table.copy()
+        fact_copy['FILM_RANK'] = fact_copy['FILM_RANK'] + i * rank_offset
+
+        for bridge_key, bridge_id in [(BRIDGE_GENRES_KEY, 'BRIDGE_GENRE_ID'), (BRIDGE_ACTORS_KEY, 'BRIDGE_ACTOR_ID')]:
+            fact_copy[bridge_id] = fact_copy[bridge_id] + i * len(tables[bridge_key])
+
+        fact_copies.append(fact_copy)
+
+    for bridge_key, bridge_id in [(BRIDGE_GENRES_KEY, 'BRIDGE_GENRE_ID'), (BRIDGE_ACTORS_KEY, 'BRIDGE_ACTOR_ID')]:
+        bridge_table = tables[bridge_key]
+
+        bridge_copies = []
+        for i in range(scale):
+            bridge_copy = bridge_table.copy()
+            bridge_copy[bridge_id] = bridge_copy[bridge_id] + i * len(bridge_table)
+            bridge_copy['FILM_RANK'] = bridge_copy['FILM_RANK'] + i * rank_offset
+            bridge_copies.append(bridge_copy)
+
+        scaled_tables[bridge_key] = pd.concat(bridge_copies, ignore_index=True)
+
+    scaled_tables[FACT_TABLE_KEY] = pd.concat(fact_copies, ignore_index=True)
+
+    return scaled_tables
+
+def measure(function, repeat: int = 3):
+
+    best_time = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    return best_time, result
+
+def print_result(name: str, seconds: float, rows: int):
+    print(f"\t- {name}: {seconds * 1000:.1f} ms ({rows / seconds:,.0f} rows/s)")
+
+# -----------------------------------------------------------------------
+#                             BENCHMARKS
+# -----------------------------------------------------------------------
+
+def benchmark_local_load(scale: int):
+
+    fact_table = get_scaled_fact_table(get_dataset_tables()[FACT_TABLE_KEY], scale)
+    rows = len(fact_table)
+    print(f"\n----------- Local load of {rows} fact rows -----------")
+
+    # Encoding only, no database needed
+    seconds, _ = measure(lambda: [tuple(x) for x in fact_table.to_numpy()])
+    print_result('Tuples for execute_values (encoding)', seconds, rows)
+
+    def read_all_csv():
+        reader = DataFrameCsvReader(fact_table)
+        while reader.read(8192):
+            pass
+
+    seconds, _ = measure(read_all_csv)
+    print_result('CSV chunks for COPY (encoding)', seconds, rows)
+
+    try:
+        conn = psy.connect(**get_psql_config())
+    except (psy.OperationalError, TypeError, ValueError) as error:
+        print(f"[INFO] The local PostgreSQL is not available, the load into the database is not measured:\n\t- Msg: {error}")
+        return
+
+    cols = ','.join(list(fact_table.columns))
+
+    def load_execute_values():
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE bench_fact_table (LIKE imdb_dwh.fact_table)")
+            extras.execute_values(cursor, f"INSERT INTO pg_temp.bench_fact_table({cols}) VALUES %s", [tuple(x) for x in fact_table.to_numpy()])
+        conn.rollback()
+
+    def load_copy():
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE bench_fact_table (LIKE imdb_dwh.fact_table)")
+            copy_local_rows(cursor, 'pg_temp', 'bench_fact_table', fact_table)
+        conn.rollback()
+
+    try:
+        seconds, _ = measure(load_execute_values)
+        print_result('execute_values into PostgreSQL', seconds, rows)
+
+        seconds, _ = measure(load_copy)
+        print_result('COPY FROM STDIN into PostgreSQL', seconds, rows)
+    finally:
+        conn.close()
+
+def benchmark_filters(scale: int):
+
+    tables = get_dataset_tables()
+    tables[FACT_TABLE_KEY] = get_scaled_fact_table(tables[FACT_TABLE_KEY], scale)
+    fact_table = tables[FACT_TABLE_KEY]
+    rows = len(fact_table)
+    print(f"\n----------- Filters over {rows} fact rows -----------")
+
+    seconds, engine = measure(lambda: FilterEngine(tables), repeat=1)
+    print_result('Filter engine build', seconds, rows)
+
+    selection = {
+        'year_ids': list(tables[DIM_YEARS_KEY]['YEAR_ID'][::2]),
+        'genres': ['ACTION', 'DRAMA', 'COMEDY'],
+        'min_revenue': 10.0,
+        'max_revenue': 500.0,
+        'max_user_score': 'POSITIVE',
+        'max_critic_score': 'MOSTLY_POSITIVE'
+    }
+
+    # Same filters with pandas, as the session applied them before the engine
+    def filter_pandas():
+        dim_genres = tables[DIM_GENRES_KEY]
+        bridge_genres = tables[BRIDGE_GENRES_KEY]
+        genre_ids = dim_genres.loc[dim_genres['GENRE_NAME'].isin(selection['genres']), 'GENRE_ID']
+        bridge_genre_ids = bridge_genres.loc[bridge_genres['GENRE_ID'].isin(genre_ids), 'BRIDGE_GENRE_ID']
+
+        return (fact_table['YEAR_ID'].isin(selection['year_ids']) & fact_table['BRIDGE_GENRE_ID'].isin(bridge_genre_ids)
+                & fact_table['REVENUE'].between(selection['min_revenue'], selection['max_revenue'])
+                & fact_table['USER_SCORE_CATEGORY'].isin(get_score_list(selection['max_user_score']))
+                & fact_table['CRITIC_SCORE_CATEGORY'].isin(get_score_list(selection['max_critic_score']))).to_numpy()
+
+    seconds, pandas_mask = measure(filter_pandas)
+    print_result('Pandas isin masks', seconds, rows)
+
+    seconds, masks = measure(lambda: engine.get_masks(selection), repeat=20)
+    print_result('Filter engine masks', seconds, rows)
+
+    assert((masks[FACT_TABLE_KEY] == pandas_mask).all())
+
+def benchmark_genre_filter(scale: int):
+
+    schema_name = 'imdb_dwh_benchmark'
+    tables = get_dataset_tables()
+    selection = {'year_ids': list(tables[DIM_YEARS_KEY]['YEAR_ID']), 'genres': ['ACTION', 'DRAMA', 'COMEDY'], 'min_revenue': 0.0, 'max_revenue': None}
+
+    try:
+        conn = psy.connect(**get_psql_config())
+    except (psy.OperationalError, TypeError, ValueError) as error:
+        print(f"[INFO] The local PostgreSQL is not available, the genre filter is not measured:\n\t- Msg: {error}")
+        return
+
+    # Genres filtered as the sidebar did before: the bridge ids go to the client and come back as a literal IN list
+    def filter_client_side(cursor):
+        cursor.execute(f"SELECT genre_id FROM {schema_name}.dim_genres WHERE {list_to_wherein('genre_name', selection['genres'])}")
+        genre_ids = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(f"SELECT bridge_genre_id FROM {schema_name}.bridge_genres WHERE {list_to_wherein('genre_id', genre_ids, is_int=True)}")
+        bridge_genre_ids = [row[0] for row in cursor.fetchall()]
+
+        conditions, params = get_fact_table_conditions(schema_name, selection['min_revenue'], selection['max_revenue'], selection['year_ids'])
+        query = f"SELECT f.* FROM {schema_name}.fact_table f WHERE {' AND '.join(conditions)} AND {list_to_wherein('f.bridge_genre_id', bridge_genre_ids, is_int=True)}"
+        cursor.execute(get_pyformat_query(query), params)
+
+        return len(cursor.fetchall()), len(query)
+
+    def filter_server_side(cursor):
+        query, params = get_filtered_fact_table_query(schema_name, selection['min_revenue'], selection['max_revenue'], selection['year_ids'], selection['genres'])
+        cursor.execute(get_pyformat_query(query), params)
+
+        return len(cursor.fetchall()), len(query)
+
+    try:
+        for genre_scale in sorted(set([1, max(1, scale // 10), scale])):
+            scaled_tables = get_scaled_film_tables(tables, genre_scale)
+            print(f"\n----------- Genre filter with {len(scaled_tables[BRIDGE_GENRES_KEY])} bridge rows -----------")
+
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE")
+                cursor.execute(f"CREATE SCHEMA {schema_name}")
+                cursor.execute(f"SET search_path TO {schema_name}")
+
+                for statement in get_schema_statements('CREATE TABLE'):
+                    cursor.execute(statement)
+
+                for table_name in DWH_TABLE_NAMES:
+                    copy_local_rows(cursor, schema_name, table_name, scaled_tables[table_name])
+
+                for statement in get_schema_statements('CREATE INDEX'):
+                    cursor.execute(statement)
+
+                cursor.execute("ANALYZE")
+            conn.commit()
+
+            with conn.cursor() as cursor:
+                seconds, (client_rows, client_query_size) = measure(lambda: filter_client_side(cursor))
+                print_result(f'Bridge ids through the client (3 queries, {client_query_size:,} chars)', seconds, client_rows)
+
+                seconds, (server_rows, server_query_size) = measure(lambda: filter_server_side(cursor))
+                print_result(f'EXISTS semi-join in the database (1 query, {server_query_size:,} chars)', seconds, server_rows)
+
+            assert(client_rows == server_rows)
+
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE")
+        conn.commit()
+        conn.close()
+
+def benchmark_top_n(scale: int):
+
+    tables = get_scaled_film_tables(get_dataset_tables(), scale)
+    fact_table = tables[FACT_TABLE_KEY]
+    rows = len(fact_table)
+    print(f"\n----------- Top N over {rows} fact rows -----------")
+
+    # Same charts with pandas, as they were computed before the top N engine
+    def get_top_pandas(merged: pd.DataFrame, name_column: str, n: int):
+        average_data = merged[['REVENUE', name_column, 'USER_SCORE']].groupby(name_column).mean().reset_index()
+
+        return average_data.sort_values(by=['REVENUE'], ascending=False).head(n)[['REVENUE', name_column, 'USER_SCORE']]
+
+    top_functions = {
+        'directors': (lambda: get_top_pandas(fact_table.merge(tables[DIM_DIRECTORS_KEY], on='DIRECTOR_ID'), 'DIRECTOR_NAME', 15),
+                      lambda: get_top_directors(tables[DIM_DIRECTORS_KEY], fact_table)),
+        'genres': (lambda: get_top_pandas(fact_table.merge(tables[BRIDGE_GENRES_KEY], on='FILM_RANK').merge(tables[DIM_GENRES_KEY], on='GENRE_ID'), 'GENRE_NAME', 5),
+                   lambda: get_top_genres(tables[DIM_GENRES_KEY], tables[BRIDGE_GENRES_KEY], fact_table)),
+        'actors': (lambda: get_top_pandas(fact_table.merge(tables[BRIDGE_ACTORS_KEY], on='FILM_RANK').merge(tables[DIM_ACTORS_KEY], on='ACTOR_ID'), 'ACTOR_NAME', 15),
+                   lambda: get_top_actors(tables[DIM_ACTORS_KEY], tables[BRIDGE_ACTORS_KEY], fact_table))
+    }
+
+    for name, (top_pandas, top_engine) in top_functions.items():
+        seconds, pandas_result = measure(top_pandas)
+        print_result(f'Top {name} with pandas merges', seconds, rows)
+
+        seconds, engine_result = measure(top_engine)
+        print_result(f'Top {name} with the top N engine', seconds, rows)
+
+        # The default sort leaves tied revenues in no fixed order and the engine orders them by name, so only the revenues are compared
+        np.testing.assert_allclose(engine_result['REVENUE'], pandas_result['REVENUE'], rtol=1e-12)
+
+def benchmark_compact_store(scale: int):
+
+    tables = get_scaled_film_tables(get_dataset_tables(), scale)
+    compact_tables = {table_name: get_compact_table(table) for table_name, table in tables.items()}
+    rows = len(tables[FACT_TABLE_KEY])
+    print(f"\n----------- Compact store of {rows} fact rows -----------")
+
+    for table_name in DWH_TABLE_NAMES:
+        print(f"\t- {table_name}: {get_table_memory(tables[table_name]) / 2**20:.2f} MB with the default types, {get_table_memory(compact_tables[table_name]) / 2**20:.2f} MB compacted")
+
+    for name, store_tables in [('default types', tables), ('compact store', compact_tables)]:
+        snapshot = WarehouseSnapshot('benchmark', 'benchmark', 'benchmark', name, store_tables, {})
+        masks = snapshot.filter_engine.get_masks({'year_ids': list(range(0, 11, 2)), 'genres': ['ACTION', 'DRAMA', 'COMEDY'], 'min_revenue': 10.0, 'max_revenue': 500.0,
+                                                  'max_user_score': 'MOSTLY_POSITIVE', 'max_critic_score': 'POSITIVE'})
+        # The film view is built once per snapshot, so it is left out of the times
+        snapshot.film_view
+
+        seconds, result = measure(lambda: get_year_state_data(lambda table_name: get_masked_table(snapshot, masks, table_name)))
+        print_result(f'Year state data with the {name}', seconds, rows)
+
+        seconds, result = measure(lambda: get_top_metrics_data(snapshot, masks))
+        print_result(f'Top metrics data with the {name}', seconds, rows)
+
+def benchmark_filter_delta(scale: int):
+
+    tables = {table_name: get_compact_table(table) for table_name, table in get_scaled_film_tables(get_dataset_tables(), scale).items()}
+    rows = len(tables[FACT_TABLE_KEY])
+    print(f"\n----------- Filter deltas over {rows} fact rows -----------")
+
+    filter_engine = FilterEngine(tables)
+    delta_engine = FilterDeltaEngine.build(tables)
+    year_ids = list(tables[DIM_YEARS_KEY]['YEAR_ID'])
+    genres = list(tables[DIM_GENRES_KEY]['GENRE_NAME'])
+
+    selection = {'year_ids': year_ids, 'genres': genres, 'min_revenue': 10.0, 'max_revenue': 500.0, 'max_user_score': SCORE_OPTIONS[-1], 'max_critic_score': SCORE_OPTIONS[-1]}
+    aggregates = delta_engine.get_full_aggregates(selection)
+
+    # Each toggle is measured from the same totals, as a session that changes one widget
+    toggles = {
+        'one year removed': {**selection, 'year_ids': year_ids[1:]},
+        'one genre removed': {**selection, 'genres': [genre for genre in genres if genre != 'WESTERN']},
+        'user score ceiling lowered': {**selection, 'max_user_score': 'MOSTLY_POSITIVE'},
+        'revenue range changed': {**selection, 'min_revenue': 20.0}
+    }
+
+    for name, toggle in toggles.items():
+        def recompute_pandas():
+            masks = filter_engine.get_masks(toggle)
+            return get_year_state_data(lambda table_name: tables[table_name][masks[table_name]] if table_name in masks else tables[table_name])
+
+        seconds, pandas_result = measure(recompute_pandas)
+        print_result(f'{name.capitalize()}, masks and pandas recompute', seconds, rows)
+
+        # Same totals without the previous ones, so the gain of the delta is not mixed with the masks the year state page no longer builds
+        seconds, full_result = measure(lambda: get_year_state_data_delta(delta_engine, delta_engine.get_full_aggregates(toggle)))
+        print_result(f'{name.capitalize()}, full recompute of the totals', seconds, rows)
+
+        seconds, delta_result = measure(lambda: get_year_state_data_delta(delta_engine, delta_engine.get_aggregates(toggle, aggregates)))
+        print_result(f'{name.capitalize()}, delta engine', seconds, rows)
+
+        pd.testing.assert_frame_equal(delta_result[0], pandas_result[0].reset_index(drop=True), check_dtype=False, rtol=1e-9)
+
+# -----------------------------------------------------------------------
+#                                 MAIN
+# -----------------------------------------------------------------------
+
+BENCHMARKS = {
+    'load': benchmark_local_load,
+    'filters': benchmark_filters,
+    'genre_filter': benchmark_genre_filter,
+    'top_n': benchmark_top_n,
+    'store': benchmark_compact_store,
+    'delta': benchmark_filter_delta
+}
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python scripts/benchmarks.py <{'|'.join(BENCHMARKS)}> [scale]")
+        sys.exit(1)
+
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    BENCHMARKS[sys.argv[1]](scale)
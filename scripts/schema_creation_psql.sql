@@ -64,4 +64,38 @@ CREATE TABLE fact_table(
     FOREIGN KEY(BRIDGE_ACTOR_ID) REFERENCES bridge_actors(BRIDGE_ACTOR_ID),
     FOREIGN KEY(DIRECTOR_ID) REFERENCES dim_directors(DIRECTOR_ID),
     FOREIGN KEY(YEAR_ID) REFERENCES dim_years(YEAR_ID)
-);
\ No newline at end of file
+);
+
+-- Tables used to synchronize only the changed rows from Snowflake
+CREATE TABLE sync_metadata(
+    TABLE_NAME VARCHAR(30) PRIMARY KEY,
+    LAST_ALTERED TIMESTAMPTZ NOT NULL,
+    ROW_COUNT BIGINT NOT NULL
+);
+
+CREATE TABLE sync_row_hashes(
+    TABLE_NAME VARCHAR(30) NOT NULL,
+    ROW_ID INT NOT NULL,
+    ROW_HASH BIGINT NOT NULL,
+    PRIMARY KEY(TABLE_NAME, ROW_ID)
+);
+
+-- Secondary indexes used by the filters of the app (rebuilt by the app after each full load)
+CREATE INDEX IF NOT EXISTS idx_fact_table_revenue ON fact_table(REVENUE);
+CREATE INDEX IF NOT EXISTS idx_fact_table_year_scores ON fact_table(YEAR_ID, USER_SCORE_CATEGORY, CRITIC_SCORE_CATEGORY);
+CREATE INDEX IF NOT EXISTS idx_fact_table_bridge_genre ON fact_table(BRIDGE_GENRE_ID);
+CREATE INDEX IF NOT EXISTS idx_bridge_genres_genre_film ON bridge_genres(GENRE_ID, FILM_RANK);
+CREATE INDEX IF NOT EXISTS idx_bridge_actors_actor_film ON bridge_actors(ACTOR_ID, FILM_RANK);
+CREATE INDEX IF NOT EXISTS idx_dim_genres_name ON dim_genres(GENRE_NAME);
+
+-- Rollup cube of the fact table used by the charts (refreshed by the app after each load)
+CREATE MATERIALIZED VIEW IF NOT EXISTS rollup_cube AS
+    SELECT f.YEAR_ID, b.GENRE_ID, f.USER_SCORE_CATEGORY, f.CRITIC_SCORE_CATEGORY, f.USER_VOTES_CATEGORY, f.REVENUE_CATEGORY,
+           COUNT(*) AS FILM_COUNT, MIN(f.REVENUE) AS REVENUE_MIN, MAX(f.REVENUE) AS REVENUE_MAX,
+           SUM(f.REVENUE) AS REVENUE_SUM, SUM(f.USER_VOTES) AS USER_VOTES_SUM, SUM(f.USER_SCORE) AS USER_SCORE_SUM, SUM(f.CRITIC_SCORE) AS CRITIC_SCORE_SUM,
+           AVG(f.REVENUE) AS REVENUE_MEAN, AVG(f.USER_VOTES) AS USER_VOTES_MEAN, AVG(f.USER_SCORE) AS USER_SCORE_MEAN, AVG(f.CRITIC_SCORE) AS CRITIC_SCORE_MEAN
+    FROM fact_table f JOIN bridge_genres b ON b.BRIDGE_GENRE_ID = f.BRIDGE_GENRE_ID
+    GROUP BY f.YEAR_ID, b.GENRE_ID, f.USER_SCORE_CATEGORY, f.CRITIC_SCORE_CATEGORY, f.USER_VOTES_CATEGORY, f.REVENUE_CATEGORY;
+
+-- Unique index needed to refresh the cube without blocking the readers
+CREATE UNIQUE INDEX IF NOT EXISTS idx_rollup_cube_cell ON rollup_cube(YEAR_ID, GENRE_ID, USER_SCORE_CATEGORY, CRITIC_SCORE_CATEGORY, USER_VOTES_CATEGORY, REVENUE_CATEGORY);
@@ -1,19 +1,53 @@
 # ///////////////////////////////////////////////////////////////////////
 #
-#                       TEST DB CONNECTIONS
-#   Python script used for testing the functions used to connect to
-#   the snowflake account and the local Postgres database.
+#                           TEST UTILITIES
+#   Python script used for testing the connections to the snowflake
+#   account and the local Postgres database, the snapshot and its cache,
+#   the filters, the rollup cube, the delta totals, the compact store,
+#   the top N engine and the film view used by the charts.
 #
 # ///////////////////////////////////////////////////////////////////////
 
 import unittest
 import os
 from dotenv import load_dotenv
-from unittest.mock import patch
-from utilities_db_connections import validate_credentials, create_snow_connection, create_psql_connection, close_snow_connection, close_psql_connection
+from unittest.mock import patch, MagicMock
+import time
+from utilities_db_connections import validate_credentials, create_snow_connection, create_psql_connection, close_snow_connection, close_psql_connection, PsqlConnectionPool, SnowSession
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+from psycopg2.pool import PoolError
+import pandas as pd
+from utilities_filters import FilterEngine, BitmapIndex, get_default_selection
+from utilities_cache import FilterResultCache, get_filter_signature
+import numpy as np
+from utilities_data import check_local_index_usage, get_filter_check_queries, get_filter_check_values, build_warehouse_snapshot, fetch_snow_dataframe, get_snow_table_versions, get_score_list, get_fact_table_conditions, get_year_state_query, get_year_state_data_psql, get_grouping_sets, is_local_db_current, get_year_state_data, get_year_state_data_delta, get_routed_year_state_data, get_top_metrics_data, get_year_state_data_cube, get_psql_column_types, read_psql_csv, read_psql_rows, fetch_psql_dataframe, get_top_directors, get_top_genres, get_top_actors, get_bubble_layout, get_bubble_directors, get_bubble_genres, get_bubble_actors
+import tracemalloc
+from utilities_star import FilmView
+import io
+import pyarrow as pa
+from utilities_rollup import RollupCube
+from utilities_store import get_compact_table, get_table_memory
+from utilities_delta import FilterDeltaEngine
+from utilities_snapshot import WarehouseSnapshot, SnapshotRegistry, get_data_version, get_bridge_genres_mask
+from datetime import datetime, timezone, timedelta
+from global_parameters import *
 
 load_dotenv()
 
+# Filters of the tests that compare two ways of getting the same films
+TEST_SELECTION = {'year_ids': [0, 3, 4, 8], 'genres': ['ACTION', 'DRAMA'], 'min_revenue': 20.0, 'max_revenue': 300.0, 'max_user_score': 'POSITIVE', 'max_critic_score': 'MIXED'}
+
+def get_dataset_tables(compact: bool = False):
+    tables = {table_name: pd.read_csv(os.path.join('datasets', f'{table_name}.csv')) for table_name in DWH_TABLE_NAMES}
+
+    if compact:
+        return {table_name: get_compact_table(table) for table_name, table in tables.items()}
+
+    return tables
+
+def get_masked_table_reader(tables: dict, masks: dict):
+    return lambda table_name: tables[table_name][masks[table_name]] if table_name in masks else tables[table_name]
+
 class TestDBConnections(unittest.TestCase):
 
     def setUp(self):
@@ -70,5 +104,669 @@ class TestDBConnections(unittest.TestCase):
         if self.psql_conn:
             close_psql_connection(self.psql_conn)
 
+class FakePsqlConnection:
+
+    def __init__(self):
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+class TestPsqlConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = PsqlConnectionPool(min_size=1, max_size=2, checkout_timeout=0.1, connection_factory=FakePsqlConnection)
+
+    def test_connection_reused(self):
+        conn = self.pool.get_connection()
+        self.pool.put_connection(conn)
+
+        self.assertIs(self.pool.get_connection(), conn, "A released connection should be reused")
+        self.assertEqual(self.pool.get_metrics()['created'], 1, "Only one connection should be created")
+
+    def test_checkout_timeout(self):
+        self.pool.get_connection()
+        self.pool.get_connection()
+
+        with self.assertRaises(PoolError):
+            self.pool.get_connection()
+        self.assertEqual(self.pool.get_metrics()['waits'], 0, "A failed checkout should not count as a wait")
+
+    def test_closed_connection_replaced(self):
+        conn = self.pool.get_connection()
+        self.pool.put_connection(conn)
+        conn.closed = 1
+
+        self.assertIsNot(self.pool.get_connection(), conn, "A closed connection should not be handed out")
+        self.assertEqual(self.pool.get_metrics()['failed_checks'], 1, "The closed connection should fail the health check")
+
+    def test_unfinished_transaction_rolled_back(self):
+        conn = self.pool.get_connection()
+        conn.status = TRANSACTION_STATUS_INERROR
+        self.pool.put_connection(conn)
+
+        self.assertEqual(conn.get_transaction_status(), TRANSACTION_STATUS_IDLE, "The connection should be rolled back when released")
+
+    def test_idle_connections_evicted(self):
+        self.pool.idle_timeout = 0
+        conns = [self.pool.get_connection(), self.pool.get_connection()]
+        for conn in conns:
+            self.pool.put_connection(conn)
+
+        metrics = self.pool.get_metrics()
+        self.assertEqual(metrics['size'], 1, "The pool should keep its minimum size")
+        self.assertEqual(metrics['evicted'], 1, "The extra idle connection should be evicted")
+
+class TestSnowSession(unittest.TestCase):
+
+    @patch('utilities_db_connections.open_snow_connection', side_effect=lambda config: MagicMock(is_closed=MagicMock(return_value=False)))
+    def test_connection_reused(self, mock_open_snow_connection):
+        snow_session = SnowSession({})
+        conn = snow_session.get_connection()
+        snow_session.release_connection(conn)
+
+        self.assertIs(snow_session.get_connection(), conn, "The session should reuse its authenticated connection")
+        self.assertEqual(mock_open_snow_connection.call_count, 1, "The session should authenticate only once")
+        snow_session.close()
+
+    @patch('utilities_db_connections.open_snow_connection', side_effect=lambda config: MagicMock(is_closed=MagicMock(return_value=False)))
+    def test_idle_connection_closed(self, mock_open_snow_connection):
+        snow_session = SnowSession({}, idle_timeout=0.01)
+        conn = snow_session.get_connection()
+        snow_session.release_connection(conn)
+        time.sleep(0.2)
+
+        conn.close.assert_called_once()
+        self.assertIsNot(snow_session.get_connection(), conn, "An idle connection should be replaced by a new one")
+        snow_session.close()
+
+class TestSnowFetch(unittest.TestCase):
+
+    def get_cursor(self, arrow_tables: list):
+        cursor = MagicMock()
+        cursor.description = [(name,) for name in arrow_tables[0].column_names]
+        cursor.rowcount = sum(arrow_table.num_rows for arrow_table in arrow_tables)
+        cursor.fetch_arrow_batches.return_value = iter(arrow_tables)
+
+        return cursor
+
+    def test_nulls_in_later_batch(self):
+        cursor = self.get_cursor([pa.table({'YEAR_ID': [1, 2], 'GENRE_NAME': ['ACTION', 'DRAMA']}), pa.table({'YEAR_ID': [3, None], 'GENRE_NAME': ['COMEDY', None]})])
+        df = fetch_snow_dataframe(cursor)
+
+        self.assertEqual(df['YEAR_ID'].dtype, np.float64, "An int column with NULLs in a later batch should be widened to float")
+        np.testing.assert_array_equal(df['YEAR_ID'].to_numpy(), [1.0, 2.0, 3.0, np.nan])
+        self.assertEqual(list(df['GENRE_NAME']), ['ACTION', 'DRAMA', 'COMEDY', None])
+
+    def test_batches_keep_int_type(self):
+        batches = []
+        cursor = self.get_cursor([pa.table({'YEAR_ID': pa.array([1, 2], type=pa.int8())}), pa.table({'YEAR_ID': pa.array([300, 4], type=pa.int16())})])
+        df = fetch_snow_dataframe(cursor, batches.append)
+
+        self.assertEqual(df['YEAR_ID'].dtype, np.int64, "The int batches should be written into the widest int type")
+        self.assertEqual(list(df['YEAR_ID']), [1, 2, 300, 4])
+        self.assertEqual(len(batches), 2, "Every batch should be passed to the consumer")
+
+    def test_missing_table_version(self):
+        conn = MagicMock()
+        conn.cursor.return_value.fetchall.return_value = [('DIM_YEARS', '2024-01-01', 11), ('FACT_TABLE', '2024-01-01', 838)]
+
+        self.assertEqual(get_snow_table_versions(conn, [DIM_YEARS_KEY, FACT_TABLE_KEY])[FACT_TABLE_KEY], ('2024-01-01', 838))
+        with self.assertRaises(KeyError):
+            get_snow_table_versions(conn, [DIM_YEARS_KEY, DIM_GENRES_KEY])
+
+class TestFilterEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+        self.engine = FilterEngine(self.tables)
+
+    def get_expected_fact_mask(self, selection: dict):
+        dim_genres = self.tables[DIM_GENRES_KEY]
+        bridge_genres = self.tables[BRIDGE_GENRES_KEY]
+        fact_table = self.tables[FACT_TABLE_KEY]
+
+        genres = dim_genres['GENRE_NAME'] if selection['genres'] is None else selection['genres']
+        genre_ids = dim_genres.loc[dim_genres['GENRE_NAME'].isin(genres), 'GENRE_ID']
+        bridge_genre_ids = bridge_genres.loc[bridge_genres['GENRE_ID'].isin(genre_ids), 'BRIDGE_GENRE_ID']
+
+        mask = fact_table['YEAR_ID'].isin(selection['year_ids']) & fact_table['BRIDGE_GENRE_ID'].isin(bridge_genre_ids) & (fact_table['REVENUE'] >= selection['min_revenue'])
+        if selection['max_revenue'] is not None:
+            mask &= fact_table['REVENUE'] <= selection['max_revenue']
+
+        for column, max_score in [('USER_SCORE_CATEGORY', selection['max_user_score']), ('CRITIC_SCORE_CATEGORY', selection['max_critic_score'])]:
+            if get_score_list(max_score) is not None:
+                mask &= fact_table[column].isin(get_score_list(max_score))
+
+        return mask.to_numpy()
+
+    def test_all_selected(self):
+        selection = {'year_ids': list(self.tables[DIM_YEARS_KEY]['YEAR_ID']), 'genres': None, 'min_revenue': 0.0, 'max_revenue': None, 'max_user_score': SCORE_OPTIONS[-1], 'max_critic_score': SCORE_OPTIONS[-1]}
+        masks = self.engine.get_masks(selection)
+
+        self.assertTrue(masks[FACT_TABLE_KEY].all(), "Every film should be selected without filters")
+        self.assertTrue(masks[BRIDGE_GENRES_KEY].all(), "Every bridge row should be selected without filters")
+
+    def test_same_rows_as_sql_filters(self):
+        selection = TEST_SELECTION
+        masks = self.engine.get_masks(selection)
+
+        self.assertTrue((masks[FACT_TABLE_KEY] == self.get_expected_fact_mask(selection)).all(), "The fact mask should select the same films as the SQL filters")
+        self.assertTrue((masks[DIM_YEARS_KEY] == self.tables[DIM_YEARS_KEY]['YEAR_ID'].isin(selection['year_ids']).to_numpy()).all(), "The year mask should select the checked years")
+
+    def test_bitmap_index_saved(self):
+        selection = {'year_ids': [1, 2, 5], 'genres': ['COMEDY'], 'min_revenue': 0.0, 'max_revenue': 100.0, 'max_user_score': 'MIXED', 'max_critic_score': SCORE_OPTIONS[-1]}
+        bitmap_index = BitmapIndex.from_arrow(*self.engine.bitmap_index.to_arrow())
+        masks = FilterEngine(self.tables, bitmap_index).get_masks(selection)
+
+        self.assertTrue((masks[FACT_TABLE_KEY] == self.get_expected_fact_mask(selection)).all(), "The saved bitmap index should select the same films")
+
+    def test_no_genre_selected(self):
+        selection = {'year_ids': [0, 1], 'genres': [], 'min_revenue': 0.0, 'max_revenue': None, 'max_user_score': SCORE_OPTIONS[-1], 'max_critic_score': SCORE_OPTIONS[-1]}
+        masks = self.engine.get_masks(selection)
+
+        self.assertFalse(masks[FACT_TABLE_KEY].any(), "No film should be selected without genres")
+
+class TestPsqlFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+
+    def test_fact_conditions(self):
+        conditions, params = get_fact_table_conditions('imdb_dwh', 20.0, 300.0, [0, 3], ['ACTION', 'DRAMA'], 'POSITIVE', None)
+
+        self.assertEqual(params, [20.0, 300.0, [0, 3], SCORE_OPTIONS[:5], ['ACTION', 'DRAMA']], "The values of the filters should be sent as parameters in order")
+        self.assertEqual(conditions[:3], ["f.revenue BETWEEN $1 AND $2", "f.year_id = ANY($3)", "f.user_score_category = ANY($4)"], "Each filter should use its own parameter")
+        self.assertEqual(len(conditions), 4, "A score without ceiling should add no condition")
+        self.assertTrue(conditions[3].startswith("EXISTS (SELECT 1 FROM imdb_dwh.bridge_genres b JOIN imdb_dwh.dim_genres g ON g.genre_id = b.genre_id"), "The genres should be a semi-join of the bridge")
+        self.assertIn("b.bridge_genre_id = f.bridge_genre_id AND g.genre_name = ANY($5)", conditions[3], "The semi-join should match the bridge of the film and the last parameter")
+
+        conditions, params = get_fact_table_conditions('imdb_dwh', genre_name_list=['COMEDY'], alias='')
+        self.assertEqual(params, [0.0, ['COMEDY']], "Only the revenue and the genres should be sent")
+        self.assertIn("b.bridge_genre_id = bridge_genre_id AND g.genre_name = ANY($2)", conditions[1], "The semi-join should follow the alias of the fact table")
+
+    @patch('utilities_snapshot.get_session_snapshot')
+    def test_bridge_mask_same_as_engine(self, get_session_snapshot):
+        get_session_snapshot.return_value = WarehouseSnapshot('account', 'database', 'schema', 'default', self.tables, {})
+        dim_genres = self.tables[DIM_GENRES_KEY]
+
+        for genres in [TEST_SELECTION['genres'], None, []]:
+            selection = {**TEST_SELECTION, 'genres': genres}
+            filtered_genres = dim_genres if genres is None else dim_genres[dim_genres['GENRE_NAME'].isin(genres)]
+
+            np.testing.assert_array_equal(get_bridge_genres_mask(filtered_genres), FilterEngine(self.tables).get_masks(selection)[BRIDGE_GENRES_KEY])
+
+class TestIndexUsageCheck(unittest.TestCase):
+
+    def get_conn(self, plan: dict):
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value.fetchone.return_value = [[{'Plan': plan}]]
+
+        return conn
+
+    def test_values_of_loaded_tables(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchone.side_effect = [(7,), ('WESTERN',), ([120.5, 131.0],)]
+
+        values = get_filter_check_values(conn, 'imdb_dwh_staging')
+        check_queries = get_filter_check_queries('imdb_dwh_staging', values)
+
+        self.assertEqual(values, {'year_ids': [7], 'genres': ['WESTERN'], 'revenue_range': [120.5, 131.0]}, "The probes should use the least frequent values of the loaded tables")
+        self.assertEqual(check_queries['dim_genres by GENRE_NAME'][1][1], [['WESTERN']])
+        self.assertEqual(check_queries['fact_table by all filters'][1][1][:3], [120.5, 131.0, [7]], "The fact probe should use the revenue band and the rarest year")
+        self.assertNotIn('bridge_genres by GENRE_ID', check_queries, "The bridge is only read inside the semi-join of the fact query")
+
+    @patch('utilities_data.get_filter_check_values', return_value={'year_ids': [0], 'genres': ['WESTERN'], 'revenue_range': [500.0, 510.0]})
+    @patch('utilities_data.prepared_statements')
+    def test_index_used(self, mock_prepared_statements, mock_check_values):
+        plan = {'Node Type': 'Bitmap Heap Scan', 'Plans': [{'Node Type': 'Bitmap Index Scan', 'Index Name': 'idx_fact_table_revenue'}]}
+        index_usage, unindexed_filters = check_local_index_usage(self.get_conn(plan), 'imdb_dwh', {table_name: 10**6 for table_name in DWH_TABLE_NAMES})
+
+        self.assertEqual(index_usage['fact_table by revenue'], ['idx_fact_table_revenue'])
+        self.assertEqual(unindexed_filters, [])
+
+    @patch('utilities_data.get_filter_check_values', return_value={'year_ids': [0], 'genres': ['WESTERN'], 'revenue_range': [500.0, 510.0]})
+    @patch('utilities_data.prepared_statements')
+    def test_seq_scan_of_big_table(self, mock_prepared_statements, mock_check_values):
+        plan = {'Node Type': 'Seq Scan', 'Relation Name': 'fact_table'}
+
+        self.assertEqual(check_local_index_usage(self.get_conn(plan), 'imdb_dwh', {table_name: 1000 for table_name in DWH_TABLE_NAMES})[1], [], "A small table may be scanned")
+
+        # A scan of a big table is only reported, the load is still published
+        with self.assertLogs(LOGGER_DATA_KEY, level='WARNING'):
+            index_usage, unindexed_filters = check_local_index_usage(self.get_conn(plan), 'imdb_dwh', {table_name: 10**6 for table_name in DWH_TABLE_NAMES})
+        self.assertEqual(len(unindexed_filters), len(index_usage), "Every probe scans the big table in this plan")
+
+class TestSnapshotBuild(unittest.TestCase):
+
+    def build_snapshot(self, row_count: int):
+        snow_data = {table_name: pd.DataFrame({'ID': [0]}) for table_name in DWH_TABLE_NAMES}
+
+        with patch('utilities_data.get_snow_table_stats', return_value={'row_counts': {table_name: row_count for table_name in DWH_TABLE_NAMES}}), \
+             patch('utilities_data.psql_connection'), patch('utilities_data.create_sync_tables'), patch('utilities_data.create_local_indexes'), \
+             patch('utilities_data.create_local_rollup_cube'), patch('utilities_data.get_local_table_versions', return_value={}), \
+             patch('utilities_data.reload_local_tables', return_value=snow_data), patch('utilities_data.WarehouseSnapshot'):
+            build_warehouse_snapshot(MagicMock(), 'account', 'database', 'schema', {})
+
+    @patch('utilities_data.rollback_local_schema')
+    def test_rollback_after_failed_build(self, mock_rollback_local_schema):
+        with self.assertRaises(AssertionError):
+            self.build_snapshot(2)
+
+        self.assertTrue(mock_rollback_local_schema.called, "A published load whose snapshot fails should be rolled back")
+
+    @patch('utilities_data.rollback_local_schema')
+    def test_no_rollback_after_build(self, mock_rollback_local_schema):
+        self.build_snapshot(1)
+
+        self.assertFalse(mock_rollback_local_schema.called, "A load whose snapshot is built should be kept")
+
+class TestSnapshotRegistry(unittest.TestCase):
+
+    def test_build_lock_per_key(self):
+        registry = SnapshotRegistry()
+        key, other_key = ('account', 'database', 'schema'), ('other_account', 'database', 'schema')
+
+        self.assertIs(registry.get_build_lock(key), registry.get_build_lock(key), "The logins of the same account should share one build lock")
+        self.assertIsNot(registry.get_build_lock(key), registry.get_build_lock(other_key), "Each account should be built under its own lock")
+
+    def test_get_while_building(self):
+        registry = SnapshotRegistry()
+        key = ('account', 'database', 'schema')
+        registry.set(WarehouseSnapshot(*key, 'version', {}, {}))
+
+        with registry.get_build_lock(('other_account', 'database', 'schema')):
+            self.assertEqual(registry.get(key).version, 'version', "A snapshot in memory should be read while another account is being built")
+
+class TestFilterResultCache(unittest.TestCase):
+
+    def test_signature_normalized(self):
+        selection = get_default_selection([3, 1, 2], 0, 100)
+        same_selection = get_default_selection([1, 2, 3, 3], 0.0, 100.0)
+        selection['genres'], same_selection['genres'] = ['DRAMA', 'ACTION'], ['ACTION', 'DRAMA']
+
+        self.assertEqual(get_filter_signature(selection), get_filter_signature(same_selection), "The order of the selected values should not change the signature")
+
+    def test_least_recently_used_evicted(self):
+        cache = FilterResultCache(max_bytes=2500)
+        cache.put('first', np.zeros(1000, dtype=np.uint8))
+        cache.put('second', np.zeros(1000, dtype=np.uint8))
+        cache.get('first')
+        cache.put('third', np.zeros(1000, dtype=np.uint8))
+
+        metrics = cache.get_metrics()
+        self.assertIsNone(cache.get('second'), "The least recently used result should be evicted")
+        self.assertIsNotNone(cache.get('first'), "A recently read result should be kept")
+        self.assertEqual(metrics['evictions'], 1, "Only one result should be evicted")
+        self.assertLessEqual(metrics['bytes'], 2500, "The cache should stay under its size")
+
+    def test_result_computed_once(self):
+        cache = FilterResultCache()
+        compute_calls = []
+        compute = lambda: compute_calls.append(1) or np.ones(10)
+
+        cache.get_or_compute('key', compute)
+        cache.get_or_compute('key', compute)
+
+        self.assertEqual(len(compute_calls), 1, "A cached result should not be computed again")
+        self.assertEqual(cache.get_metrics()['hits'], 1, "The second call should be a hit")
+
+class TestRollupCube(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+        self.cube = RollupCube.build(self.tables)
+
+    def test_same_year_state_data(self):
+        selection = {**TEST_SELECTION, 'min_revenue': 0.0, 'max_revenue': None}
+        masks = FilterEngine(self.tables).get_masks(selection)
+
+        avg_data, pie_counts = get_year_state_data(get_masked_table_reader(self.tables, masks))
+        cube_avg_data, cube_pie_counts = get_year_state_data_cube(self.cube, self.cube.get_cells(selection))
+
+        pd.testing.assert_frame_equal(avg_data.reset_index(drop=True), cube_avg_data)
+        for pie_count, cube_pie_count in zip(pie_counts, cube_pie_counts):
+            column = pie_count.columns[0]
+            pd.testing.assert_frame_equal(pie_count.sort_values(column).reset_index(drop=True), cube_pie_count.sort_values(column).reset_index(drop=True))
+
+    def test_split_cells_not_answered(self):
+        selection = get_default_selection(list(self.tables[DIM_YEARS_KEY]['YEAR_ID']), 20.0, 300.0)
+
+        self.assertIsNone(self.cube.get_cells(selection), "A revenue range that splits some cell should be answered from the fact table")
+
+class TestPsqlFetch(unittest.TestCase):
+
+    def test_column_types_from_schema(self):
+        column_types = get_psql_column_types(FACT_TABLE_KEY)
+
+        self.assertEqual(list(column_types), list(pd.read_csv(os.path.join('datasets', 'fact_table.csv'), nrows=1).columns), "The columns should follow the CREATE TABLE of the schema script")
+        self.assertEqual(str(column_types['YEAR_ID']), 'int32', "INT columns should be read as int32")
+
+    def test_typed_csv(self):
+        fact_table = pd.read_csv(os.path.join('datasets', 'fact_table.csv'))
+        df = read_psql_csv(io.BufferedReader(io.BytesIO(fact_table.to_csv(index=False, header=False).encode('utf-8'))), get_psql_column_types(FACT_TABLE_KEY))
+
+        self.assertEqual(str(df['FILM_RANK'].dtype), 'int32', "The ids should keep the type of the schema")
+        self.assertEqual(str(df['USER_SCORE_CATEGORY'].dtype), 'category', "The category columns should be categorical")
+        self.assertEqual(list(df['USER_SCORE_CATEGORY'].cat.categories), sorted(fact_table['USER_SCORE_CATEGORY'].unique()), "The categories should be sorted like the strings")
+        pd.testing.assert_frame_equal(df, fact_table, check_dtype=False, check_categorical=False)
+
+    def test_empty_result(self):
+        df = read_psql_csv(io.BufferedReader(io.BytesIO()), get_psql_column_types(DIM_GENRES_KEY))
+
+        self.assertEqual(len(df), 0, "An empty result should give an empty frame")
+        self.assertEqual(str(df['GENRE_ID'].dtype), 'int32', "An empty result should keep the types of the schema")
+
+    def test_selected_columns(self):
+        fact_table = pd.read_csv(os.path.join('datasets', 'fact_table.csv'))
+        columns = ['REVENUE', 'FILM_RANK', 'USER_SCORE_CATEGORY']
+        df = read_psql_csv(io.BufferedReader(io.BytesIO(fact_table.to_csv(index=False, header=False).encode('utf-8'))), get_psql_column_types(FACT_TABLE_KEY), columns)
+
+        self.assertEqual(list(df.columns), columns, "Only the requested columns should be kept, in the requested order")
+        pd.testing.assert_frame_equal(df, fact_table[columns], check_dtype=False, check_categorical=False)
+
+    def test_prepared_rows(self):
+        dim_genres = pd.read_csv(os.path.join('datasets', 'dim_genres.csv'))
+        df = read_psql_rows(list(dim_genres.itertuples(index=False, name=None)), get_psql_column_types(DIM_GENRES_KEY), ['GENRE_NAME', 'GENRE_ID'])
+
+        self.assertEqual(str(df['GENRE_ID'].dtype), 'int32', "The rows should take the types of the schema")
+        pd.testing.assert_frame_equal(df, dim_genres[['GENRE_NAME', 'GENRE_ID']], check_dtype=False)
+        self.assertEqual(len(read_psql_rows([], get_psql_column_types(DIM_GENRES_KEY))), 0, "No rows should give an empty frame")
+
+    def test_streamed_copy(self):
+        fact_table = pd.concat([pd.read_csv(os.path.join('datasets', 'fact_table.csv'))] * 20, ignore_index=True)
+        csv_bytes = fact_table.to_csv(index=False, header=False).encode('utf-8')
+        cursor = MagicMock()
+        cursor.mogrify.return_value = b"SELECT 1"
+
+        # Written in small pieces and larger than a pipe buffer, so the reader has to parse while the rows arrive
+        cursor.copy_expert.side_effect = lambda query, file: [file.write(csv_bytes[i:i + 4096]) for i in range(0, len(csv_bytes), 4096)]
+        df = fetch_psql_dataframe(cursor, "SELECT f.* FROM imdb_dwh.fact_table f", [], get_psql_column_types(FACT_TABLE_KEY), ['FILM_RANK', 'REVENUE'])
+
+        pd.testing.assert_frame_equal(df, fact_table[['FILM_RANK', 'REVENUE']], check_dtype=False)
+
+        cursor.copy_expert.side_effect = ValueError("query failed")
+        with self.assertRaises(ValueError):
+            fetch_psql_dataframe(cursor, "SELECT f.* FROM imdb_dwh.fact_table f", [], get_psql_column_types(FACT_TABLE_KEY))
+
+class TestYearStateQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.selection = {'year_ids': [1, 2], 'genres': ['ACTION', 'DRAMA'], 'min_revenue': 0.0, 'max_revenue': 1000.0, 'max_user_score': 'MIXED', 'max_critic_score': None}
+
+    def test_query_params(self):
+        query, params = get_year_state_query('imdb_dwh', self.selection)
+
+        self.assertEqual(params, [0.0, 1000.0, [1, 2], SCORE_OPTIONS[:4], ['ACTION', 'DRAMA']], "The values of the filters should be sent as parameters in order")
+        self.assertIn("f.revenue BETWEEN $1 AND $2", query, "The revenue range should use the first two parameters")
+        self.assertIn("g.genre_name = ANY($5)", query, "The genres should be the last parameter")
+        self.assertNotIn("critic_score_category = ANY", query, "A filter without values should add no condition")
+        self.assertIn("GROUPING(f.year_id, f.user_score_category, f.critic_score_category, f.user_votes_category, f.revenue_category)", query, "The rows should tell their grouping set")
+
+    @patch('utilities_data.prepared_statements')
+    def test_rows_to_frames(self, prepared_statements):
+        grouping_sets = get_grouping_sets(['YEAR_ID', 'USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY'])
+        rows = [
+            (2, 6.0, 50.0, 200.0, 300.0, 2001.0, None, None, None, None, 4, grouping_sets['YEAR_ID']),
+            (1, 7.0, 60.0, 100.0, 500.0, 2000.0, None, None, None, None, 6, grouping_sets['YEAR_ID']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, 'MIXED', None, None, None, 7, grouping_sets['USER_SCORE_CATEGORY']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, None, None, None, None, 3, grouping_sets['USER_SCORE_CATEGORY']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, None, 'POSITIVE', None, None, 10, grouping_sets['CRITIC_SCORE_CATEGORY']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, None, None, 'HIGH', None, 5, grouping_sets['USER_VOTES_CATEGORY']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, None, None, 'LOW', None, 5, grouping_sets['USER_VOTES_CATEGORY']),
+            (None, 6.5, 55.0, 140.0, 420.0, 2000.4, None, None, None, 'LOW', 10, grouping_sets['REVENUE_CATEGORY'])
+        ]
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value.fetchall.return_value = rows
+
+        avg_data, (user_score_count, critic_score_count, user_votes_count, revenue_count) = get_year_state_data_psql(conn, self.selection)
+
+        prepared_statements.execute.assert_called_once()
+        self.assertEqual(list(avg_data['YEAR_ID']), [1, 2], "The years should be sorted by id")
+        self.assertEqual(list(avg_data.columns), ['YEAR_ID', 'USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES', 'YEAR'], "The means should have the columns of the pandas path")
+        self.assertEqual(list(user_score_count['COUNT']), [7, 3], "The films without a category should be kept as their own row")
+        self.assertEqual(list(critic_score_count['CRITIC_SCORE_CATEGORY']), ['POSITIVE'], "Each frame should only have the rows of its grouping set")
+        self.assertEqual(list(user_votes_count['USER_VOTES_CATEGORY']), ['HIGH', 'LOW'], "Ties should be sorted by name")
+        self.assertEqual(revenue_count['COUNT'].sum(), 10, "The counts should come from the rows of the set")
+
+    @patch('utilities_data.get_local_table_versions')
+    def test_local_db_version(self, get_local_table_versions):
+        snow_versions = {table_name: (datetime(2024, 1, 1, 12, tzinfo=timezone.utc), 10) for table_name in DWH_TABLE_NAMES}
+        snapshot = WarehouseSnapshot('account', 'database', 'schema', get_data_version(snow_versions), {}, {})
+
+        get_local_table_versions.return_value = {table_name: (datetime(2024, 1, 1, 14, tzinfo=timezone(timedelta(hours=2))), 10) for table_name in DWH_TABLE_NAMES}
+        self.assertTrue(is_local_db_current(MagicMock(), snapshot), "The same instant in another time zone should be the same version")
+
+        get_local_table_versions.return_value = {**snow_versions, FACT_TABLE_KEY: (snow_versions[FACT_TABLE_KEY][0], 11)}
+        self.assertFalse(is_local_db_current(MagicMock(), snapshot), "A newer sync of the local db should not answer for the snapshot")
+
+        get_local_table_versions.return_value = {}
+        self.assertFalse(is_local_db_current(MagicMock(), snapshot), "A local db never synced should not answer for the snapshot")
+
+class TestCompactStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+        self.compact_tables = get_dataset_tables(compact=True)
+
+    def test_compact_types(self):
+        fact_table = self.compact_tables[FACT_TABLE_KEY]
+
+        self.assertEqual(str(fact_table['FILM_RANK'].dtype), 'int16', "The ids should use the smallest int type that fits them")
+        self.assertEqual(str(fact_table['USER_VOTES'].dtype), 'int32', "The votes do not fit in int16")
+        self.assertEqual(str(fact_table['REVENUE'].dtype), 'float64', "The revenue is not the same in float32, so it should keep its type")
+        self.assertEqual(str(fact_table['USER_SCORE_CATEGORY'].cat.codes.dtype), 'int8', "The category columns should be stored as int8 codes")
+        self.assertTrue(set(SCORE_OPTIONS) <= set(fact_table['CRITIC_SCORE_CATEGORY'].cat.categories), "Every score option should be a category")
+        self.assertIs(get_compact_table(fact_table), fact_table, "A compact table should not be copied again")
+
+        for table_name in DWH_TABLE_NAMES:
+            self.assertLess(get_table_memory(self.compact_tables[table_name]), get_table_memory(self.tables[table_name]), f"The table {table_name} should use less memory")
+
+    def test_same_chart_data(self):
+        selection = TEST_SELECTION
+        snapshot = WarehouseSnapshot('account', 'database', 'schema', 'default', self.tables, {})
+        compact_snapshot = WarehouseSnapshot('account', 'database', 'schema', 'compact', self.compact_tables, {})
+
+        masks = snapshot.filter_engine.get_masks(selection)
+        compact_masks = compact_snapshot.filter_engine.get_masks(selection)
+
+        for table_name in masks:
+            np.testing.assert_array_equal(compact_masks[table_name], masks[table_name])
+
+        avg_data, pie_counts = get_year_state_data(get_masked_table_reader(self.tables, masks))
+        compact_avg_data, compact_pie_counts = get_year_state_data(get_masked_table_reader(self.compact_tables, masks))
+
+        pd.testing.assert_frame_equal(compact_avg_data, avg_data, check_dtype=False)
+        for compact_pie_count, pie_count in zip(compact_pie_counts, pie_counts):
+            pd.testing.assert_frame_equal(compact_pie_count.reset_index(drop=True).astype({pie_count.columns[0]: object}), pie_count.reset_index(drop=True))
+
+        top_metrics = get_top_metrics_data(snapshot, masks)
+        for name, compact_data in get_top_metrics_data(compact_snapshot, compact_masks).items():
+            pd.testing.assert_frame_equal(compact_data, top_metrics[name], check_dtype=False, check_categorical=False)
+
+class TestFilterDeltaEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables(compact=True)
+        self.filter_engine = FilterEngine(self.tables)
+        self.delta_engine = FilterDeltaEngine.build(self.tables)
+        self.selection = get_default_selection(list(self.tables[DIM_YEARS_KEY]['YEAR_ID']), 10.0, 500.0)
+
+    def assert_same_year_state_data(self, aggregates, selection: dict):
+        masks = self.filter_engine.get_masks(selection)
+        avg_data, pie_counts = get_year_state_data(get_masked_table_reader(self.tables, masks))
+        delta_avg_data, delta_pie_counts = get_year_state_data_delta(self.delta_engine, aggregates)
+
+        pd.testing.assert_frame_equal(delta_avg_data, avg_data.reset_index(drop=True), check_dtype=False, rtol=1e-9)
+        for delta_pie_count, pie_count in zip(delta_pie_counts, pie_counts):
+            pd.testing.assert_frame_equal(delta_pie_count, pie_count.reset_index(drop=True).astype({pie_count.columns[0]: object}), check_dtype=False)
+
+    @patch('utilities_delta.DELTA_MAX_ROWS_FRACTION', 1.0)
+    def test_toggles_same_as_recompute(self):
+        genres = list(self.tables[DIM_GENRES_KEY]['GENRE_NAME'])
+        toggles = [
+            {'year_ids': [0, 1, 2, 4, 5, 6, 7, 8, 9, 10]},
+            {'genres': [genre for genre in genres if genre != 'DRAMA']},
+            {'genres': [genre for genre in genres if genre not in ['DRAMA', 'ACTION']]},
+            {'max_user_score': 'MIXED'},
+            {'year_ids': [0, 1, 2, 4, 5, 6, 7, 8], 'max_critic_score': 'POSITIVE'},
+            {'genres': None},
+            {'max_user_score': SCORE_OPTIONS[-1]}
+        ]
+
+        selection = self.selection
+        aggregates = self.delta_engine.get_full_aggregates(selection)
+
+        for toggle in toggles:
+            selection = {**selection, **toggle}
+            delta_aggregates = self.delta_engine.get_delta_aggregates(aggregates, selection)
+
+            self.assertIsNotNone(delta_aggregates, "A toggle of a year, genre or score should be applied as a delta")
+            self.assert_same_year_state_data(delta_aggregates, selection)
+            aggregates = delta_aggregates
+
+    def test_revenue_change_recomputed(self):
+        aggregates = self.delta_engine.get_full_aggregates(self.selection)
+        selection = {**self.selection, 'min_revenue': 50.0}
+
+        self.assertIsNone(self.delta_engine.get_delta_aggregates(aggregates, selection), "A new revenue range should not be applied as a delta")
+        self.assert_same_year_state_data(self.delta_engine.get_aggregates(selection, aggregates), selection)
+        self.assert_same_year_state_data(aggregates, self.selection)
+
+    def test_large_toggle_recomputed(self):
+        aggregates = self.delta_engine.get_full_aggregates(self.selection)
+        selection = {**self.selection, 'year_ids': [0]}
+
+        self.assertIsNone(self.delta_engine.get_delta_aggregates(aggregates, selection), "A toggle that reads most of the films should be recomputed")
+        self.assert_same_year_state_data(self.delta_engine.get_aggregates(selection, aggregates), selection)
+
+    def test_routed_to_cube_or_delta(self):
+        snapshot = WarehouseSnapshot('account', 'database', 'schema', 'default', self.tables, {})
+        get_aggregates = MagicMock(side_effect=self.delta_engine.get_full_aggregates)
+
+        whole_cells = {**self.selection, 'min_revenue': 0.0, 'max_revenue': None}
+        get_routed_year_state_data(snapshot, whole_cells, None, get_aggregates)
+        get_aggregates.assert_not_called()
+
+        avg_data, pie_counts = get_routed_year_state_data(snapshot, self.selection, None, get_aggregates)
+        get_aggregates.assert_called_once_with(self.selection)
+        pd.testing.assert_frame_equal(avg_data, get_year_state_data_delta(self.delta_engine, self.delta_engine.get_full_aggregates(self.selection))[0])
+
+class TestTopEntities(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+        selection = TEST_SELECTION
+        masks = FilterEngine(self.tables).get_masks(selection)
+        self.get_table = get_masked_table_reader(self.tables, masks)
+
+    def assert_same_top(self, top: pd.DataFrame, merged: pd.DataFrame, name_column: str, n: int, metric: str):
+        average_data = merged[['REVENUE', name_column, 'USER_SCORE']].groupby(name_column).mean()
+
+        # The old path sorted with the default quicksort, so tied means came in no fixed order, the engine orders them by name on purpose
+        expected = average_data.sort_values(by=[metric], ascending=False).head(n)
+        np.testing.assert_allclose(top[metric], expected[metric], rtol=1e-12)
+        np.testing.assert_allclose(top[['REVENUE', 'USER_SCORE']], average_data.loc[top[name_column], ['REVENUE', 'USER_SCORE']], rtol=1e-12)
+
+        # Only the names tied with the last mean may differ from the old path
+        above_last = expected.index[~np.isclose(expected[metric], expected[metric].iloc[-1], rtol=1e-12)]
+        self.assertTrue(set(above_last) <= set(top[name_column]), "Every name above the last mean should be in the top")
+
+        names, means = top[name_column].to_numpy(), top[metric].to_numpy()
+        ties = np.isclose(means[1:], means[:-1], rtol=1e-12)
+        self.assertTrue((names[1:][ties] > names[:-1][ties]).all(), "Tied means should be ordered by name")
+
+    def test_same_top_as_merges(self):
+        fact_table = self.get_table(FACT_TABLE_KEY)
+
+        merged_directors = fact_table.merge(self.get_table(DIM_DIRECTORS_KEY), on='DIRECTOR_ID')
+        merged_genres = fact_table.merge(self.get_table(BRIDGE_GENRES_KEY), on='FILM_RANK').merge(self.get_table(DIM_GENRES_KEY), on='GENRE_ID')
+        merged_actors = fact_table.merge(self.get_table(BRIDGE_ACTORS_KEY), on='FILM_RANK').merge(self.get_table(DIM_ACTORS_KEY), on='ACTOR_ID')
+
+        self.assert_same_top(get_top_directors(self.get_table(DIM_DIRECTORS_KEY), fact_table), merged_directors, 'DIRECTOR_NAME', 15, 'REVENUE')
+        self.assert_same_top(get_top_genres(self.get_table(DIM_GENRES_KEY), self.get_table(BRIDGE_GENRES_KEY), fact_table), merged_genres, 'GENRE_NAME', 5, 'REVENUE')
+        self.assert_same_top(get_top_actors(self.get_table(DIM_ACTORS_KEY), self.get_table(BRIDGE_ACTORS_KEY), fact_table), merged_actors, 'ACTOR_NAME', 15, 'REVENUE')
+
+    def test_top_by_user_score(self):
+        fact_table = self.get_table(FACT_TABLE_KEY)
+        merged_actors = fact_table.merge(self.get_table(BRIDGE_ACTORS_KEY), on='FILM_RANK').merge(self.get_table(DIM_ACTORS_KEY), on='ACTOR_ID')
+
+        top_actors = get_top_actors(self.get_table(DIM_ACTORS_KEY), self.get_table(BRIDGE_ACTORS_KEY), fact_table, n=7, metric='USER_SCORE')
+
+        self.assert_same_top(top_actors, merged_actors, 'ACTOR_NAME', 7, 'USER_SCORE')
+
+class TestFilmView(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = get_dataset_tables()
+        self.film_view = FilmView.build(self.tables)
+
+    def get_expected_rows(self, masks: dict):
+        get_table = get_masked_table_reader(self.tables, masks)
+
+        merged = get_table(FACT_TABLE_KEY).copy()
+        merged['AVERAGE_SCORE'] = merged[['USER_SCORE', 'CRITIC_SCORE']].mean(axis=1)
+        merged = merged.merge(get_table(DIM_YEARS_KEY), on='YEAR_ID').merge(get_table(DIM_DIRECTORS_KEY), on='DIRECTOR_ID')
+        merged = merged.merge(get_table(BRIDGE_GENRES_KEY), on='FILM_RANK').merge(get_table(DIM_GENRES_KEY), on='GENRE_ID')
+        merged = merged.merge(get_table(BRIDGE_ACTORS_KEY), on='FILM_RANK').merge(get_table(DIM_ACTORS_KEY), on='ACTOR_ID')
+
+        return merged[['REVENUE', 'YEAR', 'AVERAGE_SCORE', 'DIRECTOR_NAME', 'GENRE_NAME', 'ACTOR_NAME']]
+
+    def get_expected_bubbles(self, masks: dict, top_names: dict):
+        merged = self.get_expected_rows(masks)
+        columns = ['REVENUE', 'YEAR', 'AVERAGE_SCORE']
+
+        bubble_genres = merged[columns + ['GENRE_NAME']]
+        bubble_genres = bubble_genres[bubble_genres['GENRE_NAME'].isin(top_names['GENRE_NAME'])].drop_duplicates()
+        bubble_directors = merged[columns + ['DIRECTOR_NAME']]
+        bubble_actors = merged[columns + ['ACTOR_NAME']]
+
+        return bubble_directors[bubble_directors['DIRECTOR_NAME'].isin(top_names['DIRECTOR_NAME'])], bubble_genres, bubble_actors[bubble_actors['ACTOR_NAME'].isin(top_names['ACTOR_NAME'])]
+
+    def get_bubbles(self, masks: dict, top_names: dict):
+        bubble_layout = get_bubble_layout(self.film_view, masks)
+
+        return (get_bubble_directors(self.film_view, bubble_layout, top_names['DIRECTOR_NAME']), get_bubble_genres(self.film_view, bubble_layout, top_names['GENRE_NAME']),
+                get_bubble_actors(self.film_view, bubble_layout, top_names['ACTOR_NAME']))
+
+    def get_top_names(self, masks: dict):
+        get_table = get_masked_table_reader(self.tables, masks)
+        fact_table = get_table(FACT_TABLE_KEY)
+
+        return {
+            'DIRECTOR_NAME': list(get_top_directors(get_table(DIM_DIRECTORS_KEY), fact_table)['DIRECTOR_NAME']),
+            'GENRE_NAME': list(get_top_genres(get_table(DIM_GENRES_KEY), get_table(BRIDGE_GENRES_KEY), fact_table)['GENRE_NAME']),
+            'ACTOR_NAME': list(get_top_actors(get_table(DIM_ACTORS_KEY), get_table(BRIDGE_ACTORS_KEY), fact_table)['ACTOR_NAME'])
+        }
+
+    def test_same_bubbles_as_merges(self):
+        selection = TEST_SELECTION
+
+        for masks in [{}, FilterEngine(self.tables).get_masks(selection)]:
+            top_names = self.get_top_names(masks)
+
+            for bubbles, expected_bubbles in zip(self.get_bubbles(masks, top_names), self.get_expected_bubbles(masks, top_names)):
+                pd.testing.assert_frame_equal(bubbles, expected_bubbles)
+
+    def test_lower_peak_memory(self):
+        top_names = self.get_top_names({})
+        peaks = []
+
+        for get_bubbles in [self.get_expected_bubbles, self.get_bubbles]:
+            tracemalloc.start()
+            get_bubbles({}, top_names)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        self.assertLess(peaks[1], peaks[0], "The bubble builders should not build the genre x actor pairing of every film")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                        UTILITIES AGGREGATES
+#   Grouped aggregations over the integer id columns of the snapshot,
+#   used by the charts instead of merging and grouping by the names.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+from utilities_filters import get_positions
+from global_parameters import *
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_bridge_rows(bridge_table: pd.DataFrame, fact_table: pd.DataFrame, id_column: str, value_columns: list):
+
+    # One row per bridge row whose film is in the fact table, like the inner merge on FILM_RANK
+    fact_positions = get_positions(bridge_table['FILM_RANK'], fact_table['FILM_RANK'])
+    found = fact_positions < len(fact_table)
+
+    entity_ids = bridge_table[id_column].to_numpy()[found]
+    values = {column: fact_table[column].to_numpy()[fact_positions[found]] for column in value_columns}
+
+    return entity_ids, values
+
+def get_top_codes(means, n: int):
+
+    if n >= len(means):
+        candidates = np.arange(len(means))
+    else:
+        # Only the groups tied with the n-th best one or above it are sorted
+        kth_mean = means[np.argpartition(means, len(means) - n)[len(means) - n]]
+        candidates = np.flatnonzero(means >= kth_mean)
+
+    # Ties keep the order of the names, as a stable sort of the grouped names would
+    return candidates[np.lexsort((candidates, -means[candidates]))][:n]
+
+# -----------------------------------------------------------------------
+#                            TOP N ENGINE
+# -----------------------------------------------------------------------
+
+def get_top_entities(entity_ids, values: dict, dim_table: pd.DataFrame, id_column: str, name_column: str, n: int, metric: str = 'REVENUE'):
+
+    # The entities are grouped by name, so ids with the same name are one group like in a groupby of the names
+    name_codes, names = pd.factorize(dim_table[name_column], sort=True)
+    name_codes = np.append(name_codes, -1)[get_positions(entity_ids, dim_table[id_column])]
+
+    found = name_codes >= 0
+    name_codes = name_codes[found]
+
+    counts = np.bincount(name_codes, minlength=len(names))
+    observed = np.flatnonzero(counts > 0)
+
+    means = {column: np.bincount(name_codes, weights=column_values[found], minlength=len(names))[observed] / counts[observed] for column, column_values in values.items()}
+    top_codes = get_top_codes(means[metric], n)
+
+    # Only the names of the winners are read, and the index is the one of the grouped names
+    top_entities = pd.DataFrame({'REVENUE': means['REVENUE'][top_codes], name_column: np.asarray(names)[observed[top_codes]], 'USER_SCORE': means['USER_SCORE'][top_codes]}, index=top_codes)
+
+    return top_entities
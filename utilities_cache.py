@@ -0,0 +1,116 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                           UTILITIES CACHE
+#   Cache of the filter results (masks and chart data) shared by all the
+#   sessions of the app, keyed by the snapshot and the selected filters.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import sys
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+import pandas as pd
+import streamlit as st
+import logging as log
+from global_parameters import *
+
+logger_cache = log.getLogger(LOGGER_CACHE_KEY)
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_object_size(value):
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(get_object_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_object_size(item) for item in value)
+
+    return sys.getsizeof(value)
+
+def get_filter_signature(selection: dict):
+
+    # Same signature for the same filters, whatever the order in which the values were selected
+    genres = None if selection['genres'] is None else tuple(sorted(set(selection['genres'])))
+    max_revenue = None if selection['max_revenue'] is None else float(selection['max_revenue'])
+    max_user_score = selection['max_user_score'] if selection['max_user_score'] in SCORE_OPTIONS else None
+    max_critic_score = selection['max_critic_score'] if selection['max_critic_score'] in SCORE_OPTIONS else None
+
+    return (tuple(sorted(set(int(year_id) for year_id in selection['year_ids']))), genres, float(selection['min_revenue']), max_revenue, max_user_score, max_critic_score)
+
+# -----------------------------------------------------------------------
+#                          FILTER RESULT CACHE
+# -----------------------------------------------------------------------
+
+class FilterResultCache:
+
+    # Least recently used results are evicted once the cache goes over its size, the values must never be modified
+    def __init__(self, max_bytes: int = FILTER_CACHE_MAX_MB * 2**20):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key: tuple):
+        with self.lock:
+            if key not in self.entries:
+                self.metrics['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.metrics['hits'] += 1
+
+            return self.entries[key][0]
+
+    def put(self, key: tuple, value):
+
+        size = get_object_size(value)
+
+        # A result bigger than the whole cache would evict everything else, so it is not kept
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.metrics['evictions'] += 1
+
+    def get_or_compute(self, key: tuple, compute):
+
+        # Two sessions may compute the same result at the same time, the second one just replaces the first
+        value = self.get(key)
+
+        if value is None:
+            value = compute()
+            self.put(key, value)
+
+        return value
+
+    def get_metrics(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, **self.metrics}
+
+    def log_metrics(self):
+        metrics = self.get_metrics()
+        logger_cache.info(f"[INFO] Filter cache: {metrics['entries']} results in {metrics['bytes'] / 2**20:.2f} MB, "
+                          f"{metrics['hits']} hits, {metrics['misses']} misses and {metrics['evictions']} evictions")
+
+@st.cache_resource(show_spinner=False)
+def get_filter_result_cache():
+    return FilterResultCache()
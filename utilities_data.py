@@ -7,19 +7,43 @@
 # ///////////////////////////////////////////////////////////////////////
 
 import psycopg2 as psy
-import psycopg2.extras as extras
 import snowflake.connector
 from snowflake.connector import SnowflakeConnection
 from psycopg2.extensions import register_adapter, AsIs
-from utilities_db_connections import validate_select_privileges, create_snow_connection, close_snow_connection, create_psql_connection, close_psql_connection, raise_psql_error, raise_unknown_error
+from utilities_db_connections import validate_select_privileges, create_snow_connection, release_snow_connection, get_psql_connection, release_psql_connection, psql_connection, get_psql_pool, raise_psql_error, raise_unknown_error
+from utilities_snapshot import WarehouseSnapshot, get_data_version, get_snapshot_registry, read_snapshot_files, write_snapshot_files, set_session_snapshot, get_masked_table, get_snapshot_result, get_session_table, get_session_snapshot, get_session_selection, get_session_aggregates, set_session_aggregates
+from utilities_filters import get_default_selection
+from utilities_rollup import RollupCube
+from utilities_aggregates import get_top_entities, get_bridge_rows
+from utilities_star import FilmView, get_ranges
+from utilities_store import get_compact_table, get_table_memory
+from utilities_delta import FilterDeltaEngine, FilterAggregates
+from utilities_cache import get_filter_signature, get_filter_result_cache
 from global_parameters import *
 import pandas as pd
 import streamlit as st
 import numpy as np
 import logging as log
+import json
+import io
+import os
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Thread, Lock
+from functools import cache
+from weakref import WeakKeyDictionary
+import hashlib
+from queue import Queue
+import time
+import re
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 logger_data = log.getLogger(LOGGER_DATA_KEY)
 
+# Arrow type of each PostgreSQL type of the schema script
+PSQL_ARROW_TYPES = {'INT': pa.int32(), 'BIGINT': pa.int64(), 'FLOAT': pa.float64(), 'VARCHAR': pa.string(), 'TIMESTAMPTZ': pa.timestamp('us', tz='UTC')}
+
 # -----------------------------------------------------------------------
 #                       ADAPTERS FOR NUMPY TYPES
 #       Necessary to insert Pandas Dataframes into PostgreSQL
@@ -71,18 +95,98 @@ def list_to_wherein(column: str, data: list, is_int=False):
 #               QUERY FUNCTIONS (Snowflake connection needed)
 # -----------------------------------------------------------------------
 
-def get_max_revenue(conn: SnowflakeConnection):
+def get_snow_table_stats(conn: SnowflakeConnection):
+
+    # Every statistic of the warehouse is computed in one pass over the fact table, with the other row counts as subqueries
+    row_count_columns = [f"(SELECT COUNT(*) FROM IMDB_DWH.{table_name})" for table_name in DWH_TABLE_NAMES if table_name != FACT_TABLE_KEY] + ["COUNT(*)"]
+    range_columns = [f"MIN({column}), MAX({column})" for column in STATS_RANGE_COLUMNS]
+    category_columns = [f"ARRAY_AGG(DISTINCT {column}) WITHIN GROUP (ORDER BY {column})" for column in STATS_CATEGORY_COLUMNS]
 
-    query = f"SELECT MAX(revenue) FROM IMDB_DWH.fact_table"
+    query = f"SELECT {', '.join(row_count_columns + range_columns + category_columns)} FROM IMDB_DWH.fact_table"
 
     cursor = conn.cursor()
     cursor.execute(query)
-    max_revenue = float(cursor.fetchone()[0])
+    row = list(cursor.fetchone())
     cursor.close()
 
-    return max_revenue
+    stats = {'row_counts': {}, 'ranges': {}, 'categories': {}}
+
+    for table_name in [table_name for table_name in DWH_TABLE_NAMES if table_name != FACT_TABLE_KEY] + [FACT_TABLE_KEY]:
+        stats['row_counts'][table_name] = int(row.pop(0))
+
+    for column in STATS_RANGE_COLUMNS:
+        min_value, max_value = row.pop(0), row.pop(0)
+        stats['ranges'][column] = [None if min_value is None else float(min_value), None if max_value is None else float(max_value)]
+
+    # Snowflake returns the arrays as JSON strings
+    for column in STATS_CATEGORY_COLUMNS:
+        stats['categories'][column] = json.loads(row.pop(0))
+
+    logger_data.info(f"[SUCCESS] Statistics of the warehouse retrieved: {sum(stats['row_counts'].values())} rows in {len(DWH_TABLE_NAMES)} tables")
+
+    return stats
+
+def get_snow_buffer_dtype(dtype):
+
+    # Snowflake sends NUMBER columns with the smallest int type that fits each batch, so the buffers use the widest one
+    if dtype.kind in 'iu':
+        return np.int64
+    elif dtype.kind == 'f':
+        return np.float64
+    elif dtype.kind == 'b':
+        return np.bool_
+    else:
+        return object
+
+def fetch_snow_batches(cursor, batch_size: int = SNOW_ARROW_BATCH_SIZE):
+
+    for arrow_table in cursor.fetch_arrow_batches():
+        for record_batch in arrow_table.to_batches(max_chunksize=batch_size):
+            yield record_batch.to_pandas()
+
+def fetch_snow_dataframe(cursor, batch_consumer=None, batch_size: int = SNOW_ARROW_BATCH_SIZE):
+
+    columns = [column[0] for column in cursor.description]
+    total_rows = cursor.rowcount
+
+    if total_rows is None or total_rows < 0:
+        batches = []
+        for batch in fetch_snow_batches(cursor, batch_size):
+            if batch_consumer is not None:
+                batch_consumer(batch)
+            batches.append(batch)
+
+        if len(batches) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(batches, ignore_index=True)
 
-def get_filtered_dimensions_snow(conn: SnowflakeConnection, table_name: str, colum_to_filter: str = None, filter_list: list = None, is_int=False):
+    # The columns are preallocated with the row count of the result, so only one batch is held twice at any time
+    buffers = None
+    offset = 0
+
+    for batch in fetch_snow_batches(cursor, batch_size):
+        if batch_consumer is not None:
+            batch_consumer(batch)
+
+        if buffers is None:
+            buffers = {column: np.empty(total_rows, dtype=get_snow_buffer_dtype(batch[column].dtype)) for column in columns}
+
+        for column in columns:
+            values = batch[column].to_numpy()
+
+            # A later batch may bring the NULLs of an int column as float NaN, so the buffer is widened instead of casting them
+            if not np.can_cast(values.dtype, buffers[column].dtype, casting='same_kind'):
+                buffers[column] = buffers[column].astype(np.result_type(buffers[column].dtype, values.dtype))
+
+            buffers[column][offset:offset + len(batch)] = values
+        offset += len(batch)
+
+    if buffers is None:
+        return pd.DataFrame(columns=columns)
+
+    return pd.DataFrame(buffers, columns=columns, copy=False)
+
+def get_filtered_dimensions_snow(conn: SnowflakeConnection, table_name: str, colum_to_filter: str = None, filter_list: list = None, is_int=False, batch_consumer=None):
 
     query = f"SELECT * FROM IMDB_DWH.{table_name}"
 
@@ -91,14 +195,14 @@ def get_filtered_dimensions_snow(conn: SnowflakeConnection, table_name: str, col
   
     cursor = conn.cursor()
     cursor.execute(query)
-    df = cursor.fetch_pandas_all()
+    df = fetch_snow_dataframe(cursor, batch_consumer)
     cursor.close()
 
     logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the table {table_name}")
 
     return df
 
-def get_filtered_fact_table_snow(conn: SnowflakeConnection, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, bridge_genre_id_list: list = None, max_user_score: str = None, max_critic_score: str = None):
+def get_filtered_fact_table_snow(conn: SnowflakeConnection, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, bridge_genre_id_list: list = None, max_user_score: str = None, max_critic_score: str = None, batch_consumer=None):
     
     year_column = 'year_id'
     genre_column = 'bridge_genre_id'
@@ -110,7 +214,7 @@ def get_filtered_fact_table_snow(conn: SnowflakeConnection, min_revenue: float =
     query = f"SELECT * FROM IMDB_DWH.fact_table"
     
     if(max_revenue is None):
-        query = query + f" WHERE revenue BETWEEN {min_revenue} AND {get_max_revenue(conn)}"
+        query = query + f" WHERE revenue >= {min_revenue}"
     else:
         query = query + f" WHERE revenue BETWEEN {min_revenue} AND {max_revenue}"
 
@@ -125,62 +229,328 @@ def get_filtered_fact_table_snow(conn: SnowflakeConnection, min_revenue: float =
 
     cursor = conn.cursor()
     cursor.execute(query)
-    df = cursor.fetch_pandas_all()
+    df = fetch_snow_dataframe(cursor, batch_consumer)
     cursor.close()
 
     logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the fact table")
 
     return df
 
+def get_snow_table(conn: SnowflakeConnection, table_name: str, batch_consumer=None):
+
+    if table_name == FACT_TABLE_KEY:
+        df = get_filtered_fact_table_snow(conn, batch_consumer=batch_consumer)
+    else:
+        df = get_filtered_dimensions_snow(conn, table_name, batch_consumer=batch_consumer)
+
+    # The batches are saved into the local db as they come, only the table kept in memory is compacted
+    compact_df = get_compact_table(df)
+    logger_data.info(f"\t Table {table_name} kept in {get_table_memory(compact_df) / 2**20:.2f} MB instead of {get_table_memory(df) / 2**20:.2f} MB")
+
+    return compact_df
+
+def run_snow_tasks(conn: SnowflakeConnection, tasks: dict, stages: list = None, concurrent: bool = SNOW_CONCURRENT_DOWNLOAD, max_workers: int = SNOW_MAX_CONCURRENT_QUERIES):
+
+    results = {}
+
+    # The tasks of a stage only start when the previous stages have finished
+    if stages is None:
+        stages = [list(tasks)]
+
+    if not concurrent or max_workers <= 1:
+        for stage in stages:
+            for key in stage:
+                function, args, kwargs = tasks[key]
+                results[key] = function(conn, *args, **kwargs)
+
+        return results
+
+    # Each task opens its own cursor over the shared connection, so the queries wait on the warehouse at the same time
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snow_download') as executor:
+        for stage in stages:
+            futures = {executor.submit(tasks[key][0], conn, *tasks[key][1], **tasks[key][2]): key for key in stage}
+
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+    logger_data.info(f"[SUCCESS] {len(tasks)} queries downloaded from Snowflake with {max_workers} concurrent cursors")
+
+    return results
+
 # -----------------------------------------------------------------------
 #    LOCAL BD FUNCTIONS (Used to store and query data from PostgreSQL)
 # -----------------------------------------------------------------------
 
-def truncate_local_tables(conn, schema_name: str, table_names: list):
-    
-    cursor = conn.cursor()
+def get_schema_statements(statement_type: str, sql_path: str = SCHEMA_SQL_PATH):
 
-    try:
+    # The statements of one type (CREATE TABLE, CREATE INDEX...) of the schema script, without the psql commands and comments
+    with open(sql_path, 'r', encoding='utf-8') as file:
+        lines = [line.split('--')[0] for line in file.readlines()]
+
+    statements = [statement.strip() for statement in ''.join(lines).split(';')]
+
+    return [statement for statement in statements if statement.upper().startswith(statement_type)]
+
+@cache
+def get_psql_column_types(table_name: str, sql_path: str = SCHEMA_SQL_PATH):
+
+    # Arrow types of the columns of a table, in the order of its CREATE TABLE, so the results are never inferred
+    for statement in get_schema_statements('CREATE TABLE', sql_path):
+        if statement.split('(')[0].split()[-1].lower() == table_name.lower():
+            column_types = {}
+
+            for column, psql_type in re.findall(r'^\s*(\w+)\s+(INT|BIGINT|FLOAT|VARCHAR|TIMESTAMPTZ)\b', statement, re.MULTILINE):
+                column_types[column.upper()] = pa.dictionary(pa.int32(), pa.string()) if column.upper() in STATS_CATEGORY_COLUMNS else PSQL_ARROW_TYPES[psql_type]
+
+            return column_types
+
+    raise KeyError(f"The table {table_name} is not in the schema script {sql_path}")
+
+def create_staging_schema(conn, schema_name: str):
+
+    staging_schema = schema_name + STAGING_SCHEMA_SUFFIX
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {staging_schema} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {staging_schema}")
+        cursor.execute(f"SET LOCAL search_path TO {staging_schema}")
+
+        for statement in get_schema_statements('CREATE TABLE'):
+            cursor.execute(statement)
+
+    conn.commit()
+
+    return staging_schema
+
+def create_local_indexes(conn, schema_name: str):
+
+    start_time = time.perf_counter()
+
+    # Built after the bulk load, since keeping them updated row by row during the COPY is much slower
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET LOCAL search_path TO {schema_name}")
+
+        for statement in get_schema_statements('CREATE INDEX'):
+            cursor.execute(statement)
+
+    conn.commit()
+
+    logger_data.info(f"[SUCCESS] Indexes of the schema {schema_name} built in {time.perf_counter() - start_time:.2f}s")
+
+def create_local_rollup_cube(conn, schema_name: str):
+
+    start_time = time.perf_counter()
+
+    # The view is filled when it is created, and its unique index lets the syncs refresh it without blocking the readers
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET LOCAL search_path TO {schema_name}")
+
+        for statement in get_schema_statements('CREATE MATERIALIZED VIEW') + get_schema_statements('CREATE UNIQUE INDEX'):
+            cursor.execute(statement)
+
+    conn.commit()
+
+    logger_data.info(f"[SUCCESS] Rollup cube of the schema {schema_name} built in {time.perf_counter() - start_time:.2f}s")
+
+def refresh_local_rollup_cube(conn, schema_name: str):
+
+    start_time = time.perf_counter()
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {schema_name}.{ROLLUP_CUBE_VIEW}")
+
+    conn.commit()
+
+    logger_data.info(f"[SUCCESS] Rollup cube of the schema {schema_name} refreshed in {time.perf_counter() - start_time:.2f}s")
+
+def get_plan_scans(plan: dict):
+
+    index_names = []
+    seq_scans = []
+
+    if plan['Node Type'] == 'Seq Scan':
+        seq_scans.append(plan['Relation Name'])
+    elif 'Index Name' in plan:
+        index_names.append(plan['Index Name'])
+
+    for subplan in plan.get('Plans', []):
+        subplan_indexes, subplan_seq_scans = get_plan_scans(subplan)
+        index_names.extend(subplan_indexes)
+        seq_scans.extend(subplan_seq_scans)
+
+    return index_names, seq_scans
+
+def get_filter_check_values(conn, schema_name: str, revenue_band: float = INDEX_CHECK_REVENUE_BAND):
+
+    # The least frequent year and genre and a narrow band of revenues of the loaded tables, so the probes select few rows whatever the ids and units of the warehouse
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT year_id FROM {schema_name}.fact_table GROUP BY year_id ORDER BY COUNT(*), year_id LIMIT 1")
+        year_row = cursor.fetchone()
+
+        cursor.execute(f"""SELECT g.genre_name FROM {schema_name}.bridge_genres b JOIN {schema_name}.dim_genres g ON g.genre_id = b.genre_id
+                           GROUP BY g.genre_name ORDER BY COUNT(*), g.genre_name LIMIT 1""")
+        genre_row = cursor.fetchone()
+
+        cursor.execute(f"SELECT percentile_cont(ARRAY[%s, %s]::float8[]) WITHIN GROUP (ORDER BY revenue) FROM {schema_name}.fact_table", [0.5 - revenue_band / 2, 0.5 + revenue_band / 2])
+        revenue_range = cursor.fetchone()[0]
+
+    return {
+        'year_ids': [] if year_row is None else [year_row[0]],
+        'genres': [] if genre_row is None else [genre_row[0]],
+        'revenue_range': [0.0, 0.0] if revenue_range is None or None in revenue_range else [float(value) for value in revenue_range]
+    }
+
+def get_filter_check_queries(schema_name: str, values: dict):
+
+    min_revenue, max_revenue = values['revenue_range']
+
+    # One query of each shape the sidebar still sends, the bridge rows of the genres are only read inside the semi-join of the fact query
+    return {
+        'dim_years by YEAR_ID': (DIM_YEARS_KEY, get_filtered_dimensions_query(schema_name, DIM_YEARS_KEY, 'YEAR_ID', values['year_ids'])),
+        'dim_genres by GENRE_NAME': (DIM_GENRES_KEY, get_filtered_dimensions_query(schema_name, DIM_GENRES_KEY, 'GENRE_NAME', values['genres'])),
+        'fact_table by revenue': (FACT_TABLE_KEY, get_filtered_fact_table_query(schema_name, min_revenue, max_revenue)),
+        'fact_table by all filters': (FACT_TABLE_KEY, get_filtered_fact_table_query(schema_name, min_revenue, max_revenue, values['year_ids'], values['genres'], SCORE_OPTIONS[-1], SCORE_OPTIONS[-1]))
+    }
+
+def check_local_index_usage(conn, schema_name: str, row_counts: dict, min_rows: int = INDEX_CHECK_MIN_ROWS):
+
+    index_usage = {}
+    unindexed_filters = []
+    check_queries = get_filter_check_queries(schema_name, get_filter_check_values(conn, schema_name))
+
+    # The plans come from the normal planner settings, on the tables already analyzed
+    with conn.cursor() as cursor:
+        for query_name, (table_name, (query, params)) in check_queries.items():
+            prepared_statements.execute(cursor, query, params, explain=True)
+            index_names, seq_scans = get_plan_scans(cursor.fetchone()[0][0]['Plan'])
+            index_usage[query_name] = index_names
+
+            if len(seq_scans) == 0 and len(index_names) > 0:
+                logger_data.info(f"[INFO] The filter '{query_name}' uses the indexes: {', '.join(index_names)}")
+            elif row_counts[table_name] < min_rows:
+                logger_data.info(f"[INFO] The filter '{query_name}' scans {table_name} sequentially, which is cheaper than an index for {row_counts[table_name]} rows")
+            else:
+                unindexed_filters.append(query_name)
+                logger_data.warning(f"[WARNING] The filter '{query_name}' scans {table_name} sequentially with {row_counts[table_name]} rows, its indexes may be missing or not selective")
+
+    conn.rollback()
+
+    # The planner may have good reasons for a scan, so the load is still published and only the count is reported
+    logger_data.info(f"[INFO] Index check of {schema_name}: {len(check_queries) - len(unindexed_filters)} of {len(check_queries)} filters use an index or scan a small table, "
+                     f"{len(unindexed_filters)} scan a big table sequentially")
+
+    return index_usage, unindexed_filters
+
+def analyze_local_tables(conn, schema_name: str, table_names: list):
+
+    with conn.cursor() as cursor:
         for table_name in table_names:
-            cursor.execute(f"TRUNCATE TABLE {schema_name}.{table_name} CASCADE")
-        
-        conn.commit()
+            cursor.execute(f"ANALYZE {schema_name}.{table_name}")
 
-    except (psy.DatabaseError) as error: 
-        raise_psql_error(error)
-        conn.rollback()
-        return False
-    except (Exception) as error: 
-        raise_unknown_error(error)
-        conn.rollback()
-        return False
-    
-    finally:
-        cursor.close()
-    
-    return True
+    conn.commit()
 
+def swap_local_schemas(conn, schema_name: str, other_schema: str):
 
-def save_local_table(conn, schema_name: str, table_name: str, data: pd.DataFrame):
+    # Renames are only catalog changes, so the readers keep using the old tables until their query finishes
+    with conn.cursor() as cursor:
+        cursor.execute(f"ALTER SCHEMA {schema_name} RENAME TO {schema_name}{SWAP_SCHEMA_SUFFIX}")
+        cursor.execute(f"ALTER SCHEMA {other_schema} RENAME TO {schema_name}")
+        cursor.execute(f"ALTER SCHEMA {schema_name}{SWAP_SCHEMA_SUFFIX} RENAME TO {other_schema}")
+
+    conn.commit()
+    prepared_statements.invalidate()
+
+def publish_staging_schema(conn, schema_name: str):
+
+    previous_schema = schema_name + PREVIOUS_SCHEMA_SUFFIX
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {previous_schema} CASCADE")
+        cursor.execute(f"ALTER SCHEMA {schema_name} RENAME TO {previous_schema}")
+        cursor.execute(f"ALTER SCHEMA {schema_name}{STAGING_SCHEMA_SUFFIX} RENAME TO {schema_name}")
+
+    conn.commit()
+    prepared_statements.invalidate()
+    logger_data.info(f"[SUCCESS] The staging schema replaced {schema_name}, the old tables were kept in {previous_schema}")
+
+def rollback_local_schema(conn, schema_name: str):
 
-    tuples = [tuple(x) for x in data.to_numpy()] 
-    cols = ','.join(list(data.columns)) 
+    swap_local_schemas(conn, schema_name, schema_name + PREVIOUS_SCHEMA_SUFFIX)
+    logger_data.info(f"[SUCCESS] {schema_name} rolled back to the tables of the previous load")
 
-    query = f"INSERT INTO {schema_name}.{table_name}({cols}) VALUES %s"
+class DataFrameCsvReader:
+
+    # File read by COPY FROM STDIN, the rows are encoded as CSV by Arrow one chunk at a time
+    def __init__(self, data: pd.DataFrame, chunk_rows: int = COPY_CHUNK_ROWS):
+        self.data = data
+        self.chunk_rows = chunk_rows
+        self.offset = 0
+        self.chunk = io.BytesIO()
+
+    def next_chunk(self):
+        rows = pa.Table.from_pandas(self.data.iloc[self.offset:self.offset + self.chunk_rows], preserve_index=False)
+
+        self.chunk = io.BytesIO()
+        pa_csv.write_csv(rows, self.chunk, pa_csv.WriteOptions(include_header=False))
+        self.chunk.seek(0)
+        self.offset += self.chunk_rows
+
+    def read(self, size: int = -1):
+        data = self.chunk.read(size)
+
+        while (size < 0 or len(data) < size) and self.offset < len(self.data):
+            self.next_chunk()
+            data += self.chunk.read(size - len(data) if size >= 0 else -1)
+
+        return data
+
+def copy_local_rows(cursor, schema_name: str, table_name: str, data: pd.DataFrame, chunk_rows: int = COPY_CHUNK_ROWS):
+
+    cols = ','.join(list(data.columns))
+    # Arrow quotes every string and writes the nulls as empty values, as the CSV format of COPY expects
+    query = f"COPY {schema_name}.{table_name}({cols}) FROM STDIN WITH (FORMAT csv)"
+
+    cursor.copy_expert(query, DataFrameCsvReader(data, chunk_rows))
+
+def insert_local_rows(cursor, schema_name: str, table_name: str, data: pd.DataFrame, primary_key: str = None):
+
+    if primary_key is None:
+        copy_local_rows(cursor, schema_name, table_name, data)
+        return
+
+    # COPY can not update the existing rows, so they are copied into a temporary table and upserted from there
+    cols = ','.join(list(data.columns))
+    updates = ', '.join([f'{column} = EXCLUDED.{column}' for column in data.columns if column != primary_key])
+    staging_table = f'staging_{table_name}'
+
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {schema_name}.{table_name})")
+    copy_local_rows(cursor, 'pg_temp', staging_table, data)
+    cursor.execute(f"INSERT INTO {schema_name}.{table_name}({cols}) SELECT {cols} FROM pg_temp.{staging_table} ON CONFLICT ({primary_key}) DO UPDATE SET {updates}")
+    cursor.execute(f"DROP TABLE pg_temp.{staging_table}")
+
+def verify_local_table(conn, schema_name: str, table_name: str, pd_count: int):
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {schema_name}.{table_name}")
+        bd_count = cursor.fetchone()[0]
+
+    if bd_count != pd_count:
+        logger_data.critical(f"[ERROR] The number of inserted rows for {table_name} is incorrect: Dataframe has {pd_count} rows and the DB table {bd_count} rows.")
+        return False
+
+    return True
+
+def save_local_table(conn, schema_name: str, table_name: str, data: pd.DataFrame):
 
     cursor = conn.cursor()
     
     try:
-        extras.execute_values(cursor, query, tuples) 
+        insert_local_rows(cursor, schema_name, table_name, data)
         conn.commit()
 
-        cursor.execute(f"SELECT COUNT(*) FROM {schema_name}.{table_name}")
-        bd_count = cursor.fetchone()[0]
-        pd_count = len(data)
-        assert(bd_count == pd_count)
+        assert(verify_local_table(conn, schema_name, table_name, len(data)))
 
     except (AssertionError) as error:
-        logger_data.critical(f"[ERROR] The number of inserted rows for {table_name} is incorrect: Dataframe has {pd_count} rows and the DB table {bd_count} rows.")
         conn.rollback()
         return False
     except (psy.DatabaseError) as error: 
@@ -198,163 +568,676 @@ def save_local_table(conn, schema_name: str, table_name: str, data: pd.DataFrame
     logger_data.info(f"\t Dataframe {table_name} saved to local db")
     return True
 
-def get_filtered_dimensions_psql(conn, table_name: str, columns: list, colum_to_filter: str = None, filter_list: list = None, is_int=False):
+def get_schema_dependencies(sql_path: str = SCHEMA_SQL_PATH):
 
-    query = f"SELECT * FROM imdb_dwh.{table_name}"
+    # Tables referenced by the foreign keys of each table in the schema script
+    dependencies = {}
 
-    if colum_to_filter is not None and filter_list is not None:
-        query = query + ' WHERE ' + list_to_wherein(colum_to_filter, filter_list, is_int)
-  
-    with conn.cursor() as cursor:
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        cursor.close()
+    for statement in get_schema_statements('CREATE TABLE', sql_path):
+        table_name = re.match(r'CREATE TABLE\s+(\w+)', statement, re.IGNORECASE).group(1).lower()
+        references = re.findall(r'REFERENCES\s+(\w+)', statement, re.IGNORECASE)
 
-    df = pd.DataFrame(rows, columns=columns)
+        dependencies[table_name] = set([reference.lower() for reference in references]) - set([table_name])
 
-    logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the table {table_name}")
+    return dependencies
 
-    return df
+def get_load_stages(table_names: list, dependencies: dict):
+
+    # Every stage has the tables whose references are already loaded, so the tables of a stage can be loaded at the same time
+    stages = []
+    loaded = set([table_name for dependency in dependencies.values() for table_name in dependency]) - set(table_names)
+    pending = list(table_names)
+
+    while len(pending) > 0:
+        stage = [table_name for table_name in pending if dependencies.get(table_name, set()) <= loaded]
+
+        if len(stage) == 0:
+            raise ValueError(f"The foreign keys of the tables {pending} have a cycle, they can not be loaded in order")
+
+        stages.append(stage)
+        loaded.update(stage)
+        pending = [table_name for table_name in pending if table_name not in stage]
+
+    return stages
+
+def load_snow_table_into_local(snow_conn: SnowflakeConnection, table_name: str, schema_name: str, psql_conns: Queue, load_times: dict):
+
+    start_time = time.perf_counter()
+    psql_conn = psql_conns.get()
+
+    try:
+        with psql_conn.cursor() as cursor:
+            data = get_snow_table(snow_conn, table_name, lambda batch: insert_local_rows(cursor, schema_name, table_name, batch))
+
+        # Committed at once, so the tables of the next stages can check their foreign keys from other connections
+        psql_conn.commit()
+
+    except Exception as error:
+        psql_conn.rollback()
+        raise error
+
+    finally:
+        psql_conns.put(psql_conn)
+
+    load_times[table_name] = time.perf_counter() - start_time
+    logger_data.info(f"\t Table {table_name} loaded into {schema_name} in {load_times[table_name]:.2f} s")
+
+    return data
+
+def load_snow_tables_into_local(snow_conn: SnowflakeConnection, schema_name: str, table_names: list):
+
+    start_time = time.perf_counter()
+    load_times = {}
+    psql_conns = Queue()
+
+    try:
+        for i in range(LOCAL_LOAD_CONNECTIONS):
+            psql_conns.put(get_psql_connection())
+
+        tasks = {table_name: (load_snow_table_into_local, [table_name, schema_name, psql_conns, load_times], {}) for table_name in table_names}
+        stages = get_load_stages(table_names, get_schema_dependencies())
+
+        snow_data = run_snow_tasks(snow_conn, tasks, stages)
+
+    finally:
+        while not psql_conns.empty():
+            release_psql_connection(psql_conns.get())
+
+    total_time = time.perf_counter() - start_time
+    logger_data.info(f"[SUCCESS] {len(table_names)} tables loaded into {schema_name} in {total_time:.2f} s ({sum(load_times.values()):.2f} s adding the time of each table)")
+
+    return snow_data
+
+class PreparedStatements:
+
+    # Statements prepared on each connection of the pool, forgotten when the live schema is swapped so no plan points to the old tables
+    def __init__(self):
+        self.lock = Lock()
+        self.version = 0
+        self.connections = WeakKeyDictionary()
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    def execute(self, cursor, query: str, params: list, explain: bool = False):
+
+        statement_name = 'filter_' + hashlib.md5(query.encode('utf-8')).hexdigest()[:16]
+
+        with self.lock:
+            version, statement_names = self.connections.get(cursor.connection, (None, set()))
+            outdated = version != self.version
+
+            if outdated:
+                statement_names = set()
+                self.connections[cursor.connection] = (self.version, statement_names)
+
+        if outdated and version is not None:
+            cursor.execute("DEALLOCATE ALL")
+
+        if statement_name not in statement_names:
+            cursor.execute(f"PREPARE {statement_name} AS {query}")
+            statement_names.add(statement_name)
+
+        execute_statement = f"EXECUTE {statement_name}" + (f" ({', '.join(['%s'] * len(params))})" if len(params) > 0 else '')
+        cursor.execute(("EXPLAIN (FORMAT JSON) " if explain else '') + execute_statement, params)
+
+prepared_statements = PreparedStatements()
+
+def get_filtered_dimensions_query(schema_name: str, table_name: str, colum_to_filter: str = None, filter_list: list = None):
+
+    # The values always travel as parameters, so each table has only two statement shapes
+    if colum_to_filter is None or filter_list is None:
+        return f"SELECT * FROM {schema_name}.{table_name}", []
+
+    return f"SELECT * FROM {schema_name}.{table_name} WHERE {colum_to_filter} = ANY($1)", [list(filter_list)]
+
+def get_fact_table_conditions(schema_name: str, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, genre_name_list: list = None, max_user_score: str = None, max_critic_score: str = None, alias: str = 'f.'):
 
-def get_filtered_fact_table_psql(conn, columns: list, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, bridge_genre_id_list: list = None, max_user_score: str = None, max_critic_score: str = None):
-    
-    year_column = 'year_id'
-    genre_column = 'bridge_genre_id'
-    user_score_column = 'user_score_category'
-    critic_score_column = 'critic_score_category'
     user_score_list = get_score_list(max_user_score)
     critic_score_list = get_score_list(max_critic_score)
 
-    query = f"SELECT * FROM IMDB_DWH.fact_table"
-    
     if(max_revenue is None):
-        query = query + f" WHERE revenue BETWEEN {min_revenue} AND {get_max_revenue(conn)}"
+        conditions = [f"{alias}revenue >= $1"]
+        params = [float(min_revenue)]
     else:
-        query = query + f" WHERE revenue BETWEEN {min_revenue} AND {max_revenue}"
+        conditions = [f"{alias}revenue BETWEEN $1 AND $2"]
+        params = [float(min_revenue), float(max_revenue)]
 
-    if(year_id_list is not None):
-        query = query + f" AND {list_to_wherein(year_column, year_id_list, is_int=True)}"
-    if(bridge_genre_id_list is not None):
-        query = query + f" AND {list_to_wherein(genre_column, bridge_genre_id_list, is_int=True)}"
-    if(user_score_list is not None):
-        query = query + f" AND {list_to_wherein(user_score_column, user_score_list)}"
-    if(critic_score_list is not None):
-        query = query + f" AND {list_to_wherein(critic_score_column, critic_score_list)}"
+    # Every optional filter adds a fixed condition, so the number of statement shapes is bounded
+    optional_filters = [('year_id', year_id_list), ('user_score_category', user_score_list), ('critic_score_category', critic_score_list)]
+
+    for column, filter_list in optional_filters:
+        if filter_list is not None:
+            params.append(list(filter_list))
+            conditions.append(f"{alias}{column} = ANY(${len(params)})")
+
+    # Semi-join resolved by the database, so the bridge rows of the genres never travel to the client and the query keeps its size
+    if genre_name_list is not None:
+        params.append(list(genre_name_list))
+        conditions.append(f"""EXISTS (SELECT 1 FROM {schema_name}.bridge_genres b JOIN {schema_name}.dim_genres g ON g.genre_id = b.genre_id
+                                      WHERE b.bridge_genre_id = {alias}bridge_genre_id AND g.genre_name = ANY(${len(params)}))""")
+
+    return conditions, params
+
+def get_filtered_fact_table_query(schema_name: str, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, genre_name_list: list = None, max_user_score: str = None, max_critic_score: str = None):
+
+    conditions, params = get_fact_table_conditions(schema_name, min_revenue, max_revenue, year_id_list, genre_name_list, max_user_score, max_critic_score)
+
+    return f"SELECT f.* FROM {schema_name}.fact_table f WHERE " + ' AND '.join(conditions), params
+
+def get_year_state_query(schema_name: str, selection: dict):
+
+    conditions, params = get_fact_table_conditions(schema_name, selection['min_revenue'], selection['max_revenue'], selection['year_ids'], selection['genres'],
+                                                   selection['max_user_score'], selection['max_critic_score'])
+
+    # One grouping set per chart, told apart by GROUPING because a film without a category also gives a NULL
+    query = f"""SELECT f.year_id, AVG(f.user_score)::float8, AVG(f.critic_score)::float8, AVG(f.revenue)::float8, AVG(f.user_votes)::float8, AVG(y.year)::float8,
+                       f.user_score_category, f.critic_score_category, f.user_votes_category, f.revenue_category, COUNT(*),
+                       GROUPING(f.year_id, f.user_score_category, f.critic_score_category, f.user_votes_category, f.revenue_category)
+                FROM {schema_name}.fact_table f JOIN {schema_name}.dim_years y ON y.year_id = f.year_id
+                WHERE {' AND '.join(conditions)}
+                GROUP BY GROUPING SETS ((f.year_id), (f.user_score_category), (f.critic_score_category), (f.user_votes_category), (f.revenue_category))"""
+
+    return query, params
+
+def get_year_state_cube_query(schema_name: str, selection: dict):
+
+    # Only valid when no cell of the cube is split by the revenue range, which is checked by the cube of the snapshot
+    if selection['max_revenue'] is None:
+        conditions = ["c.revenue_min >= $1"]
+        params = [float(selection['min_revenue'])]
+    else:
+        conditions = ["c.revenue_min >= $1", "c.revenue_max <= $2"]
+        params = [float(selection['min_revenue']), float(selection['max_revenue'])]
+
+    optional_filters = [('year_id', selection['year_ids']), ('user_score_category', get_score_list(selection['max_user_score'])), ('critic_score_category', get_score_list(selection['max_critic_score']))]
+
+    for column, filter_list in optional_filters:
+        if filter_list is not None:
+            params.append(list(filter_list))
+            conditions.append(f"c.{column} = ANY(${len(params)})")
+
+    if selection['genres'] is not None:
+        params.append(list(selection['genres']))
+        conditions.append(f"c.genre_id IN (SELECT genre_id FROM {schema_name}.dim_genres WHERE genre_name = ANY(${len(params)}))")
+
+    # Same rows as get_year_state_query, the means come from the sums of the cells
+    query = f"""SELECT c.year_id, SUM(c.user_score_sum)::float8 / SUM(c.film_count), SUM(c.critic_score_sum)::float8 / SUM(c.film_count),
+                       SUM(c.revenue_sum)::float8 / SUM(c.film_count), SUM(c.user_votes_sum)::float8 / SUM(c.film_count), SUM(y.year * c.film_count)::float8 / SUM(c.film_count),
+                       c.user_score_category, c.critic_score_category, c.user_votes_category, c.revenue_category, SUM(c.film_count)::int8,
+                       GROUPING(c.year_id, c.user_score_category, c.critic_score_category, c.user_votes_category, c.revenue_category)
+                FROM {schema_name}.{ROLLUP_CUBE_VIEW} c JOIN {schema_name}.dim_years y ON y.year_id = c.year_id
+                WHERE {' AND '.join(conditions)}
+                GROUP BY GROUPING SETS ((c.year_id), (c.user_score_category), (c.critic_score_category), (c.user_votes_category), (c.revenue_category))"""
+
+    return query, params
+
+def get_grouping_sets(columns: list):
+
+    # GROUPING sets the bit of every column left out of the set of the row, the first column being the highest bit
+    all_columns = 2 ** len(columns) - 1
+
+    return {column: all_columns ^ (1 << (len(columns) - 1 - i)) for i, column in enumerate(columns)}
+
+def is_local_db_current(conn, snapshot: WarehouseSnapshot):
+
+    # The local db can already hold a newer sync than the snapshot, and the results are cached under the version of the snapshot
+    local_versions = get_local_table_versions(conn, snapshot.key[2])
+
+    if not all(table_name in local_versions for table_name in DWH_TABLE_NAMES):
+        return False
+
+    return get_data_version({table_name: local_versions[table_name] for table_name in DWH_TABLE_NAMES}) == snapshot.version
+
+def get_pyformat_query(query: str):
+
+    # The parameters of the queries are numbered in order, so they can also be sent with a plain execute
+    return re.sub(r'\$\d+', '%s', query)
+
+def get_psql_frame(arrow_table: pa.Table):
+
+    df = arrow_table.to_pandas()
+
+    # The categories come in the order they were found, so they are sorted to filter and sort like the strings
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.set_categories(sorted(df[column].cat.categories))
+
+    return df
+
+def read_psql_rows(rows: list, column_types: dict, columns: list = None):
+
+    # The rows have every column of the table, in the order of its CREATE TABLE
+    columns = list(column_types) if columns is None else list(columns)
+    positions = {column: i for i, column in enumerate(column_types)}
+
+    arrow_table = pa.table({column: pa.array([row[positions[column]] for row in rows], type=column_types[column]) for column in columns})
+
+    return get_psql_frame(arrow_table)
+
+def read_psql_csv(csv_stream, column_types: dict, columns: list = None):
+
+    # The CSV has every column of the table, and only the requested ones are converted
+    columns = list(column_types) if columns is None else list(columns)
+
+    if len(csv_stream.peek(1)) == 0:
+        arrow_table = pa.schema([(column, column_types[column]) for column in columns]).empty_table()
+    else:
+        read_options = pa_csv.ReadOptions(column_names=list(column_types))
+        convert_options = pa_csv.ConvertOptions(column_types=column_types, include_columns=columns, quoted_strings_can_be_null=False)
+
+        # The blocks are parsed while the rows arrive, so the whole CSV is never held in memory
+        arrow_table = pa_csv.open_csv(csv_stream, read_options=read_options, convert_options=convert_options).read_all()
+
+    return get_psql_frame(arrow_table)
+
+def fetch_psql_dataframe(cursor, query: str, params: list, column_types: dict, columns: list = None):
+
+    # COPY sends the rows as one CSV stream that Arrow parses into typed columns, without a Python object per value
+    copy_query = f"COPY ({cursor.mogrify(get_pyformat_query(query), params).decode('utf-8')}) TO STDOUT WITH (FORMAT csv)"
+    read_fd, write_fd = os.pipe()
+    copy_errors = []
+
+    def copy_rows():
+        try:
+            with open(write_fd, 'wb') as csv_writer:
+                cursor.copy_expert(copy_query, csv_writer)
+        except Exception as error:
+            copy_errors.append(error)
+
+    # The database writes into a pipe while Arrow reads from the other end, if the reader stops the writer gets a broken pipe
+    copy_thread = Thread(target=copy_rows, name='psql_copy', daemon=True)
+    copy_thread.start()
+
+    try:
+        with open(read_fd, 'rb') as csv_stream:
+            df = read_psql_csv(csv_stream, column_types, columns)
+    finally:
+        copy_thread.join()
+
+        # The error of the query explains a cut stream better than the parser
+        if len(copy_errors) > 0:
+            raise copy_errors[0]
+
+    return df
+
+def get_filtered_dimensions_psql(conn, table_name: str, columns: list = None, colum_to_filter: str = None, filter_list: list = None, schema_name: str = 'imdb_dwh'):
+
+    query, params = get_filtered_dimensions_query(schema_name, table_name, colum_to_filter, filter_list)
+
+    # The dimensions are small, so they reuse the plan prepared on the connection instead of a COPY per filter change
+    with conn.cursor() as cursor:
+        prepared_statements.execute(cursor, query, params)
+        df = get_compact_table(read_psql_rows(cursor.fetchall(), get_psql_column_types(table_name), columns))
+
+    logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the table {table_name}")
+
+    return df
+
+def get_local_table_psql(conn, table_name: str, schema_name: str = 'imdb_dwh'):
+
+    query, params = get_filtered_dimensions_query(schema_name, table_name)
+
+    with conn.cursor() as cursor:
+        df = get_compact_table(fetch_psql_dataframe(cursor, query, params, get_psql_column_types(table_name)))
+
+    logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the table {table_name}")
+
+    return df
+
+def get_year_state_data_psql(conn, selection: dict, schema_name: str = 'imdb_dwh', from_cube: bool = False):
+
+    query, params = get_year_state_cube_query(schema_name, selection) if from_cube else get_year_state_query(schema_name, selection)
 
     with conn.cursor() as cursor:
-        cursor.execute(query)
+        prepared_statements.execute(cursor, query, params)
         rows = cursor.fetchall()
-        cursor.close()
 
-    df = pd.DataFrame(rows, columns=columns)
+    average_columns = ['YEAR_ID', 'USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES', 'YEAR']
+    count_columns = ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']
+    aggregates = pd.DataFrame(rows, columns=average_columns + count_columns + ['COUNT', 'GROUPING'])
+    grouping_sets = get_grouping_sets(['YEAR_ID'] + count_columns)
+
+    # Same frames as get_average_data_per_year and get_pie_count return from the whole fact table
+    avg_data = aggregates.loc[aggregates['GROUPING'] == grouping_sets['YEAR_ID'], average_columns].astype({'YEAR_ID': 'int64'})
+    avg_data = avg_data.sort_values('YEAR_ID').reset_index(drop=True)
+
+    category_counts = []
+    for column in count_columns:
+        category_count = aggregates.loc[aggregates['GROUPING'] == grouping_sets[column], [column, 'COUNT']].astype({'COUNT': 'int64'})
+
+        if column in ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY']:
+            category_count = category_count.sort_values(column, ascending=False)
+        else:
+            category_count = category_count.sort_values(['COUNT', column], ascending=[False, True])
+
+        category_counts.append(category_count.reset_index(drop=True))
+
+    logger_data.info(f"[SUCCESS] {len(rows)} aggregated rows retrieved for the year state dashboard")
+
+    return avg_data, tuple(category_counts)
+
+def get_filtered_fact_table_psql(conn, columns: list, min_revenue: float = 0.0, max_revenue:float = None, year_id_list: list = None, genre_name_list: list = None, max_user_score: str = None, max_critic_score: str = None, schema_name: str = 'imdb_dwh'):
+    
+    query, params = get_filtered_fact_table_query(schema_name, min_revenue, max_revenue, year_id_list, genre_name_list, max_user_score, max_critic_score)
+
+    with conn.cursor() as cursor:
+        df = get_compact_table(fetch_psql_dataframe(cursor, query, params, get_psql_column_types(FACT_TABLE_KEY), columns))
 
     logger_data.info(f"[SUCCESS] {len(df)} elements retrieved from the fact table")
 
     return df
 
+# -----------------------------------------------------------------------
+#   SYNC FUNCTIONS (Used to update only the changed rows of the local db)
+# -----------------------------------------------------------------------
+
+def get_snow_table_versions(conn: SnowflakeConnection, table_names: list):
+
+    query = "SELECT TABLE_NAME, LAST_ALTERED, ROW_COUNT FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'IMDB_DWH'"
+
+    cursor = conn.cursor()
+    cursor.execute(query)
+    rows = cursor.fetchall()
+    cursor.close()
+
+    versions = {str(table_name).lower(): (last_altered, int(row_count)) for table_name, last_altered, row_count in rows}
+
+    # A missing table would be compared and saved as None by the sync, so it stops here
+    missing_tables = [table_name for table_name in table_names if table_name not in versions]
+    if len(missing_tables) > 0:
+        raise KeyError(f"The tables {missing_tables} are not in the IMDB_DWH schema of the Snowflake account")
+
+    return {table_name: versions[table_name] for table_name in table_names}
+
+def get_snow_row_hashes(conn: SnowflakeConnection, table_name: str):
+
+    query = f"SELECT {DWH_PRIMARY_KEYS[table_name]} AS ROW_ID, HASH(*) AS ROW_HASH FROM IMDB_DWH.{table_name}"
+
+    cursor = conn.cursor()
+    cursor.execute(query)
+    df = fetch_snow_dataframe(cursor)
+    cursor.close()
+
+    return df
+
+def download_snow_row_hashes(conn: SnowflakeConnection, table_names: list):
+
+    tasks = {table_name: (get_snow_row_hashes, [table_name], {}) for table_name in table_names}
+
+    return run_snow_tasks(conn, tasks)
+
+def get_filtered_rows_snow(conn: SnowflakeConnection, table_name: str, row_ids: list):
+
+    primary_key = DWH_PRIMARY_KEYS[table_name]
+    chunks = []
+
+    for i in range(0, len(row_ids), SYNC_MAX_IDS_PER_QUERY):
+        chunks.append(get_filtered_dimensions_snow(conn, table_name, primary_key, row_ids[i:i + SYNC_MAX_IDS_PER_QUERY], is_int=True))
+
+    return pd.concat(chunks, ignore_index=True)
+
+def create_sync_tables(conn, schema_name: str):
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema_name}.{SYNC_METADATA_TABLE}(TABLE_NAME VARCHAR(30) PRIMARY KEY, LAST_ALTERED TIMESTAMPTZ NOT NULL, ROW_COUNT BIGINT NOT NULL)")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema_name}.{SYNC_ROW_HASHES_TABLE}(TABLE_NAME VARCHAR(30) NOT NULL, ROW_ID INT NOT NULL, ROW_HASH BIGINT NOT NULL, PRIMARY KEY(TABLE_NAME, ROW_ID))")
+
+    conn.commit()
+
+def get_local_table_versions(conn, schema_name: str):
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT TABLE_NAME, LAST_ALTERED, ROW_COUNT FROM {schema_name}.{SYNC_METADATA_TABLE}")
+        rows = cursor.fetchall()
+
+    return {table_name: (last_altered, row_count) for table_name, last_altered, row_count in rows}
+
+def get_local_row_hashes(conn, schema_name: str, table_name: str):
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT ROW_ID, ROW_HASH FROM {schema_name}.{SYNC_ROW_HASHES_TABLE} WHERE TABLE_NAME = %s", [table_name])
+        rows = cursor.fetchall()
+
+    return pd.DataFrame(rows, columns=['ROW_ID', 'ROW_HASH'])
+
+def save_local_sync_state(cursor, schema_name: str, table_name: str, version: tuple, row_hashes: pd.DataFrame):
+
+    last_altered, row_count = version
+
+    cursor.execute(f"INSERT INTO {schema_name}.{SYNC_METADATA_TABLE}(TABLE_NAME, LAST_ALTERED, ROW_COUNT) VALUES (%s, %s, %s) ON CONFLICT (TABLE_NAME) DO UPDATE SET LAST_ALTERED = EXCLUDED.LAST_ALTERED, ROW_COUNT = EXCLUDED.ROW_COUNT", [table_name, last_altered, row_count])
+    cursor.execute(f"DELETE FROM {schema_name}.{SYNC_ROW_HASHES_TABLE} WHERE TABLE_NAME = %s", [table_name])
+
+    hashes = row_hashes[['ROW_ID', 'ROW_HASH']].copy()
+    hashes.insert(0, 'TABLE_NAME', table_name)
+    insert_local_rows(cursor, schema_name, SYNC_ROW_HASHES_TABLE, hashes)
+
+def delete_local_rows(cursor, schema_name: str, table_name: str, row_ids: list):
+
+    cursor.execute(f"DELETE FROM {schema_name}.{table_name} WHERE {DWH_PRIMARY_KEYS[table_name]} = ANY(%s)", [[int(row_id) for row_id in row_ids]])
+
+def get_changed_row_ids(snow_hashes: pd.DataFrame, local_hashes: pd.DataFrame):
+
+    snow = pd.Series(snow_hashes['ROW_HASH'].to_numpy(), index=snow_hashes['ROW_ID'].to_numpy())
+    local = pd.Series(local_hashes['ROW_HASH'].to_numpy(), index=local_hashes['ROW_ID'].to_numpy())
+
+    common_ids = snow.index.intersection(local.index)
+    updated_ids = common_ids[snow[common_ids].to_numpy() != local[common_ids].to_numpy()]
+
+    changed_ids = snow.index.difference(local.index).union(updated_ids)
+    deleted_ids = local.index.difference(snow.index)
+
+    return list(changed_ids), list(deleted_ids)
+
+def reload_local_tables(snow_conn: SnowflakeConnection, psql_conn, schema_name: str, snow_versions: dict, snow_stats: dict):
+
+    # The row hashes are read before the data, so a change made during the download is pulled again in the next sync
+    row_hashes = download_snow_row_hashes(snow_conn, DWH_TABLE_NAMES)
+
+    # Everything is loaded into a staging schema, so the sessions keep filtering the complete old tables meanwhile
+    staging_schema = create_staging_schema(psql_conn, schema_name)
+
+    snow_data = load_snow_tables_into_local(snow_conn, staging_schema, DWH_TABLE_NAMES)
+
+    with psql_conn.cursor() as cursor:
+        for table_name in DWH_TABLE_NAMES:
+            assert(verify_local_table(psql_conn, staging_schema, table_name, snow_stats['row_counts'][table_name]))
+            save_local_sync_state(cursor, staging_schema, table_name, snow_versions[table_name], row_hashes[table_name])
+
+    psql_conn.commit()
+
+    # The staging tables are created without secondary indexes, so they are only built once the data is in place
+    create_local_indexes(psql_conn, staging_schema)
+    create_local_rollup_cube(psql_conn, staging_schema)
+    analyze_local_tables(psql_conn, staging_schema, DWH_TABLE_NAMES + [ROLLUP_CUBE_VIEW])
+    check_local_index_usage(psql_conn, staging_schema, snow_stats['row_counts'])
+    publish_staging_schema(psql_conn, schema_name)
+
+    logger_data.info("[SUCCESS] All data from Snowflake was downloaded and saved into the local database.")
+
+    return snow_data
+
+def sync_local_tables(snow_conn: SnowflakeConnection, psql_conn, schema_name: str, snow_versions: dict, snow_stats: dict, local_versions: dict):
+
+    changed_tables = [table_name for table_name in DWH_TABLE_NAMES if snow_versions[table_name] != local_versions.get(table_name)]
+    deleted_ids = {}
+
+    # Upserts go in foreign key order and deletes in the reverse one, so no row is left pointing to a missing one
+    with psql_conn.cursor() as cursor:
+        for table_name in changed_tables:
+            snow_hashes = get_snow_row_hashes(snow_conn, table_name)
+            changed_ids, deleted_ids[table_name] = get_changed_row_ids(snow_hashes, get_local_row_hashes(psql_conn, schema_name, table_name))
+
+            if len(changed_ids) > SYNC_FULL_RELOAD_RATIO * len(snow_hashes):
+                insert_local_rows(cursor, schema_name, table_name, get_filtered_dimensions_snow(snow_conn, table_name), DWH_PRIMARY_KEYS[table_name])
+            elif len(changed_ids) > 0:
+                insert_local_rows(cursor, schema_name, table_name, get_filtered_rows_snow(snow_conn, table_name, changed_ids), DWH_PRIMARY_KEYS[table_name])
+
+            save_local_sync_state(cursor, schema_name, table_name, snow_versions[table_name], snow_hashes)
+            logger_data.info(f"[SUCCESS] Table {table_name} synchronized: {len(changed_ids)} rows upserted and {len(deleted_ids[table_name])} rows deleted")
+
+        for table_name in reversed(changed_tables):
+            if len(deleted_ids[table_name]) > 0:
+                delete_local_rows(cursor, schema_name, table_name, deleted_ids[table_name])
+
+    for table_name in changed_tables:
+        assert(verify_local_table(psql_conn, schema_name, table_name, snow_stats['row_counts'][table_name]))
+
+    psql_conn.commit()
+    analyze_local_tables(psql_conn, schema_name, changed_tables)
+
+    if len(changed_tables) > 0:
+        refresh_local_rollup_cube(psql_conn, schema_name)
+    logger_data.info(f"[SUCCESS] Local database synchronized with Snowflake: {len(changed_tables)} of {len(DWH_TABLE_NAMES)} tables had changes.")
+
+    # The local db is now up to date, so the session data is read from it instead of the warehouse
+    return {table_name: get_local_table_psql(psql_conn, table_name) for table_name in DWH_TABLE_NAMES}
+
 # -----------------------------------------------------------------------
 # FIRST CONNECTION FUNCTIONS (only executed when the user logs into the app) 
 # -----------------------------------------------------------------------
 
-def validate_initial_data(cached_value):
-    return DIM_YEARS_KEY in st.session_state and DIM_GENRES_KEY in st.session_state and DIM_DIRECTORS_KEY in st.session_state and DIM_ACTORS_KEY in st.session_state
+def build_warehouse_snapshot(snow_conn: SnowflakeConnection, account: str, database: str, schema: str, snow_versions: dict):
 
-@st.cache_resource(validate=validate_initial_data, show_spinner="Downloading data from your Snowflake account...")
-def get_initial_data():
+    snow_stats = get_snow_table_stats(snow_conn)
+
+    # The pool rolls back whatever is left uncommitted if the build fails
+    with psql_connection() as psql_conn:
+        create_sync_tables(psql_conn, schema)
+        create_local_indexes(psql_conn, schema)
+        create_local_rollup_cube(psql_conn, schema)
+
+        local_versions = get_local_table_versions(psql_conn, schema)
+
+        if SYNC_INCREMENTAL and all(table_name in local_versions for table_name in DWH_TABLE_NAMES):
+            snow_data = sync_local_tables(snow_conn, psql_conn, schema, snow_versions, snow_stats, local_versions)
+            published = False
+        else:
+            snow_data = reload_local_tables(snow_conn, psql_conn, schema, snow_versions, snow_stats)
+            published = True
 
-    logger_data.info("[INFO] Getting data from the Snowflake account")
-    
-    # Get data from the snowflake account
-    snow_conn = None
-    db_schema = None
     try:
-        snow_conn = create_snow_connection()
+        for table_name in DWH_TABLE_NAMES:
+            assert(len(snow_data[table_name]) == snow_stats['row_counts'][table_name])
 
-        if(validate_select_privileges(snow_conn)):
-            dim_years = get_filtered_dimensions_snow(snow_conn, DIM_YEARS_KEY)
-            dim_genres = get_filtered_dimensions_snow(snow_conn, DIM_GENRES_KEY)
-            dim_directors = get_filtered_dimensions_snow(snow_conn, DIM_DIRECTORS_KEY) 
-            dim_actors = get_filtered_dimensions_snow(snow_conn, DIM_ACTORS_KEY)
+        snapshot = WarehouseSnapshot(account, database, schema, get_data_version(snow_versions), snow_data, snow_stats)
+        snapshot.log_memory_usage()
 
-            bridge_genres = get_filtered_dimensions_snow(snow_conn, BRIDGE_GENRES_KEY)
-            bridge_actors = get_filtered_dimensions_snow(snow_conn, BRIDGE_ACTORS_KEY)
+    # A full load already published is undone, so the local db keeps the tables of the snapshot still in use
+    except Exception as error:
+        if published:
+            with psql_connection() as psql_conn:
+                rollback_local_schema(psql_conn, schema)
+        raise error
+
+    return snapshot
 
-            max_revenue = get_max_revenue(snow_conn)
-            fact_table = get_filtered_fact_table_snow(snow_conn)
+def refresh_warehouse_snapshot(snow_conn: SnowflakeConnection, snapshot: WarehouseSnapshot):
+
+    registry = get_snapshot_registry()
+    try:
+        snow_versions = get_snow_table_versions(snow_conn, DWH_TABLE_NAMES)
 
-            logger_data.info("[SUCCESS] All data from Snowflake was downloaded.")
+        with psql_connection() as psql_conn:
+            create_sync_tables(psql_conn, snapshot.key[2])
+            local_versions = get_local_table_versions(psql_conn, snapshot.key[2])
+
+        local_db_updated = all(local_versions.get(table_name) == snow_versions[table_name] for table_name in DWH_TABLE_NAMES)
+
+        if get_data_version(snow_versions) == snapshot.version and local_db_updated:
+            logger_data.info(f"[SUCCESS] The snapshot {snapshot.version} is up to date with the Snowflake account")
         else:
-            logger_data.info("[ERROR] The logged user does not have permission to query the database.")
-            return None
+            logger_data.info(f"[INFO] The snapshot {snapshot.version} is outdated, downloading the changes from the Snowflake account")
 
+            new_snapshot = build_warehouse_snapshot(snow_conn, *snapshot.key, snow_versions)
+            write_snapshot_files(new_snapshot)
+            warm_filter_result_cache(new_snapshot)
+            registry.set(new_snapshot)
+
+    # Nobody waits for this thread, so the errors are only logged
     except Exception as error:
-        raise_unknown_error(error)
-        close_snow_connection(snow_conn)
-        return False
-    
+        logger_data.error(f"[ERROR] The snapshot {snapshot.version} could not be checked against the Snowflake account:\n\t- Msg: {error}")
+
     finally:
-        db_schema = snow_conn.schema
-        close_snow_connection(snow_conn)
-
-    # Save data into session
-    st.session_state[DIM_YEARS_KEY] = dim_years
-    st.session_state[DIM_GENRES_KEY] = dim_genres
-    st.session_state[DIM_DIRECTORS_KEY] = dim_directors
-    st.session_state[DIM_ACTORS_KEY] = dim_actors
-
-    st.session_state[DIM_YEARS_COLUMNS_KEY] = list(dim_years.columns)
-    st.session_state[DIM_GENRES_COLUMNS_KEY] = list(dim_genres.columns)
-    st.session_state[DIM_DIRECTORS_COLUMNS_KEY] = list(dim_directors.columns)
-    st.session_state[DIM_ACTORS_COLUMNS_KEY] = list(dim_actors.columns)
-    
-    st.session_state[BRIDGE_ACTORS_KEY] = bridge_actors
-    st.session_state[BRIDGE_GENRES_KEY] = bridge_genres
+        release_snow_connection(snow_conn)
+        registry.end_refresh(snapshot.key)
+        get_psql_pool().log_metrics()
 
-    st.session_state[BRIDGE_ACTORS_COLUMNS_KEY] = list(bridge_actors.columns)
-    st.session_state[BRIDGE_GENRES_COLUMNS_KEY] = list(bridge_genres.columns)
+def start_snapshot_refresh(snow_conn: SnowflakeConnection, snapshot: WarehouseSnapshot):
 
-    st.session_state[FACT_TABLE_KEY] = fact_table
-    st.session_state[FACT_TABLE_COLUMNS_KEY] = list(fact_table.columns)
+    if not get_snapshot_registry().start_refresh(snapshot.key):
+        return False
 
-    st.session_state[COMPLETE_YEAR_LIST_KEY] = dim_years['YEAR']
-    st.session_state[COMPLETE_YEAR_IDS_LIST_KEY] = dim_years['YEAR_ID']
-    st.session_state[COMPLETE_GENRE_LIST_KEY] = dim_genres['GENRE_NAME']
-    st.session_state[MAX_REVENUE_KEY] = max_revenue
+    # The thread takes the context of the session to read its credentials, and releases the connection when it finishes
+    thread = Thread(target=refresh_warehouse_snapshot, args=(snow_conn, snapshot), name='snapshot_refresh', daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
 
-    st.session_state[CHECKBOXES_YEAR_STATES_KEY] = [True] * len(st.session_state[COMPLETE_YEAR_IDS_LIST_KEY])
-    st.session_state[INITIAL_DATA_KEY] = True
+    return True
 
-    # Save data into the local db
-    logger_data.info("[INFO] Saving data into the local database.")
+def get_initial_data():
 
-    psql_conn = None
+    logger_data.info("[INFO] Getting data from the Snowflake account")
+    
+    # Get the snapshot from memory or disk if possible, and from the snowflake account otherwise
+    snow_conn = None
+    refreshing = False
     try:
-        psql_conn = create_psql_connection()
+        snow_conn = create_snow_connection()
+
+        if(validate_select_privileges(snow_conn)):
+            key = (snow_conn.account, snow_conn.database, snow_conn.schema)
+            registry = get_snapshot_registry()
 
-        table_names = [DIM_YEARS_KEY, DIM_GENRES_KEY, DIM_DIRECTORS_KEY, DIM_ACTORS_KEY, BRIDGE_GENRES_KEY, BRIDGE_ACTORS_KEY, FACT_TABLE_KEY]
-        dataframes = [dim_years, dim_genres, dim_directors, dim_actors, bridge_genres, bridge_actors, fact_table]
+            snapshot = registry.get(key)
+            downloaded = False
 
-        if(truncate_local_tables(psql_conn, db_schema, table_names)):
-            
-            for i in range(len(table_names)):
-                save_local_table(psql_conn, db_schema, table_names[i], dataframes[i])
+            # Only the logins of the same account wait for its build, the rest read the registry without any lock
+            if snapshot is None:
+                with registry.get_build_lock(key):
+                    snapshot = registry.get(key)
+
+                    if snapshot is None:
+                        snapshot = read_snapshot_files(*key)
+
+                        if snapshot is None:
+                            with st.spinner("Downloading data from your Snowflake account..."):
+                                snow_versions = get_snow_table_versions(snow_conn, DWH_TABLE_NAMES)
+                                snapshot = build_warehouse_snapshot(snow_conn, *key, snow_versions)
+                                write_snapshot_files(snapshot)
+                                downloaded = True
+
+                        registry.set(snapshot)
+
+            warm_filter_result_cache(snapshot)
+
+            if not downloaded:
+                refreshing = start_snapshot_refresh(snow_conn, snapshot)
+        else:
+            logger_data.info("[ERROR] The logged user does not have permission to query the database.")
+            return None
+
+    except (AssertionError) as error:
+        return False
 
-        logger_data.info("[SUCCESS] All data from Snowflake saved into the local database.")
-    
     except (psy.DatabaseError, psy.OperationalError, psy.DataError, psy.IntegrityError, psy.InternalError, psy.ProgrammingError) as psql_error:
         raise_psql_error(psql_error)
-        psql_conn.rollback()
-        close_psql_connection(psql_conn)
         return False
 
-    except Exception as unknown_error:
-        raise_unknown_error(unknown_error)
-        psql_conn.rollback()
-        close_psql_connection(psql_conn)
+    except Exception as error:
+        raise_unknown_error(error)
         return False
-
+    
     finally:
-        close_psql_connection(psql_conn)
+        if not refreshing:
+            release_snow_connection(snow_conn)
+
+    # The session only keeps a reference to the shared snapshot and its own filters
+    set_session_snapshot(snapshot)
+
+    st.session_state[CHECKBOXES_YEAR_STATES_KEY] = [True] * len(snapshot.year_ids_list)
+    st.session_state[INITIAL_DATA_KEY] = True
 
     return True
 
@@ -370,44 +1253,37 @@ def get_average_data_per_year(dim_year: pd.DataFrame, fact_table_reduced: pd.Dat
 
     return average_data_per_year
 
-def get_top_directors(dim_director: pd.DataFrame, fact_table_reduced: pd.DataFrame):
+def get_top_directors(dim_director: pd.DataFrame, fact_table_reduced: pd.DataFrame, n: int = 15, metric: str = 'REVENUE'):
 
-    average_data_per_director = fact_table_reduced.merge(dim_director, on='DIRECTOR_ID')
-    
-    average_data_per_director = average_data_per_director[['REVENUE', 'DIRECTOR_NAME', 'USER_SCORE']]
-    average_data_per_director = average_data_per_director.groupby('DIRECTOR_NAME').mean().reset_index()
+    values = {column: fact_table_reduced[column].to_numpy() for column in ['REVENUE', 'USER_SCORE']}
 
-    top_directors_data = average_data_per_director.sort_values(by=['REVENUE'], ascending=False).head(15)
-    return top_directors_data[['REVENUE', 'DIRECTOR_NAME', 'USER_SCORE']]
+    return get_top_entities(fact_table_reduced['DIRECTOR_ID'].to_numpy(), values, dim_director, 'DIRECTOR_ID', 'DIRECTOR_NAME', n, metric)
 
-def get_top_genres(dim_genres: pd.DataFrame, bridge_genres: pd.DataFrame, fact_table_reduced: pd.DataFrame):
+def get_top_genres(dim_genres: pd.DataFrame, bridge_genres: pd.DataFrame, fact_table_reduced: pd.DataFrame, n: int = 5, metric: str = 'REVENUE'):
 
-    average_data_per_genre = fact_table_reduced.merge(bridge_genres, on='FILM_RANK')
-    average_data_per_genre = average_data_per_genre.merge(dim_genres, on='GENRE_ID')
+    genre_ids, values = get_bridge_rows(bridge_genres, fact_table_reduced, 'GENRE_ID', ['REVENUE', 'USER_SCORE'])
 
-    average_data_per_genre = average_data_per_genre[['REVENUE', 'GENRE_NAME', 'USER_SCORE']]
-    average_data_per_genre = average_data_per_genre.groupby('GENRE_NAME').mean().reset_index()
+    return get_top_entities(genre_ids, values, dim_genres, 'GENRE_ID', 'GENRE_NAME', n, metric)
 
-    top_genres_data = average_data_per_genre.sort_values(by=['REVENUE'], ascending=False).head(5)
-    return top_genres_data[['REVENUE', 'GENRE_NAME', 'USER_SCORE']]
+def get_top_actors(dim_actors: pd.DataFrame, bridge_actors: pd.DataFrame, fact_table_reduced: pd.DataFrame, n: int = 15, metric: str = 'REVENUE'):
 
-def get_top_actors(dim_actors: pd.DataFrame, bridge_actors: pd.DataFrame, fact_table_reduced: pd.DataFrame):
+    actor_ids, values = get_bridge_rows(bridge_actors, fact_table_reduced, 'ACTOR_ID', ['REVENUE', 'USER_SCORE'])
 
-    average_data_per_actor = fact_table_reduced.merge(bridge_actors, on='FILM_RANK')
-    average_data_per_actor = average_data_per_actor.merge(dim_actors, on='ACTOR_ID')
+    return get_top_entities(actor_ids, values, dim_actors, 'ACTOR_ID', 'ACTOR_NAME', n, metric)
 
-    average_data_per_actor = average_data_per_actor[['REVENUE', 'ACTOR_NAME', 'USER_SCORE']]
-    average_data_per_actor = average_data_per_actor.groupby('ACTOR_NAME').mean().reset_index()
+def get_value_count(column: pd.Series):
 
-    top_actors_data = average_data_per_actor.sort_values(by=['REVENUE'], ascending=False).head(15)
-    return top_actors_data[['REVENUE', 'ACTOR_NAME', 'USER_SCORE']]
+    # Categorical columns also count the categories without films, which are not drawn
+    value_count = column.value_counts()
+
+    return value_count[value_count > 0]
 
 def get_pie_count(fact_table_reduced: pd.DataFrame):
 
-    user_score_count = fact_table_reduced['USER_SCORE_CATEGORY'].value_counts()
-    critic_score_count = fact_table_reduced['CRITIC_SCORE_CATEGORY'].value_counts()
-    user_votes_count = fact_table_reduced['USER_VOTES_CATEGORY'].value_counts()
-    revenue_category_count = fact_table_reduced['REVENUE_CATEGORY'].value_counts()
+    user_score_count = get_value_count(fact_table_reduced['USER_SCORE_CATEGORY'])
+    critic_score_count = get_value_count(fact_table_reduced['CRITIC_SCORE_CATEGORY'])
+    user_votes_count = get_value_count(fact_table_reduced['USER_VOTES_CATEGORY'])
+    revenue_category_count = get_value_count(fact_table_reduced['REVENUE_CATEGORY'])
 
     user_score_count = pd.DataFrame({'USER_SCORE_CATEGORY':user_score_count.index, 'COUNT':user_score_count.values})
     critic_score_count = pd.DataFrame({'CRITIC_SCORE_CATEGORY':critic_score_count.index, 'COUNT':critic_score_count.values})
@@ -417,33 +1293,221 @@ def get_pie_count(fact_table_reduced: pd.DataFrame):
     user_score_count = user_score_count.sort_values('USER_SCORE_CATEGORY', ascending=False)
     critic_score_count = critic_score_count.sort_values('CRITIC_SCORE_CATEGORY', ascending=False)
 
+    # Ties go by name like in the rollup cube, and not by the order of the codes of the compact store
+    user_votes_count = user_votes_count.sort_values(['COUNT', 'USER_VOTES_CATEGORY'], ascending=[False, True])
+    revenue_category_count = revenue_category_count.sort_values(['COUNT', 'REVENUE_CATEGORY'], ascending=[False, True])
+
     return user_score_count, critic_score_count, user_votes_count, revenue_category_count
 
-def get_merged_genres(dim_genres: pd.DataFrame, bridge_genres: pd.DataFrame, fact_table: pd.DataFrame):
+# -----------------------------------------------------------------------
+#   PAGE DATA FUNCTIONS (data of each dashboard, shared in the filter cache)
+# -----------------------------------------------------------------------
+
+def get_year_state_data(get_table):
+
+    fact_table = get_table(FACT_TABLE_KEY)
+
+    average_data_columns = ['YEAR_ID', 'USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES']
+    avg_data = get_average_data_per_year(get_table(DIM_YEARS_KEY), fact_table[average_data_columns])
+
+    pie_columns = ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']
+
+    return avg_data, get_pie_count(fact_table[pie_columns])
+
+def get_year_state_data_cube(rollup_cube: RollupCube, cells: pd.DataFrame):
+
+    year_totals = rollup_cube.get_totals(cells, 'YEAR_ID')
+
+    # Same frames as get_year_state_data returns from the films of the cells
+    avg_data = year_totals[['USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES']].reset_index()
+    avg_data['YEAR'] = rollup_cube.years.reindex(avg_data['YEAR_ID']).to_numpy(dtype=np.float64)
+
+    category_counts = []
+    for column in ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']:
+        category_count = rollup_cube.get_totals(cells, column)['FILM_COUNT'].rename('COUNT').reset_index()
+
+        if column in ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY']:
+            category_count = category_count.sort_values(column, ascending=False)
+        else:
+            category_count = category_count.sort_values(['COUNT', column], ascending=[False, True])
+
+        category_counts.append(category_count.reset_index(drop=True))
+
+    return avg_data, tuple(category_counts)
+
+def get_year_state_data_delta(delta_engine: FilterDeltaEngine, aggregates: FilterAggregates):
+
+    # Same frames as get_year_state_data_cube, from the totals the session keeps for its filters
+    avg_data = delta_engine.get_year_totals(aggregates)
+
+    category_counts = []
+    for column in ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']:
+        category_count = delta_engine.get_category_counts(aggregates, column)
+
+        if column in ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY']:
+            category_count = category_count.sort_values(column, ascending=False)
+        else:
+            category_count = category_count.sort_values(['COUNT', column], ascending=[False, True])
+
+        category_counts.append(category_count.reset_index(drop=True))
+
+    return avg_data, tuple(category_counts)
+
+def get_routed_year_state_data(snapshot: WarehouseSnapshot, selection: dict, get_table, get_aggregates=None):
+
+    cells = None if selection is None else snapshot.rollup_cube.get_cells(selection)
+
+    # With the PostgreSQL backend the aggregates are computed by the database, and only the rows of the charts are transferred
+    if FILTER_BACKEND == 'psql' and selection is not None:
+        with psql_connection() as conn:
+            if is_local_db_current(conn, snapshot):
+                return get_year_state_data_psql(conn, selection, from_cube=cells is not None)
+
+        logger_data.info(f"[INFO] The local database does not hold the snapshot {snapshot.version}, the charts are computed from memory")
+
+    # The cube answers whenever the filters select whole cells, otherwise the films are aggregated one by one
+    if cells is not None:
+        return get_year_state_data_cube(snapshot.rollup_cube, cells)
+
+    # A session that keeps its totals only adds or subtracts the films of the toggled years, genres or scores
+    if get_aggregates is not None and selection is not None:
+        return get_year_state_data_delta(snapshot.delta_engine, get_aggregates(selection))
+
+    return get_year_state_data(get_table)
+
+def update_session_aggregates(snapshot: WarehouseSnapshot, selection: dict):
+
+    aggregates = snapshot.delta_engine.get_aggregates(selection, get_session_aggregates())
+    set_session_aggregates(aggregates)
+
+    return aggregates
+
+def get_session_year_state_data():
+
+    snapshot = get_session_snapshot()
+
+    return get_routed_year_state_data(snapshot, get_session_selection(), get_session_table, lambda selection: update_session_aggregates(snapshot, selection))
+
+def get_bubble_layout(film_view: FilmView, masks: dict):
+
+    film_rows = film_view.get_film_rows(masks.get(FACT_TABLE_KEY))
+    entries = {bridge_key: film_view.bridges[bridge_key].get_entries(film_rows, masks.get(bridge_key)) for bridge_key in [BRIDGE_GENRES_KEY, BRIDGE_ACTORS_KEY]}
+    counts = {bridge_key: np.bincount(entry_films, minlength=len(film_rows)) for bridge_key, (entry, entry_films) in entries.items()}
+
+    # The charts keep the rows of the genre x actor pairing of each film, so only its size and first row are computed
+    pair_counts = counts[BRIDGE_GENRES_KEY] * counts[BRIDGE_ACTORS_KEY]
+    pair_starts = np.cumsum(pair_counts) - pair_counts
+
+    return film_rows, entries, counts, pair_starts
+
+def get_entry_ranks(entry_films, counts):
+
+    # Position of each entry among the entries of its film
+    return np.arange(len(entry_films)) - (np.cumsum(counts) - counts)[entry_films]
+
+def get_bubble_frame(film_view: FilmView, film_rows, row_films, name_column: str, names, index):
+
+    films = film_view.films
+
+    return pd.DataFrame({
+        'REVENUE': films['REVENUE'].to_numpy()[film_rows[row_films]],
+        'YEAR': films['YEAR'].to_numpy()[film_rows[row_films]],
+        'AVERAGE_SCORE': films['AVERAGE_SCORE'].to_numpy()[film_rows[row_films]],
+        name_column: names
+    }, index=pd.Index(index, dtype='int64'))
+
+def get_bubble_directors(film_view: FilmView, bubble_layout: tuple, top_directors: list):
+
+    film_rows, entries, counts, pair_starts = bubble_layout
+    director_names = film_view.films['DIRECTOR_NAME'].cat
+
+    # Each film of a top director keeps one row per genre and actor pair, without pairing the names
+    top_codes = director_names.categories.get_indexer(top_directors)
+    top_films = np.flatnonzero(np.isin(director_names.codes.to_numpy()[film_rows], top_codes))
+    repeats = (counts[BRIDGE_GENRES_KEY] * counts[BRIDGE_ACTORS_KEY])[top_films]
+
+    row_films = np.repeat(top_films, repeats)
+    names = np.asarray(director_names.categories)[director_names.codes.to_numpy()[film_rows[row_films]]]
+
+    return get_bubble_frame(film_view, film_rows, row_films, 'DIRECTOR_NAME', names, get_ranges(pair_starts[top_films], repeats))
+
+def get_bubble_actors(film_view: FilmView, bubble_layout: tuple, top_actors: list):
+
+    film_rows, entries, counts, pair_starts = bubble_layout
+    actor_entries, actor_films = entries[BRIDGE_ACTORS_KEY]
+    actors = film_view.bridges[BRIDGE_ACTORS_KEY]
+
+    # Only the actors in the top are repeated, once per genre of their film
+    actor_ranks = get_entry_ranks(actor_films, counts[BRIDGE_ACTORS_KEY])
+    top = np.flatnonzero(np.isin(actors.names.codes[actor_entries], actors.names.categories.get_indexer(top_actors)))
+    repeats = counts[BRIDGE_GENRES_KEY][actor_films[top]]
+
+    row_entries = np.repeat(top, repeats)
+    row_genres = get_ranges(np.zeros(len(top), dtype=np.int64), repeats)
+    index = pair_starts[actor_films[row_entries]] + row_genres * counts[BRIDGE_ACTORS_KEY][actor_films[row_entries]] + actor_ranks[row_entries]
+
+    order = np.argsort(index, kind='stable')
+    row_entries, index = row_entries[order], index[order]
+
+    return get_bubble_frame(film_view, film_rows, actor_films[row_entries], 'ACTOR_NAME', actors.get_names(actor_entries[row_entries]), index)
+
+def get_bubble_genres(film_view: FilmView, bubble_layout: tuple, top_genres: list):
+
+    film_rows, entries, counts, pair_starts = bubble_layout
+    genre_entries, genre_films = entries[BRIDGE_GENRES_KEY]
+    genres = film_view.bridges[BRIDGE_GENRES_KEY]
+
+    # The rows of a genre only differ by actor, so the first pair of each film and genre is the one left by drop_duplicates
+    genre_ranks = get_entry_ranks(genre_films, counts[BRIDGE_GENRES_KEY])
+    top = np.flatnonzero(np.isin(genres.names.codes[genre_entries], genres.names.categories.get_indexer(top_genres)) & (counts[BRIDGE_ACTORS_KEY][genre_films] > 0))
+    index = pair_starts[genre_films[top]] + genre_ranks[top] * counts[BRIDGE_ACTORS_KEY][genre_films[top]]
+
+    bubble_genres = get_bubble_frame(film_view, film_rows, genre_films[top], 'GENRE_NAME', genres.get_names(genre_entries[top]), index)
+
+    return bubble_genres.drop_duplicates()
+
+def get_top_metrics_data(snapshot: WarehouseSnapshot, masks: dict):
+
+    get_table = lambda table_name: get_masked_table(snapshot, masks, table_name)
+    fact_table = get_table(FACT_TABLE_KEY)
 
-    merged_fact_table = fact_table.merge(bridge_genres, on='FILM_RANK')
-    merged_fact_table = merged_fact_table.merge(dim_genres, on='GENRE_ID')
+    # Methods for horizontal graphs
+    top_directors_columns = ['FILM_RANK', 'DIRECTOR_ID', 'REVENUE', 'USER_SCORE']
+    top_directors_data = get_top_directors(get_table(DIM_DIRECTORS_KEY), fact_table[top_directors_columns])
 
-    return merged_fact_table
+    top_genres_columns = ['FILM_RANK', 'BRIDGE_GENRE_ID', 'REVENUE', 'USER_SCORE']
+    top_genres_data = get_top_genres(get_table(DIM_GENRES_KEY), get_table(BRIDGE_GENRES_KEY), fact_table[top_genres_columns])
 
-def get_merged_actors(dim_actors: pd.DataFrame, bridge_actors: pd.DataFrame, fact_table: pd.DataFrame):
+    top_actors_columns = ['FILM_RANK', 'BRIDGE_ACTOR_ID', 'REVENUE', 'USER_SCORE']
+    top_actors_data = get_top_actors(get_table(DIM_ACTORS_KEY), get_table(BRIDGE_ACTORS_KEY), fact_table[top_actors_columns])
 
-    merged_fact_table = fact_table.merge(bridge_actors, on='FILM_RANK')
-    merged_fact_table = merged_fact_table.merge(dim_actors, on='ACTOR_ID')
+    # Methods for bubble graphs, each one only reads the bridge it draws from the film view of the snapshot
+    bubble_layout = get_bubble_layout(snapshot.film_view, masks)
 
-    return merged_fact_table
+    fact_table_directors = get_bubble_directors(snapshot.film_view, bubble_layout, list(top_directors_data['DIRECTOR_NAME']))
+    fact_table_genres = get_bubble_genres(snapshot.film_view, bubble_layout, list(top_genres_data['GENRE_NAME']))
+    fact_table_actors = get_bubble_actors(snapshot.film_view, bubble_layout, list(top_actors_data['ACTOR_NAME']))
 
-def get_merged_directors(dim_director: pd.DataFrame, fact_table: pd.DataFrame):
+    return {
+        'top_directors': top_directors_data,
+        'top_genres': top_genres_data,
+        'top_actors': top_actors_data,
+        'bubble_directors': fact_table_directors,
+        'bubble_genres': fact_table_genres,
+        'bubble_actors': fact_table_actors
+    }
 
-    merged_fact_table = fact_table.merge(dim_director, on='DIRECTOR_ID')
-    return merged_fact_table
+def warm_filter_result_cache(snapshot: WarehouseSnapshot):
 
-def get_merged_years(dim_year: pd.DataFrame, fact_table: pd.DataFrame):
+    # The default filters are the first ones every session sees, so their results are computed before any session asks
+    # Same range as the revenue slider before the user moves it
+    selection = get_default_selection(snapshot.year_ids_list, 0.0, snapshot.max_revenue)
+    signature = get_filter_signature(selection)
 
-    merged_fact_table = fact_table.merge(dim_year, on='YEAR_ID')
-    return merged_fact_table
+    masks = get_snapshot_result(snapshot, signature, FILTER_MASKS_KEY, lambda: snapshot.filter_engine.get_masks(selection))
+    get_table = lambda table_name: get_masked_table(snapshot, masks, table_name)
 
-def get_average_score(fact_table: pd.DataFrame):
+    get_snapshot_result(snapshot, signature, YEAR_STATE_DATA_KEY, lambda: get_routed_year_state_data(snapshot, selection, get_table))
+    get_snapshot_result(snapshot, signature, TOP_METRICS_DATA_KEY, lambda: get_top_metrics_data(snapshot, masks))
 
-    fact_table['AVERAGE_SCORE'] = fact_table[['USER_SCORE', 'CRITIC_SCORE']].mean(axis=1)
-    return fact_table
\ No newline at end of file
+    get_filter_result_cache().log_metrics()
@@ -8,11 +8,17 @@
 
 from dotenv import load_dotenv
 import os
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock, Timer
 import psycopg2 as psy
+import psycopg2.extensions
+import psycopg2.pool
 import snowflake.connector
+import streamlit as st
 from utilities_navigation import get_login_state, get_credentials
 import logging as log
-from global_parameters import LOGGER_DB_CONNECTIONS_KEY
+from global_parameters import LOGGER_DB_CONNECTIONS_KEY, SNOW_SESSION_KEY, SNOW_SESSION_IDLE_TIMEOUT, SNOW_KEEP_ALIVE_FREQUENCY, PSQL_POOL_MIN_SIZE, PSQL_POOL_MAX_SIZE, PSQL_POOL_IDLE_TIMEOUT, PSQL_POOL_CHECKOUT_TIMEOUT, PSQL_POOL_PING_AFTER
 
 logger_db_conn = log.getLogger(LOGGER_DB_CONNECTIONS_KEY)
 load_dotenv()
@@ -37,6 +43,11 @@ def raise_psql_error(psql_error):
     logger_db_conn.error(f"[ERROR] An error has occurred in Postgresql:\n\t- Msg: {psql_error.pgerror}\n\t- Error Code: {psql_error.pgcode}")
     raise psql_error
 
+def raise_pool_timeout_error(timeout: float):
+    pool_error = psy.pool.PoolError(f'No connection of the local PostgreSQL pool was released in {timeout} seconds.')
+    logger_db_conn.error(f"[ERROR] An error has occurred in the PostgreSQL pool:\n\t- Msg: {pool_error}")
+    raise pool_error
+
 def raise_missing_env_variable(key_error: KeyError):
     logger_db_conn.error(f"[ERROR] An getenvment Variable was not configured:\n\t- Msg: {key_error}")
     raise key_error
@@ -63,6 +74,90 @@ def get_snow_config():
     
     return config
 
+def open_snow_connection(config: dict):
+
+    # The database, schema and warehouse are set by the login request itself, so no USE statement is needed
+    conn = snowflake.connector.connect(**config, client_session_keep_alive=True, client_session_keep_alive_heartbeat_frequency=SNOW_KEEP_ALIVE_FREQUENCY)
+
+    # Snowflake ignores the ones the user can not use, so the session info returned by the login is checked instead
+    expected_context = [str(config[key]).upper() for key in ['database', 'schema', 'warehouse']]
+    session_context = [str(value).upper() for value in [conn.database, conn.schema, conn.warehouse]]
+
+    if session_context != expected_context:
+        conn.close()
+        raise snowflake.connector.errors.DatabaseError(msg=f"The user can not use the database, schema or warehouse configured: {', '.join(expected_context)}")
+
+    return conn
+
+class SnowSession:
+
+    # The connection is authenticated once and shared by the login, the privileges check and the downloads of the session
+    def __init__(self, config: dict, idle_timeout: float = SNOW_SESSION_IDLE_TIMEOUT):
+        self.config = config
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.conn = None
+        self.users = 0
+        self.idle_timer = None
+
+    def get_connection(self):
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+
+            if self.conn is None or self.conn.is_closed():
+                self.conn = open_snow_connection(self.config)
+
+            self.users += 1
+            return self.conn
+
+    def release_connection(self, conn):
+        with self.lock:
+            if conn is not self.conn:
+                close_snow_connection(conn)
+                return
+
+            self.users -= 1
+
+            # The keep-alive stops the token from expiring, so the idle connections are closed by a timer
+            if self.users == 0:
+                self.idle_timer = Timer(self.idle_timeout, self.close_if_idle)
+                self.idle_timer.daemon = True
+                self.idle_timer.start()
+
+    def close_if_idle(self):
+        with self.lock:
+            if self.users > 0 or self.conn is None:
+                return
+
+            conn, self.conn = self.conn, None
+
+        logger_db_conn.info(f"[INFO] The Snowflake connection was idle for {self.idle_timeout} s")
+        close_snow_connection(conn)
+
+    def close(self):
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+
+            conn, self.conn = self.conn, None
+
+        if conn is not None:
+            close_snow_connection(conn)
+
+def get_snow_session():
+    return st.session_state.get(SNOW_SESSION_KEY)
+
+def set_snow_session(snow_session: SnowSession):
+    previous_session = get_snow_session()
+
+    if previous_session is not None:
+        previous_session.close()
+
+    st.session_state[SNOW_SESSION_KEY] = snow_session
+
 def validate_credentials(username, password):
     try:
 
@@ -70,15 +165,11 @@ def validate_credentials(username, password):
         config['user'] = username
         config['password'] = password
 
-        conn = snowflake.connector.connect(**config)
+        # The connection opened to validate the credentials is kept for the rest of the session
+        snow_session = SnowSession(config)
+        snow_session.release_connection(snow_session.get_connection())
+        set_snow_session(snow_session)
 
-        cursor = conn.cursor()
-        cursor.execute(f'USE DATABASE {conn.database};')
-        cursor.execute(f'USE WAREHOUSE {conn.warehouse};')
-        cursor.execute(f'USE SCHEMA {conn.database}.{conn.schema};')
-        cursor.close()
-                
-        close_snow_connection(conn)
         return True
     
     except snowflake.connector.errors.DatabaseError:
@@ -109,32 +200,43 @@ def create_snow_connection():
         logger_db_conn.info("\n----------- Creating a connection to the Snowflake Account -----------")
 
         if get_login_state():
-            
-            config = get_snow_config()
-            config['user'], config['password'] = get_credentials()
-            conn = snowflake.connector.connect(**config)
 
-            cursor = conn.cursor()
-            cursor.execute(f'USE DATABASE {conn.database};')
-            cursor.execute(f'USE WAREHOUSE {conn.warehouse};')
-            cursor.execute(f'USE SCHEMA {conn.database}.{conn.schema};')
-            cursor.close()
+            snow_session = get_snow_session()
+
+            if snow_session is None:
+                config = get_snow_config()
+                config['user'], config['password'] = get_credentials()
+                snow_session = SnowSession(config)
+                set_snow_session(snow_session)
+
+            conn = snow_session.get_connection()
 
         else:
             raise_login_error()
         
-    except snowflake.connector.errors as snowflake_error:
-        close_snow_connection(conn)
+    # The connection belongs to the session, and a failed one is never handed out, so there is nothing to close here
+    except snowflake.connector.errors.Error as snowflake_error:
         raise_snowflake_error(snowflake_error)
     
     except Exception as unknown_error:
-        close_snow_connection(conn)
         raise_unknown_error(unknown_error)
 
     else:
         logger_db_conn.info(f"[SUCCESS] Connected to the account: {conn.account} with user {conn.user}, using the database {conn.database} and the warehouse {conn.warehouse}")
         return conn
     
+def release_snow_connection(conn):
+
+    # Once the user logs out the session is gone, so the connection is just closed
+    snow_session = get_snow_session()
+
+    if conn is None:
+        logger_db_conn.error("[ERROR] Not a valid connection to release.")
+    elif snow_session is None:
+        close_snow_connection(conn)
+    else:
+        snow_session.release_connection(conn)
+
 def close_snow_connection(conn):
     if(conn is not None):
         logger_db_conn.info("\n----------- Closing the connection with the Snowflake Account -----------")
@@ -198,3 +300,171 @@ def close_psql_connection(conn):
         logger_db_conn.info("[SUCCESS] Connection to PostgreSQL closed successfully.")
     else:
         logger_db_conn.error("[ERROR] Not a valid connection to close.")
+
+# -----------------------------------------------------------------------
+#                      POSTGRESQL CONNECTION POOL
+# -----------------------------------------------------------------------
+
+class PsqlConnectionPool:
+
+    # Connections are only checked when they are taken, so returning one to the pool costs no round trip
+    def __init__(self, min_size: int = PSQL_POOL_MIN_SIZE, max_size: int = PSQL_POOL_MAX_SIZE, idle_timeout: float = PSQL_POOL_IDLE_TIMEOUT,
+                 checkout_timeout: float = PSQL_POOL_CHECKOUT_TIMEOUT, ping_after: float = PSQL_POOL_PING_AFTER, connection_factory=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self.connection_factory = create_psql_connection if connection_factory is None else connection_factory
+
+        self.condition = Condition()
+        self.idle = []
+        self.size = 0
+        self.metrics = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'created': 0, 'closed': 0, 'evicted': 0, 'failed_checks': 0}
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except psy.Error:
+            pass
+
+        with self.condition:
+            self.size -= 1
+            self.metrics['closed'] += 1
+            self.condition.notify()
+
+    def evict_idle_connections(self):
+
+        # The oldest connections are at the start of the list, and the min size is always kept open
+        now = time.monotonic()
+        evicted = []
+
+        with self.condition:
+            while self.size - len(evicted) > self.min_size and len(self.idle) > 0 and now - self.idle[0][1] > self.idle_timeout:
+                evicted.append(self.idle.pop(0)[0])
+            self.metrics['evicted'] += len(evicted)
+
+        for conn in evicted:
+            self.close_connection(conn)
+
+    def is_healthy(self, conn, idle_time: float):
+
+        if conn.closed or conn.get_transaction_status() != psy.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        # Only the connections idle for a while can have been dropped by the server
+        if idle_time > self.ping_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psy.Error:
+                return False
+
+        return True
+
+    def get_connection(self):
+
+        self.evict_idle_connections()
+        start_time = time.monotonic()
+        waited = False
+
+        while True:
+            with self.condition:
+                while len(self.idle) == 0 and self.size >= self.max_size:
+                    waited = True
+                    remaining = self.checkout_timeout - (time.monotonic() - start_time)
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        raise_pool_timeout_error(self.checkout_timeout)
+
+                if len(self.idle) > 0:
+                    conn, last_used = self.idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self.size += 1
+
+            if conn is None:
+                try:
+                    conn = self.connection_factory()
+                except Exception as error:
+                    with self.condition:
+                        self.size -= 1
+                        self.condition.notify()
+                    raise error
+
+                with self.condition:
+                    self.metrics['created'] += 1
+                break
+
+            if self.is_healthy(conn, time.monotonic() - last_used):
+                break
+
+            with self.condition:
+                self.metrics['failed_checks'] += 1
+            self.close_connection(conn)
+
+        with self.condition:
+            self.metrics['checkouts'] += 1
+            if waited:
+                self.metrics['waits'] += 1
+                self.metrics['wait_time'] += time.monotonic() - start_time
+
+        return conn
+
+    def put_connection(self, conn):
+
+        # Unfinished transactions are discarded, so the next user always gets a clean connection
+        if not conn.closed and conn.get_transaction_status() != psy.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psy.Error:
+                pass
+
+        if conn.closed or conn.get_transaction_status() != psy.extensions.TRANSACTION_STATUS_IDLE:
+            self.close_connection(conn)
+        else:
+            with self.condition:
+                self.idle.append((conn, time.monotonic()))
+                self.condition.notify()
+
+        self.evict_idle_connections()
+
+    def get_metrics(self):
+        with self.condition:
+            return {'size': self.size, 'active': self.size - len(self.idle), 'idle': len(self.idle), **self.metrics}
+
+    def log_metrics(self):
+        metrics = self.get_metrics()
+        logger_db_conn.info(f"[INFO] PostgreSQL pool: {metrics['active']} active and {metrics['idle']} idle connections, {metrics['checkouts']} checkouts, "
+                            f"{metrics['waits']} waits ({metrics['wait_time']:.2f} s), {metrics['created']} created, {metrics['evicted']} evicted and {metrics['failed_checks']} failed checks")
+
+    def close_all(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+
+        for conn, last_used in idle:
+            self.close_connection(conn)
+
+@st.cache_resource(show_spinner=False)
+def get_psql_pool():
+    return PsqlConnectionPool()
+
+def get_psql_connection():
+    if not get_login_state():
+        raise_login_error()
+
+    return get_psql_pool().get_connection()
+
+def release_psql_connection(conn):
+    if(conn is not None):
+        get_psql_pool().put_connection(conn)
+    else:
+        logger_db_conn.error("[ERROR] Not a valid connection to release.")
+
+@contextmanager
+def psql_connection():
+    conn = get_psql_connection()
+    try:
+        yield conn
+    finally:
+        release_psql_connection(conn)
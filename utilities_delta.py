@@ -0,0 +1,240 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                           UTILITIES DELTA
+#   Sums and counts of the filtered films by year and by category, kept
+#   by each session and updated with the films of the filters it toggles.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+from utilities_filters import get_positions, get_lookup
+from utilities_star import get_ranges
+from global_parameters import *
+
+# Columns filtered by a list of values, in the order their changes are applied
+DELTA_FILTER_COLUMNS = ['YEAR_ID', 'GENRE_ID', 'USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY']
+DELTA_COUNT_COLUMNS = ['USER_SCORE_CATEGORY', 'CRITIC_SCORE_CATEGORY', 'USER_VOTES_CATEGORY', 'REVENUE_CATEGORY']
+DELTA_MEASURES = ['USER_SCORE', 'CRITIC_SCORE', 'REVENUE', 'USER_VOTES']
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_category_codes(values: pd.Series):
+
+    # Same sorted categories as the compact store, and the films without a category get the last code
+    categories = sorted(pd.Series(values).dropna().unique())
+    codes = pd.Categorical(values, categories=categories).codes.astype(np.int32)
+    codes[codes < 0] = len(categories)
+
+    return codes, np.asarray(categories, dtype=object)
+
+def get_row_groups(codes, size: int):
+
+    # Like a CSR matrix: the films with the code i are the ones between offsets[i] and offsets[i + 1] of the order
+    order = np.argsort(codes, kind='stable').astype(np.int32)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=size), out=offsets[1:])
+
+    return order, offsets
+
+def get_score_lookup(categories, max_score: str):
+
+    # Without a valid ceiling every film is kept, also the ones without a category
+    if max_score not in SCORE_OPTIONS:
+        return get_lookup(len(categories))
+
+    return np.append(np.isin(categories, SCORE_OPTIONS[:SCORE_OPTIONS.index(max_score) + 1]), False)
+
+# -----------------------------------------------------------------------
+#                          FILTER AGGREGATES
+# -----------------------------------------------------------------------
+
+class FilterAggregates:
+
+    # Totals of the films of one selection, never modified once built so a session can keep them between reruns
+    def __init__(self, selection: dict, lookups: dict, year_sums, year_counts, category_counts: dict):
+        self.selection = selection
+        self.lookups = lookups
+        self.year_sums = year_sums
+        self.year_counts = year_counts
+        self.category_counts = category_counts
+
+    def is_same_revenue(self, selection: dict):
+        return (self.selection['min_revenue'], self.selection['max_revenue']) == (selection['min_revenue'], selection['max_revenue'])
+
+# -----------------------------------------------------------------------
+#                          FILTER DELTA ENGINE
+# -----------------------------------------------------------------------
+
+class FilterDeltaEngine:
+
+    # Codes of every film of the fact table, and the films of each value of the filtered columns
+    def __init__(self, codes: dict, categories: dict, revenue, measures, groups: dict, year_ids, years, genre_names):
+        self.codes = codes
+        self.categories = categories
+        self.revenue = revenue
+        self.measures = measures
+        self.groups = groups
+        self.year_ids = year_ids
+        self.years = years
+        self.genre_names = genre_names
+
+    @classmethod
+    def build(cls, tables: dict):
+
+        dim_years = tables[DIM_YEARS_KEY]
+        dim_genres = tables[DIM_GENRES_KEY]
+        bridge_genres = tables[BRIDGE_GENRES_KEY]
+        fact_table = tables[FACT_TABLE_KEY]
+
+        # The genre of a film is the one of its bridge row, as in the bitmap index of the filters
+        bridge_positions = get_positions(fact_table['BRIDGE_GENRE_ID'], bridge_genres['BRIDGE_GENRE_ID'])
+        genre_positions = np.append(get_positions(bridge_genres['GENRE_ID'], dim_genres['GENRE_ID']), len(dim_genres))
+
+        codes = {
+            'YEAR_ID': get_positions(fact_table['YEAR_ID'], dim_years['YEAR_ID']).astype(np.int32),
+            'GENRE_ID': genre_positions[bridge_positions].astype(np.int32)
+        }
+
+        categories = {}
+        for column in DELTA_COUNT_COLUMNS:
+            codes[column], categories[column] = get_category_codes(fact_table[column])
+
+        sizes = {'YEAR_ID': len(dim_years) + 1, 'GENRE_ID': len(dim_genres) + 1, **{column: len(categories[column]) + 1 for column in categories}}
+        groups = {column: get_row_groups(codes[column], sizes[column]) for column in DELTA_FILTER_COLUMNS}
+
+        measures = fact_table[DELTA_MEASURES].to_numpy(dtype=np.float64)
+
+        return cls(codes, categories, fact_table['REVENUE'].to_numpy(dtype=np.float64), measures, groups, dim_years['YEAR_ID'].to_numpy(), dim_years['YEAR'].to_numpy(), dim_genres['GENRE_NAME'].to_numpy())
+
+    @property
+    def rows(self):
+        return len(self.revenue)
+
+    def get_lookups(self, selection: dict):
+
+        genre_lookup = get_lookup(len(self.genre_names)) if selection['genres'] is None else get_lookup(len(self.genre_names), np.flatnonzero(np.isin(self.genre_names, selection['genres'])))
+
+        return {
+            'YEAR_ID': get_lookup(len(self.year_ids), np.flatnonzero(np.isin(self.year_ids, selection['year_ids']))),
+            'GENRE_ID': genre_lookup,
+            'USER_SCORE_CATEGORY': get_score_lookup(self.categories['USER_SCORE_CATEGORY'], selection['max_user_score']),
+            'CRITIC_SCORE_CATEGORY': get_score_lookup(self.categories['CRITIC_SCORE_CATEGORY'], selection['max_critic_score'])
+        }
+
+    def get_revenue_mask(self, selection: dict, rows=None):
+
+        revenue = self.revenue if rows is None else self.revenue[rows]
+        mask = revenue >= selection['min_revenue']
+
+        if selection['max_revenue'] is not None:
+            mask &= revenue <= selection['max_revenue']
+
+        return mask
+
+    def get_totals(self, rows, weights):
+
+        year_codes = self.codes['YEAR_ID'][rows]
+        year_size = len(self.year_ids) + 1
+
+        # Without rows bincount gives ints, so the totals are always cast to add them up later
+        year_counts = np.bincount(year_codes, weights=weights, minlength=year_size).astype(np.float64, copy=False)
+        year_sums = np.column_stack([np.bincount(year_codes, weights=weights * self.measures[rows, i], minlength=year_size) for i in range(len(DELTA_MEASURES))]).astype(np.float64, copy=False)
+        category_counts = {column: np.bincount(self.codes[column][rows], weights=weights, minlength=len(self.categories[column]) + 1).astype(np.float64, copy=False) for column in DELTA_COUNT_COLUMNS}
+
+        return year_sums, year_counts, category_counts
+
+    def get_full_aggregates(self, selection: dict):
+
+        lookups = self.get_lookups(selection)
+        mask = self.get_revenue_mask(selection)
+
+        for column in DELTA_FILTER_COLUMNS:
+            mask &= lookups[column][self.codes[column]]
+
+        rows = np.flatnonzero(mask)
+
+        return FilterAggregates(selection, lookups, *self.get_totals(rows, np.ones(len(rows))))
+
+    def get_delta_aggregates(self, aggregates: FilterAggregates, selection: dict):
+
+        # A new revenue range changes films of every value, so it is the only filter without a delta
+        if not aggregates.is_same_revenue(selection):
+            return None
+
+        lookups = dict(aggregates.lookups)
+        new_lookups = self.get_lookups(selection)
+        changed_codes = {column: np.flatnonzero(lookups[column] != new_lookups[column]) for column in DELTA_FILTER_COLUMNS}
+
+        # The films of the toggled values are read in random order, so past a share of the table one pass over every film is faster
+        order_offsets = {column: self.groups[column][1] for column in DELTA_FILTER_COLUMNS}
+        delta_rows = sum(int((order_offsets[column][codes + 1] - order_offsets[column][codes]).sum()) for column, codes in changed_codes.items())
+
+        if delta_rows > DELTA_MAX_ROWS_FRACTION * self.rows:
+            return None
+
+        year_sums, year_counts = aggregates.year_sums.copy(), aggregates.year_counts.copy()
+        category_counts = {column: counts.copy() for column, counts in aggregates.category_counts.items()}
+
+        # Each changed column is applied with the others as they are at that moment, so several changes add up to the new selection
+        for column in DELTA_FILTER_COLUMNS:
+            if len(changed_codes[column]) == 0:
+                continue
+
+            order, offsets = self.groups[column]
+            rows = order[get_ranges(offsets[changed_codes[column]], offsets[changed_codes[column] + 1] - offsets[changed_codes[column]])]
+
+            keep = self.get_revenue_mask(selection, rows)
+            for other_column in DELTA_FILTER_COLUMNS:
+                if other_column != column:
+                    keep &= lookups[other_column][self.codes[other_column][rows]]
+
+            rows = rows[keep]
+            weights = np.where(new_lookups[column][self.codes[column][rows]], 1.0, -1.0)
+
+            delta_sums, delta_counts, delta_category_counts = self.get_totals(rows, weights)
+            year_sums += delta_sums
+            year_counts += delta_counts
+            for count_column in DELTA_COUNT_COLUMNS:
+                category_counts[count_column] += delta_category_counts[count_column]
+
+            lookups[column] = new_lookups[column]
+
+        return FilterAggregates(selection, lookups, year_sums, year_counts, category_counts)
+
+    def get_aggregates(self, selection: dict, aggregates: FilterAggregates = None):
+
+        if aggregates is not None:
+            delta_aggregates = self.get_delta_aggregates(aggregates, selection)
+
+            if delta_aggregates is not None:
+                return delta_aggregates
+
+        return self.get_full_aggregates(selection)
+
+    def get_year_totals(self, aggregates: FilterAggregates):
+
+        # The counts are whole numbers even after many deltas, so the years without films are the ones at zero
+        found = np.flatnonzero(np.rint(aggregates.year_counts[:-1]) > 0)
+        counts = aggregates.year_counts[found]
+
+        year_totals = pd.DataFrame({measure: aggregates.year_sums[found, i] / counts for i, measure in enumerate(DELTA_MEASURES)})
+        year_totals.insert(0, 'YEAR_ID', self.year_ids[found])
+        year_totals['YEAR'] = self.years[found].astype(np.float64, copy=False)
+
+        return year_totals.sort_values('YEAR_ID').reset_index(drop=True)
+
+    def get_category_counts(self, aggregates: FilterAggregates, column: str):
+
+        counts = np.rint(aggregates.category_counts[column][:-1]).astype(np.int64)
+        found = np.flatnonzero(counts > 0)
+
+        return pd.DataFrame({column: self.categories[column][found], 'COUNT': counts[found]})
+
+    def memory_usage(self):
+        codes_bytes = sum(codes.nbytes for codes in self.codes.values())
+        groups_bytes = sum(order.nbytes + offsets.nbytes for order, offsets in self.groups.values())
+
+        return codes_bytes + groups_bytes + self.revenue.nbytes + self.measures.nbytes
@@ -0,0 +1,248 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                          UTILITIES FILTERS
+#   In-memory filter engine of the snapshot, used by the sidebar to
+#   filter the tables with NumPy masks instead of querying PostgreSQL.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from global_parameters import *
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_positions(values, index_values):
+
+    # Values missing from the referenced table point to the last position, which is never selected
+    positions = pd.Index(index_values).get_indexer(values)
+    positions[positions < 0] = len(index_values)
+
+    return positions.astype(np.min_scalar_type(len(index_values)))
+
+def get_lookup(size: int, selected_positions=None):
+
+    # One extra position for the values missing from the referenced table
+    lookup = np.zeros(size + 1, dtype=bool)
+
+    if selected_positions is None:
+        lookup[:size] = True
+    else:
+        lookup[selected_positions] = True
+
+    return lookup
+
+def get_default_selection(year_ids: list, min_revenue: float, max_revenue: float):
+
+    # Filters of the sidebar before the user changes any widget
+    return {
+        'year_ids': list(year_ids),
+        'genres': None,
+        'min_revenue': min_revenue,
+        'max_revenue': max_revenue,
+        'max_user_score': SCORE_OPTIONS[-1],
+        'max_critic_score': SCORE_OPTIONS[-1]
+    }
+
+# -----------------------------------------------------------------------
+#                            BITMAP INDEX
+# -----------------------------------------------------------------------
+
+class RowBitmap:
+
+    # Like the containers of a roaring bitmap: sparse values keep their sorted rows, dense ones a packed bitmap
+    def __init__(self, rows: int, positions=None, packed=None):
+        self.rows = rows
+        self.positions = positions
+        self.packed = packed
+
+    @classmethod
+    def from_positions(cls, rows: int, positions):
+        if len(positions) * 32 < rows:
+            return cls(rows, positions=positions.astype(np.uint32))
+
+        mask = np.zeros(rows, dtype=bool)
+        mask[positions] = True
+
+        return cls(rows, packed=np.packbits(mask))
+
+    def get_packed(self):
+        if self.packed is not None:
+            return self.packed
+
+        mask = np.zeros(self.rows, dtype=bool)
+        mask[self.positions] = True
+
+        return np.packbits(mask)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes if self.packed is not None else self.positions.nbytes
+
+class BitmapIndex:
+
+    # Bitmaps of the fact rows for every value of the filtered columns, and the rows sorted by revenue for the ranges
+    def __init__(self, rows: int, bitmaps: dict, revenue_positions, revenue_values):
+        self.rows = rows
+        self.bitmaps = bitmaps
+        self.revenue_positions = revenue_positions
+        self.revenue_values = revenue_values
+
+    @classmethod
+    def build(cls, tables: dict):
+
+        bridge_genres = tables[BRIDGE_GENRES_KEY]
+        fact_table = tables[FACT_TABLE_KEY]
+        rows = len(fact_table)
+
+        # The genres are reached through the bridge row of each film, films without one get no genre
+        fact_genre_ids = fact_table['BRIDGE_GENRE_ID'].map(pd.Series(bridge_genres['GENRE_ID'].to_numpy(), index=bridge_genres['BRIDGE_GENRE_ID']))
+
+        columns = {
+            'YEAR_ID': fact_table['YEAR_ID'],
+            'GENRE_ID': fact_genre_ids,
+            'USER_SCORE_CATEGORY': fact_table['USER_SCORE_CATEGORY'],
+            'CRITIC_SCORE_CATEGORY': fact_table['CRITIC_SCORE_CATEGORY']
+        }
+
+        bitmaps = {}
+        for column, values in columns.items():
+            codes, uniques = pd.factorize(values)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+            # Genre ids become floats when some film has no bridge row, so every value is kept as text
+            bitmaps[column] = {get_value_key(value): RowBitmap.from_positions(rows, order[bounds[i]:bounds[i + 1]]) for i, value in enumerate(uniques)}
+
+        revenue = fact_table['REVENUE'].to_numpy(dtype=np.float64)
+        revenue_positions = np.argsort(revenue, kind='stable').astype(np.uint32)
+
+        return cls(rows, bitmaps, revenue_positions, revenue[revenue_positions])
+
+    def get_union(self, column: str, values: list):
+
+        bitmaps = [self.bitmaps[column][get_value_key(value)] for value in values if get_value_key(value) in self.bitmaps[column]]
+
+        if len(bitmaps) == 0:
+            return np.zeros((self.rows + 7) // 8, dtype=np.uint8)
+
+        return np.bitwise_or.reduce([bitmap.get_packed() for bitmap in bitmaps])
+
+    def get_revenue_range(self, min_revenue: float, max_revenue: float = None):
+
+        start = np.searchsorted(self.revenue_values, min_revenue, side='left')
+        end = np.searchsorted(self.revenue_values, np.inf if max_revenue is None else max_revenue, side='right')
+
+        # Only the smaller side of the range is written, the rows inside or the rows outside it
+        if end - start <= self.rows // 2:
+            mask = np.zeros(self.rows, dtype=bool)
+            mask[self.revenue_positions[start:end]] = True
+        else:
+            mask = np.ones(self.rows, dtype=bool)
+            mask[self.revenue_positions[:start]] = False
+            mask[self.revenue_positions[end:]] = False
+
+        return np.packbits(mask)
+
+    def get_mask(self, selection: dict, genre_ids: list):
+
+        packed = self.get_revenue_range(selection['min_revenue'], selection['max_revenue'])
+        np.bitwise_and(packed, self.get_union('YEAR_ID', selection['year_ids']), out=packed)
+        np.bitwise_and(packed, self.get_union('GENRE_ID', genre_ids), out=packed)
+
+        for column, max_score in [('USER_SCORE_CATEGORY', selection['max_user_score']), ('CRITIC_SCORE_CATEGORY', selection['max_critic_score'])]:
+            if max_score in SCORE_OPTIONS:
+                np.bitwise_and(packed, self.get_union(column, SCORE_OPTIONS[:SCORE_OPTIONS.index(max_score) + 1]), out=packed)
+
+        return np.unpackbits(packed, count=self.rows).view(bool)
+
+    def memory_usage(self):
+        bitmaps_bytes = sum(bitmap.nbytes for column_bitmaps in self.bitmaps.values() for bitmap in column_bitmaps.values())
+
+        return bitmaps_bytes + self.revenue_positions.nbytes + self.revenue_values.nbytes
+
+    def to_arrow(self):
+
+        bitmap_rows = [(column, value, bitmap) for column, column_bitmaps in self.bitmaps.items() for value, bitmap in column_bitmaps.items()]
+
+        bitmaps_table = pa.table({
+            'column': pa.array([row[0] for row in bitmap_rows], type=pa.string()),
+            'value': pa.array([row[1] for row in bitmap_rows], type=pa.string()),
+            'positions': pa.array([row[2].positions for row in bitmap_rows], type=pa.list_(pa.uint32())),
+            'packed': pa.array([None if row[2].packed is None else row[2].packed.tobytes() for row in bitmap_rows], type=pa.binary())
+        }).replace_schema_metadata({'rows': str(self.rows)})
+
+        revenue_table = pa.table({'position': self.revenue_positions, 'revenue': self.revenue_values})
+
+        return bitmaps_table, revenue_table
+
+    @classmethod
+    def from_arrow(cls, bitmaps_table: pa.Table, revenue_table: pa.Table):
+
+        rows = int(bitmaps_table.schema.metadata[b'rows'])
+        bitmaps_table = bitmaps_table.combine_chunks()
+        positions = bitmaps_table['positions'].chunk(0)
+        packed = bitmaps_table['packed'].chunk(0)
+
+        # The arrays keep pointing to the Arrow buffers, so a memory-mapped file is not copied
+        bitmaps = {}
+        for i, (column, value) in enumerate(zip(bitmaps_table['column'].to_pylist(), bitmaps_table['value'].to_pylist())):
+            if packed[i].is_valid:
+                bitmap = RowBitmap(rows, packed=np.frombuffer(packed[i].as_buffer(), dtype=np.uint8))
+            else:
+                bitmap = RowBitmap(rows, positions=positions[i].values.to_numpy())
+
+            bitmaps.setdefault(column, {})[value] = bitmap
+
+        return cls(rows, bitmaps, revenue_table['position'].to_numpy(), revenue_table['revenue'].to_numpy())
+
+def get_value_key(value):
+
+    # Same text for the ids read as int or float
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+
+    return str(value)
+
+# -----------------------------------------------------------------------
+#                            FILTER ENGINE
+# -----------------------------------------------------------------------
+
+class FilterEngine:
+
+    # The dimensions are filtered with lookups, and the fact table with the bitmap index of the snapshot
+    def __init__(self, tables: dict, bitmap_index: BitmapIndex = None):
+        dim_years = tables[DIM_YEARS_KEY]
+        dim_genres = tables[DIM_GENRES_KEY]
+        bridge_genres = tables[BRIDGE_GENRES_KEY]
+
+        self.year_ids = dim_years['YEAR_ID'].to_numpy()
+        self.genre_ids = dim_genres['GENRE_ID'].to_numpy()
+        self.genre_names = dim_genres['GENRE_NAME'].to_numpy()
+        self.bridge_genre_positions = get_positions(bridge_genres['GENRE_ID'], dim_genres['GENRE_ID'])
+
+        self.bitmap_index = BitmapIndex.build(tables) if bitmap_index is None else bitmap_index
+
+    def get_year_lookup(self, year_ids: list):
+        return get_lookup(len(self.year_ids), np.flatnonzero(np.isin(self.year_ids, year_ids)))
+
+    def get_genre_lookup(self, genre_names: list = None):
+        if genre_names is None:
+            return get_lookup(len(self.genre_names))
+
+        return get_lookup(len(self.genre_names), np.flatnonzero(np.isin(self.genre_names, genre_names)))
+
+    def get_masks(self, selection: dict):
+
+        year_lookup = self.get_year_lookup(selection['year_ids'])
+        genre_lookup = self.get_genre_lookup(selection['genres'])
+
+        return {
+            DIM_YEARS_KEY: year_lookup[:-1],
+            DIM_GENRES_KEY: genre_lookup[:-1],
+            BRIDGE_GENRES_KEY: genre_lookup.take(self.bridge_genre_positions),
+            FACT_TABLE_KEY: self.bitmap_index.get_mask(selection, list(self.genre_ids[genre_lookup[:-1]]))
+        }
@@ -0,0 +1,84 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                          UTILITIES ROLLUP
+#   Rollup cube of the fact table by year, genre and categories, built
+#   once per snapshot to answer the charts without reading every film.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+from global_parameters import *
+
+# -----------------------------------------------------------------------
+#                             ROLLUP CUBE
+# -----------------------------------------------------------------------
+
+class RollupCube:
+
+    # One cell for each combination of the dimensions found in the films, with the count, sum and mean of the measures
+    def __init__(self, cells: pd.DataFrame, genre_ids: pd.Series, years: pd.Series):
+        self.cells = cells
+        self.genre_ids = genre_ids
+        self.years = years
+
+    @classmethod
+    def build(cls, tables: dict):
+
+        dim_years = tables[DIM_YEARS_KEY]
+        dim_genres = tables[DIM_GENRES_KEY]
+        bridge_genres = tables[BRIDGE_GENRES_KEY]
+        fact_table = tables[FACT_TABLE_KEY]
+
+        # Same genre as the filters, the one of the bridge row of each film, so films without one are left out
+        fact_genre_ids = fact_table['BRIDGE_GENRE_ID'].map(pd.Series(bridge_genres['GENRE_ID'].to_numpy(), index=bridge_genres['BRIDGE_GENRE_ID']))
+
+        films = fact_table[[column for column in ROLLUP_CUBE_DIMENSIONS if column != 'GENRE_ID'] + ROLLUP_CUBE_MEASURES].assign(GENRE_ID=fact_genre_ids)
+        films = films[films['GENRE_ID'].notna()].astype({'GENRE_ID': 'int64'})
+
+        aggregations = {'FILM_COUNT': ('REVENUE', 'size'), 'REVENUE_MIN': ('REVENUE', 'min'), 'REVENUE_MAX': ('REVENUE', 'max')}
+        aggregations.update({f'{measure}_SUM': (measure, 'sum') for measure in ROLLUP_CUBE_MEASURES})
+
+        cells = films.groupby(ROLLUP_CUBE_DIMENSIONS, sort=True, observed=True).agg(**aggregations).reset_index()
+
+        for measure in ROLLUP_CUBE_MEASURES:
+            cells[f'{measure}_MEAN'] = cells[f'{measure}_SUM'] / cells['FILM_COUNT']
+
+        return cls(cells, pd.Series(dim_genres['GENRE_ID'].to_numpy(), index=dim_genres['GENRE_NAME']), pd.Series(dim_years['YEAR'].to_numpy(), index=dim_years['YEAR_ID']))
+
+    def get_cells(self, selection: dict):
+
+        cells = self.cells
+        mask = cells['YEAR_ID'].isin(selection['year_ids']).to_numpy()
+
+        if selection['genres'] is not None:
+            mask &= cells['GENRE_ID'].isin(self.genre_ids[self.genre_ids.index.isin(selection['genres'])]).to_numpy()
+
+        for column, max_score in [('USER_SCORE_CATEGORY', selection['max_user_score']), ('CRITIC_SCORE_CATEGORY', selection['max_critic_score'])]:
+            if max_score in SCORE_OPTIONS:
+                mask &= cells[column].isin(SCORE_OPTIONS[:SCORE_OPTIONS.index(max_score) + 1]).to_numpy()
+
+        min_revenue = selection['min_revenue']
+        max_revenue = np.inf if selection['max_revenue'] is None else selection['max_revenue']
+
+        inside = ((cells['REVENUE_MIN'] >= min_revenue) & (cells['REVENUE_MAX'] <= max_revenue)).to_numpy()
+        outside = ((cells['REVENUE_MAX'] < min_revenue) | (cells['REVENUE_MIN'] > max_revenue)).to_numpy()
+
+        # A cell with films on both sides of the revenue range cannot be split, so the filters need the fact table
+        if not (inside | outside)[mask].all():
+            return None
+
+        return cells[mask & inside]
+
+    def get_totals(self, cells: pd.DataFrame, column: str):
+
+        totals = cells.groupby(column, sort=True, observed=True)[['FILM_COUNT'] + [f'{measure}_SUM' for measure in ROLLUP_CUBE_MEASURES]].sum()
+
+        # The means of the group come from the sums of its cells, never from the means of the cells
+        for measure in ROLLUP_CUBE_MEASURES:
+            totals[measure] = totals[f'{measure}_SUM'] / totals['FILM_COUNT']
+
+        return totals
+
+    def memory_usage(self):
+        return int(self.cells.memory_usage(index=True, deep=True).sum())
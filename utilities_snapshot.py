@@ -0,0 +1,354 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                         UTILITIES SNAPSHOT
+#   Read-only copy of the IMDB_DWH tables shared by every session of the
+#   app, and the functions used by each session to filter it.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from functools import cached_property
+from threading import Lock
+import pyarrow as pa
+import pandas as pd
+import streamlit as st
+import logging as log
+from utilities_filters import FilterEngine, BitmapIndex
+from utilities_rollup import RollupCube
+from utilities_star import FilmView
+from utilities_delta import FilterDeltaEngine, FilterAggregates
+from utilities_store import get_table_memory
+from utilities_cache import get_filter_result_cache
+from global_parameters import *
+
+logger_snapshot = log.getLogger(LOGGER_SNAPSHOT_KEY)
+
+# -----------------------------------------------------------------------
+#                          SNAPSHOT OBJECT
+# -----------------------------------------------------------------------
+
+class WarehouseSnapshot:
+
+    # The tables are shared by all the sessions, so they must never be modified in place
+    def __init__(self, account: str, database: str, schema: str, version: str, tables: dict, stats: dict, bitmap_index: BitmapIndex = None):
+        self.key = (account, database, schema)
+        self.version = version
+        self.tables = tables
+        self.stats = stats
+        self.bitmap_index = bitmap_index
+
+    @property
+    def min_revenue(self):
+        return self.stats['ranges']['REVENUE'][0]
+
+    @property
+    def max_revenue(self):
+        return self.stats['ranges']['REVENUE'][1]
+
+    @property
+    def year_list(self):
+        return self.tables[DIM_YEARS_KEY]['YEAR']
+
+    @property
+    def year_ids_list(self):
+        return self.tables[DIM_YEARS_KEY]['YEAR_ID']
+
+    @property
+    def genre_list(self):
+        return self.tables[DIM_GENRES_KEY]['GENRE_NAME']
+
+    # Built by the first session that filters the snapshot, and shared by the rest
+    @cached_property
+    def filter_engine(self):
+        filter_engine = FilterEngine(self.tables, self.bitmap_index)
+        self.bitmap_index = filter_engine.bitmap_index
+
+        return filter_engine
+
+    # Rebuilt with every new snapshot, so it always holds the same films as the tables
+    @cached_property
+    def rollup_cube(self):
+        return RollupCube.build(self.tables)
+
+    @cached_property
+    def film_view(self):
+        return FilmView.build(self.tables)
+
+    @cached_property
+    def delta_engine(self):
+        return FilterDeltaEngine.build(self.tables)
+
+    def get_columns(self, table_name: str):
+        return list(self.tables[table_name].columns)
+
+    def memory_usage(self):
+        return {table_name: get_table_memory(table) for table_name, table in self.tables.items()}
+
+    def log_memory_usage(self):
+        memory_usage = self.memory_usage()
+        total_mb = sum(memory_usage.values()) / 2**20
+
+        logger_snapshot.info(f"[INFO] Snapshot {self.version} of {'.'.join(self.key)} uses {total_mb:.2f} MB:")
+        for table_name, table_bytes in memory_usage.items():
+            logger_snapshot.info(f"\t- {table_name}: {len(self.tables[table_name])} rows, {table_bytes / 2**20:.2f} MB")
+
+        if self.bitmap_index is not None:
+            logger_snapshot.info(f"\t- bitmap index: {self.bitmap_index.memory_usage() / 2**20:.2f} MB")
+
+        logger_snapshot.info(f"\t- rollup cube: {len(self.rollup_cube.cells)} cells, {self.rollup_cube.memory_usage() / 2**20:.2f} MB")
+        logger_snapshot.info(f"\t- film view: {self.film_view.memory_usage() / 2**20:.2f} MB")
+        logger_snapshot.info(f"\t- delta engine: {self.delta_engine.memory_usage() / 2**20:.2f} MB")
+
+def get_version_str(version: tuple):
+
+    # Snowflake and PostgreSQL return the same instant in their own time zone, so both are written in UTC
+    last_altered, row_count = version
+    if isinstance(last_altered, datetime):
+        last_altered = last_altered.astimezone(timezone.utc).isoformat()
+
+    return f'({last_altered}, {int(row_count)})'
+
+def get_data_version(table_versions: dict):
+
+    version_str = ';'.join([f'{table_name}={get_version_str(table_versions[table_name])}' for table_name in sorted(table_versions)])
+
+    return hashlib.sha1(version_str.encode('utf-8')).hexdigest()[:16]
+
+class SnapshotRegistry:
+
+    # Latest snapshot of each account, database and schema loaded in this process
+    def __init__(self):
+        self.lock = Lock()
+        self.build_locks = {}
+        self.snapshots = {}
+        self.refreshing = set()
+
+    def get(self, key: tuple):
+        with self.lock:
+            return self.snapshots.get(key)
+
+    def get_build_lock(self, key: tuple):
+        with self.lock:
+            return self.build_locks.setdefault(key, Lock())
+
+    def set(self, snapshot: WarehouseSnapshot):
+        with self.lock:
+            self.snapshots[snapshot.key] = snapshot
+
+    def start_refresh(self, key: tuple):
+        with self.lock:
+            if key in self.refreshing:
+                return False
+
+            self.refreshing.add(key)
+            return True
+
+    def end_refresh(self, key: tuple):
+        with self.lock:
+            self.refreshing.discard(key)
+
+@st.cache_resource(show_spinner=False)
+def get_snapshot_registry():
+    return SnapshotRegistry()
+
+# -----------------------------------------------------------------------
+#      DISK FUNCTIONS (Arrow IPC files used to start without Snowflake)
+# -----------------------------------------------------------------------
+
+def read_snapshot_manifest(cache_dir: str = SNAPSHOT_CACHE_DIR):
+
+    manifest_path = os.path.join(cache_dir, SNAPSHOT_MANIFEST_FILE)
+
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def remove_old_snapshot_files(cache_dir: str, versions_to_keep: list):
+
+    for entry in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, entry)
+
+        # Sessions that memory-mapped a removed file keep reading it until they release the snapshot
+        if os.path.isdir(entry_path) and entry not in versions_to_keep:
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+def write_arrow_file(arrow_table: pa.Table, file_path: str):
+    with pa.OSFile(file_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+
+def read_arrow_file(file_path: str):
+    return pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all()
+
+def write_snapshot_files(snapshot: WarehouseSnapshot, cache_dir: str = SNAPSHOT_CACHE_DIR):
+
+    version_dir = os.path.join(cache_dir, snapshot.version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    try:
+        previous_manifest = read_snapshot_manifest(cache_dir)
+    except ValueError:
+        previous_manifest = None
+
+    tables_manifest = {}
+    for table_name, table in snapshot.tables.items():
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        file_name = os.path.join(snapshot.version, f'{table_name}.arrow')
+
+        write_arrow_file(arrow_table, os.path.join(cache_dir, file_name))
+
+        tables_manifest[table_name] = {
+            'file': file_name,
+            'rows': arrow_table.num_rows,
+            'schema': {field.name: str(field.type) for field in arrow_table.schema}
+        }
+
+    # The bitmap index is built once per snapshot and saved with it, so a cold start does not build it again
+    indexes_manifest = {}
+    for index_name, arrow_table in zip(['bitmaps', 'revenue'], snapshot.filter_engine.bitmap_index.to_arrow()):
+        indexes_manifest[index_name] = os.path.join(snapshot.version, f'{index_name}_index.arrow')
+        write_arrow_file(arrow_table, os.path.join(cache_dir, indexes_manifest[index_name]))
+
+    manifest = {
+        'format': SNAPSHOT_FILE_FORMAT,
+        'account': snapshot.key[0],
+        'database': snapshot.key[1],
+        'schema': snapshot.key[2],
+        'version': snapshot.version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'stats': snapshot.stats,
+        'tables': tables_manifest,
+        'indexes': indexes_manifest
+    }
+
+    # The manifest is replaced in one step, so a crash in the middle leaves the previous snapshot usable
+    manifest_path = os.path.join(cache_dir, SNAPSHOT_MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    versions_to_keep = [snapshot.version]
+    if previous_manifest is not None:
+        versions_to_keep.append(previous_manifest['version'])
+    remove_old_snapshot_files(cache_dir, versions_to_keep[:SNAPSHOT_MAX_VERSIONS])
+
+    logger_snapshot.info(f"[SUCCESS] Snapshot {snapshot.version} saved in {version_dir}")
+
+def read_snapshot_files(account: str, database: str, schema: str, cache_dir: str = SNAPSHOT_CACHE_DIR):
+
+    try:
+        manifest = read_snapshot_manifest(cache_dir)
+
+        if manifest is None:
+            return None
+
+        if manifest['format'] != SNAPSHOT_FILE_FORMAT or (manifest['account'], manifest['database'], manifest['schema']) != (account, database, schema):
+            logger_snapshot.info(f"[INFO] The snapshot saved in {cache_dir} belongs to another account or format, it will not be used")
+            return None
+
+        tables = {}
+        for table_name in DWH_TABLE_NAMES:
+            table_manifest = manifest['tables'][table_name]
+            arrow_table = read_arrow_file(os.path.join(cache_dir, table_manifest['file']))
+
+            schema_found = {field.name: str(field.type) for field in arrow_table.schema}
+            if arrow_table.num_rows != table_manifest['rows'] or schema_found != table_manifest['schema']:
+                logger_snapshot.error(f"[ERROR] The file of the table {table_name} does not match the manifest of the snapshot {manifest['version']}")
+                return None
+
+            # Split blocks keep the numeric columns pointing to the memory-mapped file instead of copying them
+            tables[table_name] = arrow_table.to_pandas(split_blocks=True)
+
+        bitmap_index = BitmapIndex.from_arrow(*[read_arrow_file(os.path.join(cache_dir, manifest['indexes'][index_name])) for index_name in ['bitmaps', 'revenue']])
+
+        if bitmap_index.rows != len(tables[FACT_TABLE_KEY]):
+            logger_snapshot.error(f"[ERROR] The bitmap index does not match the fact table of the snapshot {manifest['version']}")
+            return None
+
+    except (OSError, ValueError, KeyError) as error:
+        logger_snapshot.error(f"[ERROR] The snapshot saved in {cache_dir} could not be read:\n\t- Msg: {error}")
+        return None
+
+    snapshot = WarehouseSnapshot(account, database, schema, manifest['version'], tables, manifest['stats'], bitmap_index)
+    logger_snapshot.info(f"[SUCCESS] Snapshot {snapshot.version} loaded from {cache_dir}")
+    snapshot.log_memory_usage()
+
+    return snapshot
+
+# -----------------------------------------------------------------------
+#          SESSION FUNCTIONS (each session only keeps its filters)
+# -----------------------------------------------------------------------
+
+def set_session_snapshot(snapshot: WarehouseSnapshot):
+    st.session_state[SNAPSHOT_KEY] = snapshot
+    st.session_state[FILTER_MASKS_KEY] = lambda: {}
+    st.session_state[FILTER_SIGNATURE_KEY] = None
+    st.session_state[FILTER_SELECTION_KEY] = None
+    st.session_state[FILTER_AGGREGATES_KEY] = None
+
+def get_session_snapshot():
+    return st.session_state[SNAPSHOT_KEY]
+
+def set_session_filters(selection: dict, signature: tuple, get_masks):
+
+    # The masks are only built when a page reads a filtered table, so a chart answered from the cube or the totals never waits for them
+    st.session_state[FILTER_MASKS_KEY] = get_masks
+    st.session_state[FILTER_SIGNATURE_KEY] = signature
+    st.session_state[FILTER_SELECTION_KEY] = selection
+
+def get_session_selection():
+    return st.session_state[FILTER_SELECTION_KEY]
+
+def get_session_masks():
+
+    # The masks may come from the shared cache, so the session gets its own dict
+    return dict(get_session_result(FILTER_MASKS_KEY, st.session_state[FILTER_MASKS_KEY]))
+
+def get_session_aggregates():
+    return st.session_state.get(FILTER_AGGREGATES_KEY)
+
+def set_session_aggregates(aggregates: FilterAggregates):
+    st.session_state[FILTER_AGGREGATES_KEY] = aggregates
+
+def get_masked_table(snapshot: WarehouseSnapshot, masks: dict, table_name: str):
+
+    table = snapshot.tables[table_name]
+    mask = masks.get(table_name)
+
+    if mask is None:
+        return table
+
+    return table[mask]
+
+def get_session_table(table_name: str):
+    return get_masked_table(get_session_snapshot(), get_session_masks(), table_name)
+
+def get_snapshot_result(snapshot: WarehouseSnapshot, signature: tuple, result_name: str, compute):
+
+    # The results of the same filters are the same for every session that uses the same snapshot
+    key = (snapshot.key, snapshot.version, signature, result_name)
+
+    return get_filter_result_cache().get_or_compute(key, compute)
+
+def get_session_result(result_name: str, compute):
+    return get_snapshot_result(get_session_snapshot(), st.session_state[FILTER_SIGNATURE_KEY], result_name, compute)
+
+def get_primary_key_mask(table_name: str, filtered_table: pd.DataFrame):
+
+    primary_key = DWH_PRIMARY_KEYS[table_name]
+    table = get_session_snapshot().tables[table_name]
+
+    return table[primary_key].isin(filtered_table[primary_key]).to_numpy()
+
+def get_bridge_genres_mask(filtered_genres: pd.DataFrame):
+
+    # The bridge rows are not downloaded, they are the ones of the filtered genres like in the EXISTS of the fact query
+    bridge_genres = get_session_snapshot().tables[BRIDGE_GENRES_KEY]
+
+    return bridge_genres['GENRE_ID'].isin(filtered_genres['GENRE_ID']).to_numpy()
@@ -0,0 +1,120 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                           UTILITIES STAR
+#   Denormalized view of the films of the snapshot, with the names of
+#   the dimensions and the bridges as offsets, built once per snapshot.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+from utilities_filters import get_positions
+from global_parameters import *
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_name_codes(dim_table: pd.DataFrame, id_column: str, name_column: str, ids):
+
+    # Ids missing from the dimension get the code -1, like the rows an inner merge would drop
+    names = pd.Categorical(dim_table[name_column])
+    codes = np.append(names.codes.astype(np.int32), np.int32(-1))[get_positions(ids, dim_table[id_column])]
+
+    return pd.Categorical.from_codes(codes, dtype=names.dtype)
+
+def get_ranges(starts, lengths):
+
+    # Positions of every range, one after the other, without a Python loop
+    ends = np.cumsum(lengths)
+    offsets = np.repeat(ends - lengths - starts, lengths)
+
+    return np.arange(ends[-1] if len(ends) > 0 else 0) - offsets
+
+# -----------------------------------------------------------------------
+#                            BRIDGE OFFSETS
+# -----------------------------------------------------------------------
+
+class BridgeOffsets:
+
+    # Like a CSR matrix: the entries of the film in position i are the ones between offsets[i] and offsets[i + 1]
+    def __init__(self, offsets, bridge_positions, names: pd.Categorical):
+        self.offsets = offsets
+        self.bridge_positions = bridge_positions
+        self.names = names
+
+    @classmethod
+    def build(cls, fact_table: pd.DataFrame, bridge_table: pd.DataFrame, dim_table: pd.DataFrame, id_column: str, name_column: str):
+
+        film_positions = get_positions(bridge_table['FILM_RANK'], fact_table['FILM_RANK']).astype(np.int64)
+        names = get_name_codes(dim_table, id_column, name_column, bridge_table[id_column])
+
+        # The entries of each film keep the order of the bridge, as the merge on FILM_RANK does
+        found = np.flatnonzero((film_positions < len(fact_table)) & (names.codes >= 0))
+        bridge_positions = found[np.argsort(film_positions[found], kind='stable')].astype(np.int32)
+
+        offsets = np.zeros(len(fact_table) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(film_positions[bridge_positions], minlength=len(fact_table)), out=offsets[1:])
+
+        return cls(offsets, bridge_positions, names[bridge_positions])
+
+    def get_entries(self, film_rows, bridge_mask=None):
+
+        entries = get_ranges(self.offsets[film_rows], self.offsets[film_rows + 1] - self.offsets[film_rows])
+        entry_films = np.repeat(np.arange(len(film_rows)), self.offsets[film_rows + 1] - self.offsets[film_rows])
+
+        # The bridge mask of the session already leaves out the rows of the genres that are not selected
+        if bridge_mask is not None:
+            selected = bridge_mask[self.bridge_positions[entries]]
+            entries, entry_films = entries[selected], entry_films[selected]
+
+        return entries, entry_films
+
+    def get_names(self, entries):
+        return np.asarray(self.names.categories)[self.names.codes[entries]]
+
+# -----------------------------------------------------------------------
+#                              FILM VIEW
+# -----------------------------------------------------------------------
+
+class FilmView:
+
+    # One row per film of the fact table, in the same order, so the fact mask of a session selects its rows directly
+    def __init__(self, films: pd.DataFrame, complete, bridges: dict):
+        self.films = films
+        self.complete = complete
+        self.bridges = bridges
+
+    @classmethod
+    def build(cls, tables: dict):
+
+        fact_table = tables[FACT_TABLE_KEY]
+        dim_years = tables[DIM_YEARS_KEY]
+
+        year_positions = get_positions(fact_table['YEAR_ID'], dim_years['YEAR_ID'])
+        director_names = get_name_codes(tables[DIM_DIRECTORS_KEY], 'DIRECTOR_ID', 'DIRECTOR_NAME', fact_table['DIRECTOR_ID'])
+
+        # Films without a year or a director would be dropped by the merges, so they are never selected
+        complete = (year_positions < len(dim_years)) & (director_names.codes >= 0)
+
+        films = pd.DataFrame({
+            'REVENUE': fact_table['REVENUE'].to_numpy(),
+            'YEAR': dim_years['YEAR'].to_numpy()[np.minimum(year_positions, len(dim_years) - 1)],
+            'AVERAGE_SCORE': fact_table[['USER_SCORE', 'CRITIC_SCORE']].mean(axis=1).to_numpy(),
+            'DIRECTOR_NAME': director_names
+        })
+
+        bridges = {
+            BRIDGE_GENRES_KEY: BridgeOffsets.build(fact_table, tables[BRIDGE_GENRES_KEY], tables[DIM_GENRES_KEY], 'GENRE_ID', 'GENRE_NAME'),
+            BRIDGE_ACTORS_KEY: BridgeOffsets.build(fact_table, tables[BRIDGE_ACTORS_KEY], tables[DIM_ACTORS_KEY], 'ACTOR_ID', 'ACTOR_NAME')
+        }
+
+        return cls(films, complete, bridges)
+
+    def get_film_rows(self, fact_mask=None):
+        return np.flatnonzero(self.complete if fact_mask is None else self.complete & fact_mask)
+
+    def memory_usage(self):
+        bridges_bytes = sum(bridge.offsets.nbytes + bridge.bridge_positions.nbytes + bridge.names.codes.nbytes for bridge in self.bridges.values())
+
+        return int(self.films.memory_usage(index=True, deep=True).sum()) + self.complete.nbytes + bridges_bytes
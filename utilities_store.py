@@ -0,0 +1,82 @@
+# ///////////////////////////////////////////////////////////////////////
+#
+#                          UTILITIES STORE
+#   Compact types of the IMDB_DWH tables kept in memory, shared by the
+#   Snowflake and PostgreSQL loaders and read by every chart.
+#
+# ///////////////////////////////////////////////////////////////////////
+
+import numpy as np
+import pandas as pd
+from global_parameters import *
+
+# -----------------------------------------------------------------------
+#                          GENERAL FUNCTIONS
+# -----------------------------------------------------------------------
+
+def get_int_dtype(values):
+
+    # Ids, years and scores never need 64 bits, int16 is the smallest type used so small tables do not change type often
+    if len(values) == 0:
+        return np.dtype(np.int16)
+
+    for dtype in [np.int16, np.int32]:
+        if np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    return np.dtype(np.int64)
+
+def get_float_dtype(values):
+
+    # Only the columns whose values are the same in float32 are reduced, so the filters compare the same numbers
+    if np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+        return np.dtype(np.float32)
+
+    return np.dtype(np.float64)
+
+def get_category_dtype(column: str, values: pd.Series):
+
+    # The categories are sorted like the strings, so the charts sort and filter them in the same order as before
+    options = set(STORE_CATEGORY_OPTIONS[column]) | set(values.dropna().unique())
+
+    return pd.CategoricalDtype(sorted(options))
+
+def is_same_dtype(dtype, other_dtype):
+
+    # Unordered categorical types are equal with the same categories in any order, but the codes are not
+    if isinstance(dtype, pd.CategoricalDtype) and isinstance(other_dtype, pd.CategoricalDtype):
+        return list(dtype.categories) == list(other_dtype.categories)
+
+    return dtype == other_dtype
+
+def get_table_memory(table: pd.DataFrame):
+    return int(table.memory_usage(index=True, deep=True).sum())
+
+# -----------------------------------------------------------------------
+#                             COMPACT STORE
+# -----------------------------------------------------------------------
+
+def get_compact_dtypes(table: pd.DataFrame):
+
+    dtypes = {}
+    for column in table.columns:
+        values = table[column]
+
+        if column in STORE_CATEGORY_OPTIONS:
+            dtypes[column] = get_category_dtype(column, values)
+        elif pd.api.types.is_integer_dtype(values.dtype) and not pd.api.types.is_extension_array_dtype(values.dtype):
+            dtypes[column] = get_int_dtype(values.to_numpy())
+        elif pd.api.types.is_float_dtype(values.dtype):
+            dtypes[column] = get_float_dtype(values.to_numpy(dtype=np.float64))
+
+    return dtypes
+
+def get_compact_table(table: pd.DataFrame):
+
+    dtypes = {column: dtype for column, dtype in get_compact_dtypes(table).items() if not is_same_dtype(dtype, table[column].dtype)}
+
+    # Columns that are already compact are not copied
+    if len(dtypes) == 0:
+        return table
+
+    return table.astype(dtypes)